@@ -0,0 +1,427 @@
+# Async version of the multi-user chat API: LLM calls are awaited, so one process can
+# keep thousands of questions in flight instead of one per worker thread.
+# Run: python app_async.py
+import asyncio
+import datetime
+import itertools
+import os
+import uuid
+from functools import wraps
+
+import httpx
+from aiohttp import web
+from dotenv import load_dotenv
+from itsdangerous import BadSignature, URLSafeSerializer
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_openai import AzureChatOpenAI
+
+from auth_tokens import TokenAuth, secret_keys_from_env
+from context_builder import TranscriptCache, context_token_budget
+from history_pages import SESSIONS_PAGE_SIZE, ask_history, ask_history_mode, etag_matches, history_etag, history_page, page_args, session_page
+from history_store import LocalHistoryStore, SqliteHistoryStore
+from password_hashing import PasswordHasher, PasswordHasherBusy
+from response_cache import prompt_cache_key
+from single_flight import AsyncSingleFlight
+from streaming import sse_event
+from user_store import JsonUserStore, SessionReaper, open_user_store
+
+# Load environment variables from .env file
+load_dotenv()
+
+HISTORY_DIR = "chat_histories"
+USERS_FILE = os.path.join(HISTORY_DIR, "users.json")
+USERS_DB_FILE = os.path.join(HISTORY_DIR, "users.db")
+USER_STORAGE_MODE = os.getenv("USER_STORAGE_MODE", "json")
+# Login sessions expire SESSION_IDLE_TTL_SECONDS after their last use or SESSION_MAX_AGE_SECONDS after
+# login (0 means never); a background thread removes expired ones in batches
+SESSION_IDLE_TTL_SECONDS = int(os.getenv("SESSION_IDLE_TTL_SECONDS", "86400"))
+SESSION_MAX_AGE_SECONDS = int(os.getenv("SESSION_MAX_AGE_SECONDS", "604800"))
+SESSION_REAP_INTERVAL_SECONDS = float(os.getenv("SESSION_REAP_INTERVAL_SECONDS", "60"))
+SESSION_REAP_BATCH_SIZE = int(os.getenv("SESSION_REAP_BATCH_SIZE", "1000"))
+# Set SECRET_KEY to the same value on every worker so all of them accept the same cookies and tokens
+SECRET_KEYS = secret_keys_from_env()
+SESSION_COOKIE = "session"
+# Turns stored per session; the context sent to the model is cut by CONTEXT_TOKEN_BUDGET, so this
+# is kept high enough that the budget, not the stored-turn cap, decides what is sent
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "50"))
+# Only the most recent turns that fit in this many tokens are sent as context
+CONTEXT_TOKEN_BUDGET = context_token_budget(os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"))
+# /ask responses carry the session's whole history ("full") or just the new turn ("delta");
+# a request can pick its own with "history_mode"
+ASK_HISTORY_MODE = ask_history_mode(os.getenv("ASK_HISTORY_MODE"))
+# Upper bound on concurrent connections to Azure OpenAI, i.e. on questions in flight
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "1000"))
+# httpx looks through its whole connection pool on every request, which gets slow with
+# thousands of connections, so they are spread over several clients of this size
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "100"))
+
+os.makedirs(HISTORY_DIR, exist_ok=True)
+
+# Password hashing runs in worker processes so a burst of logins doesn't stall the event loop.
+# PASSWORD_HASH_METHOD is a werkzeug method string, e.g. "scrypt" or "pbkdf2:sha256:600000".
+password_hasher = PasswordHasher(os.getenv("PASSWORD_HASH_METHOD", "scrypt"),
+                                 int(os.getenv("PASSWORD_HASH_WORKERS", "2")),
+                                 int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64")))
+
+# Same session history handling as app_multiuser.py: an LRU cache that spills colder sessions to disk,
+# or with HISTORY_STORAGE_MODE=sqlite a database shared by every worker process
+HISTORY_STORAGE_MODE = os.getenv("HISTORY_STORAGE_MODE", "memory")
+HISTORY_CACHE_MAX_SESSIONS = int(os.getenv("HISTORY_CACHE_MAX_SESSIONS", "10000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", "0"))
+SPILL_DIR = os.path.join(HISTORY_DIR, "spill")
+HISTORY_DB_FILE = os.path.join(HISTORY_DIR, "chat_histories.db")
+if HISTORY_STORAGE_MODE == "sqlite":
+    session_store = SqliteHistoryStore(HISTORY_DB_FILE)
+else:
+    session_store = LocalHistoryStore(SPILL_DIR, HISTORY_CACHE_MAX_SESSIONS, HISTORY_CACHE_MAX_BYTES)
+
+# Rendered "Previous conversation:" transcripts, kept in step with the stored histories
+transcripts = TranscriptCache(HISTORY_CACHE_MAX_SESSIONS)
+
+# Prompt template with context awareness
+prompt_template = ChatPromptTemplate.from_messages([
+    ("system", "You are a helpful assistant providing concise and accurate answers. Maintain context from the conversation history."),
+    ("human", "{question}")
+])
+
+
+def make_chain():
+    llm = AzureChatOpenAI(
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+        azure_deployment=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"),
+        temperature=0.7,
+        max_tokens=500,
+        http_async_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE),
+            timeout=httpx.Timeout(600, connect=5.0)
+        )
+    )
+    return prompt_template | llm
+
+
+# Requests take turns over the chains, and so over their connection pools
+chains = itertools.cycle([make_chain() for _ in range(max(1, -(-LLM_MAX_CONNECTIONS // LLM_POOL_SIZE)))])
+
+# Identical prompts arriving while the first one is still being answered wait for its answer
+single_flight = AsyncSingleFlight()
+
+# Signed cookie holding the logged-in user, like Flask's session cookie
+session_serializer = URLSafeSerializer(SECRET_KEYS, salt="session")
+# /login also returns a bearer token, checked with one HMAC on any worker without reading the user store
+token_auth = TokenAuth(SECRET_KEYS, int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "86400")))
+
+
+# User management functions
+def save_users():
+    try:
+        users.flush()
+        return True
+    except Exception as e:
+        print(f"Error saving users: {e}")
+        return False
+
+
+def load_users():
+    try:
+        store = open_user_store(USER_STORAGE_MODE, USERS_FILE, USERS_DB_FILE,
+                                SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
+        if store.is_empty():
+            store.add_user('admin', password_hasher.hash('admin'))
+            store.flush()
+        return store
+    except Exception as e:
+        print(f"Error loading users: {e}")
+        store = JsonUserStore(None, SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
+        store.add_user('admin', password_hasher.hash('admin'))
+        return store
+
+
+# Users, plus which user owns each login session so /ask can credit a session_id sent without the cookie
+users = load_users()
+session_reaper = SessionReaper(users, SESSION_REAP_INTERVAL_SECONDS, SESSION_REAP_BATCH_SIZE, on_reaped=save_users)
+
+
+async def user_call(method, *args):
+    """
+    Call a `users` method off the event loop: the sqlite store queries and commits,
+    and the JSON store's save rewrites the whole file.
+    """
+    return await asyncio.to_thread(method, *args)
+
+
+async def get_login(request):
+    """Return the {"username", "session_id"} of a valid bearer token, else of the session cookie, or {}."""
+    login_state = token_auth.verify_header(request.headers.get('Authorization'))
+    if not login_state:
+        cookie = request.cookies.get(SESSION_COOKIE)
+        if not cookie:
+            return {}
+        try:
+            login_state = session_serializer.loads(cookie)
+        except BadSignature:
+            return {}
+    # Either is only good while its login session hasn't expired or been logged out
+    if await user_call(users.touch, login_state.get('session_id')) != login_state.get('username'):
+        return {}
+    return login_state
+
+
+def json_error(message, status):
+    return web.json_response({"error": message}, status=status)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+def login_required(handler):
+    @wraps(handler)
+    async def decorated_handler(request):
+        if 'username' not in await get_login(request):
+            return json_error("Authentication required", 401)
+        return await handler(request)
+    return decorated_handler
+
+
+async def history_call(method, *args):
+    """Call a session_store method; in sqlite mode it may wait on other workers' writes, so off the event loop."""
+    if HISTORY_STORAGE_MODE == "sqlite":
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+
+async def store_turn(session_id, question, answer, username, history_mode):
+    """Append a finished turn to the session's history and return the history fields of the response."""
+    turn = {
+        "question": question,
+        "answer": answer,
+        "timestamp": str(datetime.datetime.now()),
+        "user": username or "anonymous"
+    }
+    session_history, version = await history_call(session_store.append_turn, session_id, turn, MAX_HISTORY_LENGTH)
+    transcripts.update(session_id, session_history)
+    return ask_history(history_mode, session_history, turn, version)
+
+
+# Authentication endpoints
+async def register(request):
+    data = await read_json(request)
+    if not data or 'username' not in data or 'password' not in data:
+        return json_error("Missing username or password", 400)
+    username, password = data['username'], data['password']
+    if await user_call(users.__contains__, username):
+        return json_error("Username already exists", 400)
+    # Hashing is deliberately slow; it runs in the worker processes, off the event loop and its GIL
+    try:
+        password_hash = await password_hasher.hash_async(password)
+    except PasswordHasherBusy:
+        return json_error("Too many logins in progress, try again shortly", 503)
+    if not await user_call(users.add_user, username, password_hash):
+        return json_error("Username already exists", 400)
+    await user_call(save_users)
+    return web.json_response({"message": f"User {username} registered", "status": "success"}, status=201)
+
+
+async def login(request):
+    data = await read_json(request)
+    if not data or 'username' not in data or 'password' not in data:
+        return json_error("Missing username or password", 400)
+    username, password = data['username'], data['password']
+    user = await user_call(users.get, username)
+    try:
+        valid = user is not None and await password_hasher.verify_async(user['password_hash'], password)
+    except PasswordHasherBusy:
+        return json_error("Too many logins in progress, try again shortly", 503)
+    if not valid:
+        return json_error("Invalid credentials", 401)
+    session_id = str(uuid.uuid4())
+    await user_call(users.add_session, username, session_id)
+    await user_call(save_users)
+    response = web.json_response({"message": f"User {username} logged in", "session_id": session_id,
+                                  "token": token_auth.issue(username, session_id),
+                                  "expires_in": token_auth.ttl_seconds})
+    response.set_cookie(SESSION_COOKIE, session_serializer.dumps({"username": username, "session_id": session_id}),
+                        httponly=True)
+    return response
+
+
+@login_required
+async def logout(request):
+    data = await read_json(request) or {}
+    login_state = await get_login(request)
+    session_id = data.get('session_id', login_state.get('session_id'))
+    username = login_state.get('username')
+    if await user_call(users.remove_session, username, session_id):
+        await user_call(save_users)
+    response = web.json_response({"message": "Logged out successfully"})
+    response.del_cookie(SESSION_COOKIE)
+    return response
+
+
+# Chat endpoints
+async def ask_question(request, stream=False):
+    """
+    Ask a question to GPT-4o. Expects a JSON payload with 'question' and optional 'session_id'.
+    Returns the answer along with the session's chat history (only the new turn with
+    "history_mode": "delta"), or streams it as Server-Sent Events with "stream": true
+    (see /ask/stream).
+    """
+    try:
+        data = await read_json(request)
+        if not data or 'question' not in data:
+            return json_error("Missing 'question' in request body", 400)
+
+        question = data['question']
+        login_state = await get_login(request)
+        session_id = data.get('session_id', login_state.get('session_id', 'default_session'))
+        if login_state.get('session_id') == session_id:
+            username = login_state.get('username')
+        else:
+            username = await user_call(users.touch, session_id)
+        try:
+            history_mode = ask_history_mode(data.get('history_mode'), ASK_HISTORY_MODE)
+        except ValueError as e:
+            return json_error(str(e), 400)
+        print(f"Question received from session {session_id}: {question}")
+
+        session_history = await history_call(session_store.get_session, session_id) or []
+        context = transcripts.context(session_id, session_history, CONTEXT_TOKEN_BUDGET)
+        contextualized_question = f"{context}\nHuman: {question}" if context else question
+
+        if stream or data.get('stream', False):
+            return await stream_answer(request, session_id, question, contextualized_question, username,
+                                       history_mode)
+
+        prompt_key = prompt_cache_key(prompt_template.format_messages(question=contextualized_question))
+        response, _ = await single_flight.do(
+            prompt_key, lambda: next(chains).ainvoke({"question": contextualized_question}))
+        print(f"Response for session {session_id}: {response.content}")
+        history_fields = await store_turn(session_id, question, response.content, username, history_mode)
+        return web.json_response({
+            "answer": response.content,
+            "status": "success",
+            "session_id": session_id,
+            **history_fields
+        })
+    except Exception as e:
+        return json_error(f"Unexpected error: {type(e).__name__}: {str(e)}", 500)
+
+
+async def stream_answer(request, session_id, question, contextualized_question, username, history_mode):
+    """Send "token" events while the answer is generated, then store the turn and send "done"."""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                           "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+    start = asyncio.get_running_loop().time()
+    first_token_ms = None
+    parts = []
+    try:
+        async for chunk in next(chains).astream({"question": contextualized_question}):
+            if not chunk.content:
+                continue
+            if first_token_ms is None:
+                first_token_ms = round((asyncio.get_running_loop().time() - start) * 1000, 1)
+            parts.append(chunk.content)
+            await response.write(sse_event("token", {"token": chunk.content}).encode())
+    except ConnectionResetError:
+        # The client went away; the unfinished answer is not stored
+        raise
+    except Exception as e:
+        await response.write(sse_event("error", {"error": f"Unexpected error: {type(e).__name__}: {str(e)}"}).encode())
+        return response
+    answer = "".join(parts)
+    print(f"Response for session {session_id}: {answer}")
+    history_fields = await store_turn(session_id, question, answer, username, history_mode)
+    await response.write(sse_event("done", {
+        "answer": answer,
+        "status": "success",
+        "session_id": session_id,
+        **history_fields,
+        "time_to_first_token_ms": first_token_ms
+    }).encode())
+    return response
+
+
+async def ask_question_stream(request):
+    return await ask_question(request, stream=True)
+
+
+async def get_history(request):
+    """Like app_multiuser.py: 'limit' and 'before' / 'after' cursors, and an ETag checked against If-None-Match."""
+    session_id = request.query.get('session_id', 'default_session')
+    try:
+        limit, before, after = page_args(request.query)
+    except ValueError as e:
+        return json_error(str(e), 400)
+    # Version first, so a turn stored in between only makes the ETag too old, never too new
+    version = await history_call(session_store.session_version, session_id)
+    etag = history_etag(session_store.version_tag, version)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers={"ETag": etag})
+    session_history = await history_call(session_store.get_session, session_id) or []
+    return web.json_response({
+        **history_page(session_history, limit, before, after),
+        "version": version,
+        "session_id": session_id
+    }, headers={"ETag": etag})
+
+
+async def get_sessions(request):
+    try:
+        limit, _, after = page_args(request.query, SESSIONS_PAGE_SIZE)
+    except ValueError as e:
+        return json_error(str(e), 400)
+    return web.json_response(session_page(await history_call(session_store.session_id_page, after, limit + 1), limit))
+
+
+async def clear_history(request):
+    data = await read_json(request) or {}
+    session_id = data.get('session_id', 'default_session')
+    transcripts.discard(session_id)
+    if await history_call(session_store.clear_session, session_id):
+        message = f"Chat history for session {session_id} cleared successfully"
+    else:
+        message = f"No history found for session {session_id}"
+    return web.json_response({"message": message, "status": "success", "session_id": session_id})
+
+
+async def clear_all_history(request):
+    session_count = await history_call(session_store.clear_all)
+    transcripts.clear()
+    return web.json_response({"message": f"Chat history cleared for all {session_count} sessions", "status": "success"})
+
+
+async def cache_stats(request):
+    return web.json_response({"cache": session_store.stats() if HISTORY_STORAGE_MODE != "sqlite" else None, "single_flight": single_flight.stats(),
+                              "status": "success"})
+
+
+async def session_stats(request):
+    return web.json_response({"sessions": await user_call(users.stats), "password_hashing": password_hasher.stats(),
+                              "status": "success"})
+
+
+async def generate_session(request):
+    return web.json_response({"session_id": str(uuid.uuid4()), "status": "success"})
+
+
+app = web.Application()
+app.router.add_post('/register', register)
+app.router.add_post('/login', login)
+app.router.add_post('/logout', logout)
+app.router.add_post('/ask', ask_question)
+app.router.add_post('/ask/stream', ask_question_stream)
+app.router.add_get('/history', get_history)
+app.router.add_get('/sessions', get_sessions)
+app.router.add_post('/clear-history', clear_history)
+app.router.add_post('/clear-all-history', clear_all_history)
+app.router.add_get('/cache-stats', cache_stats)
+app.router.add_get('/session-stats', session_stats)
+app.router.add_get('/generate-session', generate_session)
+
+
+if __name__ == '__main__':
+    web.run_app(app, host='localhost', port=3000, backlog=4096)
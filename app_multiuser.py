@@ -5,6 +5,13 @@ from dotenv import load_dotenv
 import os
 import datetime
 import uuid
+from context_builder import TranscriptCache, context_token_budget
+from history_pages import SESSIONS_PAGE_SIZE, ask_history, ask_history_mode, etag_matches, history_etag, history_page, page_args, session_page
+from history_store import LocalHistoryStore, SqliteHistoryStore
+from response_cache import prompt_cache_key
+from session_locks import SessionLocks
+from single_flight import SingleFlight
+from streaming import sse_response, stream_answer
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,9 +19,38 @@ load_dotenv()
 # Initialize Flask application
 app = Flask(__name__)
 
-# Initialize chat history storage with session support
-chat_histories = {}
-MAX_HISTORY_LENGTH = 10
+# Turns stored per session; the context sent to the model is cut by CONTEXT_TOKEN_BUDGET, so this
+# is kept high enough that the budget, not the stored-turn cap, decides what is sent
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "50"))
+# Only the most recent turns that fit in this many tokens are sent as context
+CONTEXT_TOKEN_BUDGET = context_token_budget(os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"))
+# /ask responses carry the session's whole history ("full") or just the new turn ("delta");
+# a request can pick its own with "history_mode"
+ASK_HISTORY_MODE = ask_history_mode(os.getenv("ASK_HISTORY_MODE"))
+
+# Initialize chat history storage with session support.
+# By default histories live in this process: at most HISTORY_CACHE_MAX_SESSIONS (0 = unlimited) or
+# HISTORY_CACHE_MAX_BYTES of them stay in memory and colder sessions spill to SPILL_DIR. With
+# HISTORY_STORAGE_MODE=sqlite they are rows in HISTORY_DB_FILE (WAL mode) instead, shared by every
+# worker process, so a follow-up question can land on any worker and still see the conversation.
+HISTORY_STORAGE_MODE = os.getenv("HISTORY_STORAGE_MODE", "memory")
+HISTORY_CACHE_MAX_SESSIONS = int(os.getenv("HISTORY_CACHE_MAX_SESSIONS", "10000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", "0"))
+HISTORY_DIR = "chat_histories"
+SPILL_DIR = os.path.join(HISTORY_DIR, "spill")
+HISTORY_DB_FILE = os.path.join(HISTORY_DIR, "chat_histories.db")
+os.makedirs(HISTORY_DIR, exist_ok=True)
+if HISTORY_STORAGE_MODE == "sqlite":
+    session_store = SqliteHistoryStore(HISTORY_DB_FILE)
+else:
+    session_store = LocalHistoryStore(SPILL_DIR, HISTORY_CACHE_MAX_SESSIONS, HISTORY_CACHE_MAX_BYTES)
+
+# Rendered "Previous conversation:" transcripts, kept in step with the stored histories
+# (and rebuilt when another worker has changed a session)
+transcripts = TranscriptCache(HISTORY_CACHE_MAX_SESSIONS)
+
+# Serializes updates to one session's history; requests for other sessions don't wait
+session_locks = SessionLocks()
 
 llm = AzureChatOpenAI(
         api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
@@ -31,16 +67,31 @@ prompt_template = ChatPromptTemplate.from_messages([
 
 chain = prompt_template | llm
 
+# Identical prompts (e.g. the same first question from many new sessions) that arrive
+# while the first one is still being answered wait for its answer instead of calling the LLM
+single_flight = SingleFlight()
+
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_question_stream():
+    """
+    REST API endpoint to ask a question and stream the answer as Server-Sent Events.
+    Same as /ask with "stream": true.
+    """
+    return ask_question(stream=True)
+
 
 @app.route('/ask', methods=['POST'])
-def ask_question():
+def ask_question(stream=False):
     """
     REST API endpoint to ask a question to GPT-4o.
     Expects a JSON payload with 'question' field and optional 'session_id'.
-    Returns the model's response as JSON along with the chat history for that session.
+    Returns the model's response as JSON along with the chat history for that session,
+    or only the new turn with "history_mode": "delta" (see ASK_HISTORY_MODE).
+    With "stream": true the answer is sent as "token" events while it is generated,
+    followed by a "done" event with the usual response; the turn is only stored once
+    the answer is complete.
     """
-    global chat_histories
-
     try:
         # Get JSON data from the request
         data = request.get_json()
@@ -50,51 +101,56 @@ def ask_question():
         # Extract question and session_id from the request
         question = data['question']
         session_id = data.get('session_id', 'default_session')
+        try:
+            history_mode = ask_history_mode(data.get('history_mode'), ASK_HISTORY_MODE)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         print(f"Question received from session {session_id}: {question}")
 
-        # Initialize session history if it doesn't exist
-        if session_id not in chat_histories:
-            chat_histories[session_id] = []
+        # Initialize session history if it doesn't exist, and get the chat history for this session
+        with session_locks.hold(session_id):
+            session_history = session_store.get_session(session_id)
+            if session_history is None:
+                session_store.create_session(session_id)
+                session_history = []
 
-        # Get the chat history for this session
-        session_history = chat_histories[session_id]
-
-        # Create context from chat history
-        context = ""
-        if session_history:
-            context = "Previous conversation:\n"
-            for entry in session_history:
-                context += f"Human: {entry['question']}\nAI: {entry['answer']}\n"
+        # Create context from chat history (cached per session, updated one turn at a time)
+        context = transcripts.context(session_id, session_history, CONTEXT_TOKEN_BUDGET)
 
         # Prepare the question with context if there's history
         contextualized_question = question
         if context:
             contextualized_question = f"{context}\nHuman: {question}"
 
+        def finish(answer):
+            print(f"Response for session {session_id}: {answer}")
+
+            # Update chat history for this session, limited to MAX_HISTORY_LENGTH entries. The store
+            # appends to whatever is there now, since other requests (on this worker or another)
+            # may have changed it while the answer was being generated.
+            with session_locks.hold(session_id):
+                turn = {"question": question, "answer": answer, "timestamp": str(datetime.datetime.now())}
+                session_history, version = session_store.append_turn(session_id, turn, MAX_HISTORY_LENGTH)
+                transcripts.update(session_id, session_history)
+
+            # Return the response with the chat history (or just the new turn) for this session
+            return {
+                "answer": answer,
+                "status": "success",
+                "session_id": session_id,
+                **ask_history(history_mode, session_history, turn, version)
+            }
+
+        if stream or data.get('stream', False):
+            chunks = (chunk.content for chunk in chain.stream({"question": contextualized_question}))
+            return sse_response(stream_answer(chunks, finish))
+
         # Invoke the chain with the user's question
-        response = chain.invoke({
+        prompt_key = prompt_cache_key(prompt_template.format_messages(question=contextualized_question))
+        answer, _ = single_flight.do(prompt_key, lambda: chain.invoke({
             "question": contextualized_question
-        })
-        print(f"Response for session {session_id}: {response.content}")
-
-        # Update chat history for this session
-        chat_histories[session_id].append({
-            "question": question,
-            "answer": response.content,
-            "timestamp": str(datetime.datetime.now())
-        })
-
-        # Limit chat history to MAX_HISTORY_LENGTH entries
-        if len(chat_histories[session_id]) > MAX_HISTORY_LENGTH:
-            chat_histories[session_id] = chat_histories[session_id][-MAX_HISTORY_LENGTH:]
-
-        # Return the response with chat history for this session
-        return jsonify({
-            "answer": response.content,
-            "status": "success",
-            "session_id": session_id,
-            "history": chat_histories[session_id]
-        }), 200
+        }).content)
+        return jsonify(finish(answer)), 200
 
     except KeyError as e:
         return jsonify({"error": f"KeyError: {str(e)}"}), 500
@@ -106,35 +162,47 @@ def ask_question():
 def get_history():
     """
     REST API endpoint to retrieve the chat history for a specific session.
-    Expects a query parameter 'session_id'.
-    Returns the chat history for that session as JSON.
+    Expects a query parameter 'session_id', and optionally 'limit' and a
+    'before' / 'after' cursor to fetch only part of it.
+    Returns the chat history for that session as JSON, with the session's
+    version as ETag; a matching If-None-Match gets an empty 304 instead.
     """
     session_id = request.args.get('session_id', 'default_session')
-
-    if session_id not in chat_histories:
-        return jsonify({
-            "history": [],
-            "count": 0,
-            "session_id": session_id
-        }), 200
-
-    return jsonify({
-        "history": chat_histories[session_id],
-        "count": len(chat_histories[session_id]),
+    try:
+        limit, before, after = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Read the version before the turns: if a turn is stored in between, the
+    # client gets the newer turns under the older ETag and just refetches next time
+    version = session_store.session_version(session_id)
+    etag = history_etag(session_store.version_tag, version)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return "", 304, {"ETag": etag}
+
+    session_history = session_store.get_session(session_id) or []
+    response = jsonify({
+        **history_page(session_history, limit, before, after),
+        "version": version,
         "session_id": session_id
-    }), 200
+    })
+    response.headers["ETag"] = etag
+    return response, 200
 
 
 @app.route('/sessions', methods=['GET'])
 def get_sessions():
     """
-    REST API endpoint to retrieve all active session IDs.
-    Returns a list of all session IDs as JSON.
+    REST API endpoint to retrieve the active session IDs, a page at a time.
+    Takes an optional 'limit' (default SESSIONS_PAGE_SIZE) and the 'after'
+    cursor returned as "next_cursor" by the previous page.
+    Returns the session IDs in ID order as JSON.
     """
-    return jsonify({
-        "sessions": list(chat_histories.keys()),
-        "count": len(chat_histories)
-    }), 200
+    try:
+        limit, _, after = page_args(request.args, SESSIONS_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(session_page(session_store.session_id_page(after, limit + 1), limit)), 200
 
 
 @app.route('/clear-history', methods=['POST'])
@@ -147,8 +215,10 @@ def clear_history():
     data = request.get_json() or {}
     session_id = data.get('session_id', 'default_session')
 
-    if session_id in chat_histories:
-        chat_histories[session_id] = []
+    with session_locks.hold(session_id):
+        transcripts.discard(session_id)
+        found = session_store.clear_session(session_id)
+    if found:
         message = f"Chat history for session {session_id} cleared successfully"
     else:
         message = f"No history found for session {session_id}"
@@ -166,15 +236,29 @@ def clear_all_history():
     REST API endpoint to clear all chat histories for all sessions.
     Returns a confirmation message.
     """
-    global chat_histories
-    session_count = len(chat_histories)
-    chat_histories = {}
+    session_count = session_store.clear_all()
+    transcripts.clear()
     return jsonify({
         "message": f"Chat history cleared for all {session_count} sessions",
         "status": "success"
     }), 200
 
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """
+    REST API endpoint to inspect the in-memory session cache.
+    Returns the cache's size, limits and hit/miss/eviction counters as JSON
+    (none in sqlite mode), plus how many LLM calls were shared between
+    identical in-flight questions.
+    """
+    return jsonify({
+        "cache": session_store.stats() if HISTORY_STORAGE_MODE != "sqlite" else None,
+        "single_flight": single_flight.stats(),
+        "status": "success"
+    }), 200
+
+
 @app.route('/generate-session', methods=['GET'])
 def generate_session():
     """
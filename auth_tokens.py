@@ -0,0 +1,74 @@
+# Signed, expiring bearer tokens and session cookies, so any worker with the shared keys can authenticate a request
+import os
+
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+
+def secret_keys_from_env():
+    """
+    The signing keys, oldest first: SECRET_KEY_PREVIOUS (comma-separated keys that
+    are still accepted while tokens signed with them expire) followed by SECRET_KEY,
+    which signs everything new. Without SECRET_KEY a random key is used, which only
+    works with a single worker process and not across restarts.
+    """
+    current = os.getenv("SECRET_KEY")
+    if not current:
+        print("SECRET_KEY is not set; using a random key, so logins only work in this process")
+        return [os.urandom(24)]
+    previous = [key for key in os.getenv("SECRET_KEY_PREVIOUS", "").split(",") if key]
+    return previous + [current]
+
+
+class TokenAuth:
+    """
+    issue() signs {"username", "session_id"} with HMAC-SHA256 and a timestamp;
+    verify() checks the signature and age without looking anything up, so a
+    token can be verified on every worker and node that shares the keys until
+    `ttl_seconds` after it was issued. The apps then also check that its login
+    session is still live in the user store, which /logout ends.
+    """
+
+    def __init__(self, secret_keys, ttl_seconds=86400):
+        self.ttl_seconds = ttl_seconds
+        self.serializer = URLSafeTimedSerializer(secret_keys, salt="auth-token")
+
+    def issue(self, username, session_id):
+        return self.serializer.dumps({"username": username, "session_id": session_id})
+
+    def verify(self, token):
+        """Return the token's {"username", "session_id"}, or None if it is forged, malformed or expired."""
+        try:
+            return self.serializer.loads(token, max_age=self.ttl_seconds)
+        except BadSignature:
+            return None
+
+    def verify_header(self, authorization):
+        """Like verify(), for an "Authorization: Bearer <token>" header value (which may be None)."""
+        scheme, _, token = (authorization or "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return None
+        return self.verify(token.strip())
+
+
+class RotatingKeySessionInterface(SecureCookieSessionInterface):
+    """
+    Flask's cookie sessions, signed with SECRET_KEY and still accepted when
+    signed with one of SECRET_KEY_FALLBACKS, as Flask 3.1 does; this does the
+    same on older versions, which ignore the fallbacks.
+    """
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        keys = [*(app.config.get("SECRET_KEY_FALLBACKS") or []), app.secret_key]
+        return URLSafeTimedSerializer(keys, salt=self.salt, serializer=self.serializer,
+                                      signer_kwargs={"key_derivation": self.key_derivation,
+                                                     "digest_method": self.digest_method})
+
+
+def use_secret_keys(app, secret_keys):
+    """Sign a Flask app's session cookies with the newest of `secret_keys` and accept any of them."""
+    app.config['SECRET_KEY'] = secret_keys[-1]
+    app.config['SECRET_KEY_FALLBACKS'] = secret_keys[:-1]
+    app.session_interface = RotatingKeySessionInterface()
@@ -1,11 +1,12 @@
 from flask import Flask, jsonify, request, session, redirect, url_for
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 import os
-import json
 from dotenv import load_dotenv
 from langchain_openai import AzureChatOpenAI
 import uuid
+from auth_tokens import TokenAuth, secret_keys_from_env, use_secret_keys
+from password_hashing import PasswordHasher, PasswordHasherBusy
+from user_store import JsonUserStore, SessionReaper, open_user_store
 
 app = Flask(__name__)
 
@@ -15,10 +16,20 @@ load_dotenv()
 # Constants
 HISTORY_DIR = "chat_history"
 USERS_FILE = os.path.join(HISTORY_DIR, "users.json")
-SECRET_KEY = os.urandom(24)
-app.config['SECRET_KEY'] = SECRET_KEY
+USERS_DB_FILE = os.path.join(HISTORY_DIR, "users.db")
+USER_STORAGE_MODE = os.getenv("USER_STORAGE_MODE", "json")
+# Login sessions expire SESSION_IDLE_TTL_SECONDS after their last use or SESSION_MAX_AGE_SECONDS after
+# login (0 means never); a background thread removes expired ones in batches
+SESSION_IDLE_TTL_SECONDS = int(os.getenv("SESSION_IDLE_TTL_SECONDS", "86400"))
+SESSION_MAX_AGE_SECONDS = int(os.getenv("SESSION_MAX_AGE_SECONDS", "604800"))
+SESSION_REAP_INTERVAL_SECONDS = float(os.getenv("SESSION_REAP_INTERVAL_SECONDS", "60"))
+SESSION_REAP_BATCH_SIZE = int(os.getenv("SESSION_REAP_BATCH_SIZE", "1000"))
+# Set SECRET_KEY to the same value on every worker so all of them accept the same cookies and tokens
+SECRET_KEYS = secret_keys_from_env()
+use_secret_keys(app, SECRET_KEYS)
+# /login also returns a bearer token, checked with one HMAC on any worker without reading the user store
+token_auth = TokenAuth(SECRET_KEYS, int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "86400")))
 chat_histories = {}
-users = {}
 
 # Validate Azure OpenAI credentials
 required_vars = {
@@ -41,11 +52,16 @@ llm = AzureChatOpenAI(
 # Ensure history directory exists
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
+# Password hashing runs in worker processes so a burst of logins doesn't stall other requests.
+# PASSWORD_HASH_METHOD is a werkzeug method string, e.g. "scrypt" or "pbkdf2:sha256:600000".
+password_hasher = PasswordHasher(os.getenv("PASSWORD_HASH_METHOD", "scrypt"),
+                                 int(os.getenv("PASSWORD_HASH_WORKERS", "2")),
+                                 int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64")))
+
 # User management functions
-def save_users(users_dict):
+def save_users():
     try:
-        with open(USERS_FILE, 'w') as f:
-            json.dump(users_dict, f, indent=2)
+        users.flush()
         return True
     except Exception as e:
         print(f"Error saving users: {e}")
@@ -53,24 +69,42 @@ def save_users(users_dict):
 
 def load_users():
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r') as f:
-                return json.load(f)
-        else:
-            default_users = {'admin': {'password_hash': generate_password_hash('admin'), 'sessions': []}}
-            save_users(default_users)
-            return default_users
+        store = open_user_store(USER_STORAGE_MODE, USERS_FILE, USERS_DB_FILE,
+                                SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
+        if store.is_empty():
+            store.add_user('admin', password_hasher.hash('admin'))
+            store.flush()
+        return store
     except Exception as e:
         print(f"Error loading users: {e}")
-        return {'admin': {'password_hash': generate_password_hash('admin'), 'sessions': []}}
+        store = JsonUserStore(None, SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
+        store.add_user('admin', password_hasher.hash('admin'))
+        return store
 
-# Load users on startup
+# Load users on startup; the store also indexes which user owns each login session
 users = load_users()
+session_reaper = SessionReaper(users, SESSION_REAP_INTERVAL_SECONDS, SESSION_REAP_BATCH_SIZE, on_reaped=save_users)
+
+def current_login():
+    """The {"username", "session_id"} of a valid bearer token, else of the session cookie; {} if neither."""
+    login_state = token_auth.verify_header(request.headers.get('Authorization'))
+    if login_state:
+        # Like the cookie, the token is only good while its login session hasn't expired or been logged out
+        if users.touch(login_state.get('session_id')) == login_state.get('username'):
+            return login_state
+        return {}
+    if 'username' in session:
+        # The cookie is only good while its login session hasn't expired or been logged out
+        if users.touch(session.get('session_id')) == session['username']:
+            return {"username": session['username'], "session_id": session.get('session_id')}
+        session.pop('username', None)
+        session.pop('session_id', None)
+    return {}
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'username' not in session:
+        if not current_login():
             return jsonify({"error": "Authentication required"}), 401
         return f(*args, **kwargs)
     return decorated_function
@@ -78,46 +112,58 @@ def login_required(f):
 # Authentication endpoints
 @app.route('/register', methods=['POST'])
 def register():
-    global users
     data = request.get_json()
     if not data or 'username' not in data or 'password' not in data:
         return jsonify({"error": "Missing username or password"}), 400
     username, password = data['username'], data['password']
     if username in users:
         return jsonify({"error": "Username already exists"}), 400
-    users[username] = {'password_hash': generate_password_hash(password), 'sessions': []}
-    save_users(users)
+    try:
+        password_hash = password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return jsonify({"error": "Too many logins in progress, try again shortly"}), 503
+    if not users.add_user(username, password_hash):
+        return jsonify({"error": "Username already exists"}), 400
+    save_users()
     return jsonify({"message": f"User {username} registered", "status": "success"}), 201
 
 @app.route('/login', methods=['POST'])
 def login():
-    global users
     data = request.get_json()
     if not data or 'username' not in data or 'password' not in data:
         return jsonify({"error": "Missing username or password"}), 400
     username, password = data['username'], data['password']
-    if username not in users or not check_password_hash(users[username]['password_hash'], password):
+    user = users.get(username)
+    try:
+        valid = user is not None and password_hasher.verify(user['password_hash'], password)
+    except PasswordHasherBusy:
+        return jsonify({"error": "Too many logins in progress, try again shortly"}), 503
+    if not valid:
         return jsonify({"error": "Invalid credentials"}), 401
     session_id = str(uuid.uuid4())
-    users[username]['sessions'].append(session_id)
+    users.add_session(username, session_id)
     session['username'] = username
     session['session_id'] = session_id
-    save_users(users)
-    return jsonify({"message": f"User {username} logged in", "session_id": session_id}), 200
+    save_users()
+    return jsonify({"message": f"User {username} logged in", "session_id": session_id,
+                    "token": token_auth.issue(username, session_id), "expires_in": token_auth.ttl_seconds}), 200
 
 @app.route('/logout', methods=['POST'])
 @login_required
 def logout():
-    global users
     data = request.get_json() or {}
-    session_id = data.get('session_id', session.get('session_id'))
-    username = session.get('username')
-    if username in users and session_id in users[username]['sessions']:
-        users[username]['sessions'].remove(session_id)
-        save_users(users)
+    login_state = current_login()
+    session_id = data.get('session_id', login_state.get('session_id'))
+    username = login_state.get('username')
+    if users.remove_session(username, session_id):
+        save_users()
     session.pop('username', None)
     session.pop('session_id', None)
     return jsonify({"message": "Logged out successfully"}), 200
 
+@app.route('/session-stats', methods=['GET'])
+def session_stats():
+    return jsonify({"sessions": users.stats(), "password_hashing": password_hasher.stats()}), 200
+
 if __name__ == '__main__':
     app.run(port=3000, debug=True)
@@ -0,0 +1,33 @@
+# Load test: fire many concurrent /ask requests at a running server and report how long they took
+# Run against the fake LLM, e.g.:
+#   FAKE_LLM_DELAY_MS=2000 python fake_llm_server.py
+#   AZURE_OPENAI_ENDPOINT=http://localhost:8081 python app_async.py
+#   python bench_async_concurrency.py 2000
+import asyncio
+import sys
+import time
+
+import aiohttp
+
+URL = "http://localhost:3000/ask"
+
+
+async def ask(http, i):
+    async with http.post(URL, json={"question": f"Question {i}?", "session_id": f"bench-{i}"}) as response:
+        body = await response.json()
+        return response.status == 200 and "answer" in body
+
+
+async def main(requests):
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=600)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(ask(http, i) for i in range(requests)), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+    ok = sum(result is True for result in results)
+    print(f"{ok}/{requests} requests succeeded in {elapsed:.2f}s ({ok / elapsed:.0f} requests/s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
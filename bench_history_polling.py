@@ -0,0 +1,42 @@
+# Microbenchmark: a client polling /history of app_multiuser.py, fetching everything each time vs.
+# sending the last ETag (304 Not Modified) or only asking for turns after its last cursor
+# Run: python bench_history_polling.py  (no Azure calls; histories go to a temporary directory)
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+POLLS = 2000
+ANSWER_CHARS = 2000
+
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://benchmark.openai.azure.com/")
+os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-05-01-preview")
+
+
+def bench(client, path, headers=None):
+    start = time.perf_counter()
+    for _ in range(POLLS):
+        response = client.get(path, headers=headers or {})
+    elapsed = (time.perf_counter() - start) / POLLS * 1e6
+    return f"{elapsed:8.1f} µs  {len(response.data):7} bytes  ({response.status_code})"
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="bench_history_polling_"))
+    import app_multiuser
+
+    store = app_multiuser.session_store
+    for turn in range(app_multiuser.MAX_HISTORY_LENGTH):
+        store.append_turn("poll", {"question": f"Question {turn}", "answer": "x" * ANSWER_CHARS,
+                                   "timestamp": f"2025-01-01 00:00:{turn:02}"}, app_multiuser.MAX_HISTORY_LENGTH)
+    client = app_multiuser.app.test_client()
+    first = client.get("/history?session_id=poll")
+    etag, after = first.headers["ETag"], first.get_json()["after_cursor"]
+
+    print(f"{app_multiuser.HISTORY_STORAGE_MODE} storage, {app_multiuser.MAX_HISTORY_LENGTH} turns of {ANSWER_CHARS} characters")
+    print(f"full history:       {bench(client, '/history?session_id=poll')}")
+    print(f"If-None-Match:      {bench(client, '/history?session_id=poll', {'If-None-Match': etag})}")
+    print(f"after last cursor:  {bench(client, f'/history?session_id=poll&after={quote(after)}')}")
@@ -0,0 +1,98 @@
+# Load test: /history latency while many clients log in at once, with password hashing on the
+# request threads (PASSWORD_HASH_WORKERS=0) vs. in the worker pool
+# Run: python bench_login_storm.py  (serves chatbot_api.py on a local port; no Azure calls are made)
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+PORT = 3099
+LOGIN_THREADS = 16
+STORM_SECONDS = 5
+PROBE_INTERVAL = 0.02
+
+
+def post(path, body):
+    request = urllib.request.Request(f"http://localhost:{PORT}{path}", data=body.encode(),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def probe_history(stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        with urllib.request.urlopen(f"http://localhost:{PORT}/history?session_id=probe") as response:
+            response.read()
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(PROBE_INTERVAL)
+
+
+def storm(stop, statuses):
+    while not stop.is_set():
+        statuses.append(post("/login", '{"username": "storm", "password": "storm-password"}'))
+
+
+def measure(login_threads):
+    stop = threading.Event()
+    latencies, statuses = [], []
+    threads = [threading.Thread(target=probe_history, args=(stop, latencies))]
+    threads += [threading.Thread(target=storm, args=(stop, statuses)) for _ in range(login_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(STORM_SECONDS)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    logins = statuses.count(200) / STORM_SECONDS
+    return f"/history p50 {statistics.median(latencies):6.1f} ms  p99 {p99:7.1f} ms  {logins:5.1f} logins/s"
+
+
+def serve():
+    # Runs in a child process, from a scratch directory so the real users and histories are untouched
+    os.environ.setdefault("AZURE_OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://benchmark.openai.azure.com/")
+    os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-05-01-preview")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="bench_login_storm_"))
+    from werkzeug.serving import make_server
+
+    import chatbot_api
+    make_server("localhost", PORT, chatbot_api.app, threaded=True).serve_forever()
+
+
+def run(label, workers):
+    env = dict(os.environ, PASSWORD_HASH_WORKERS=str(workers))
+    server = subprocess.Popen([sys.executable, __file__, "serve"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(300):
+            try:
+                urllib.request.urlopen(f"http://localhost:{PORT}/history")
+                break
+            except OSError:
+                time.sleep(0.1)
+        post("/register", '{"username": "storm", "password": "storm-password"}')
+        print(f"{label:<22} idle:  {measure(0)}")
+        print(f"{label:<22} storm: {measure(LOGIN_THREADS)}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["serve"]:
+        serve()
+    else:
+        run("request threads", 0)
+        run(f"worker pool ({os.getenv('PASSWORD_HASH_WORKERS', '2')})", int(os.getenv("PASSWORD_HASH_WORKERS", "2")))
@@ -0,0 +1,38 @@
+# Microbenchmark: building the prompt template + chain per request vs. reusing them from the registry
+# Run: python bench_prompt_registry.py  (no Azure calls are made, the LLM is never invoked)
+import os
+import time
+
+# prompt_engineering builds an AzureChatOpenAI client at import time; placeholders are enough for that
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://benchmark.openai.azure.com/")
+os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-05-01-preview")
+
+from prompt_engineering import FEW_SHOT_EXAMPLES, PERSONAS, create_prompt_template, llm
+from prompt_registry import PromptRegistry
+
+REQUESTS = 20000
+
+
+def bench(label, get_chain):
+    combinations = [(persona, question_type) for persona in PERSONAS
+                    for question_type in [None] + list(FEW_SHOT_EXAMPLES)]
+    start = time.perf_counter()
+    for i in range(REQUESTS):
+        get_chain(*combinations[i % len(combinations)])
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / REQUESTS * 1e6:8.1f} µs/request")
+    return elapsed
+
+
+def build_per_request(persona, question_type):
+    prompt_template = create_prompt_template(persona, question_type)
+    return prompt_template, prompt_template | llm
+
+
+if __name__ == "__main__":
+    registry = PromptRegistry(create_prompt_template, llm, PERSONAS)
+    registry.warm([None] + list(FEW_SHOT_EXAMPLES))
+    before = bench("build per request", build_per_request)
+    after = bench("prompt registry", registry.get)
+    print(f"Speedup: {before / after:.0f}x ({registry.stats()['builds']} templates built once)")
@@ -0,0 +1,64 @@
+# Benchmark: chained `any(p in question ...)` scans vs. the single-pass QuestionClassifier
+# Run: python bench_question_classifier.py
+import random
+import string
+import time
+
+from question_classifier import QuestionClassifier
+
+# Same patterns as prompt_engineering.py
+QUESTION_PATTERNS = {
+    "factual": ["what is", "who is", "when did", "where is", "how many"],
+    "opinion": ["what do you think", "opinion", "best", "worst", "should i"],
+    "instruction": ["how do i", "how to", "steps", "guide", "instructions"]
+}
+
+QUESTIONS = 50000
+
+
+def classify_with_any(question, patterns):
+    question = question.lower()
+    for category, keywords in patterns.items():
+        if any(q in question for q in keywords):
+            return category
+    return None
+
+
+def make_corpus(size, rng):
+    openers = ["What is", "Who is", "How do I", "What do you think about", "Which is the best",
+               "Can you explain", "Tell me about", "Why does", "Give me steps for", "Is it true that"]
+    topics = ["quantum computing", "the French revolution", "sourdough bread", "Python generators",
+              "public speaking", "black holes", "index funds", "the offside rule", "jazz chords", "compost"]
+    return [f"{rng.choice(openers)} {rng.choice(topics)}{rng.choice(['?', '', ' please?'])}" for _ in range(size)]
+
+
+def grow_patterns(patterns, extra, rng):
+    """The same categories with `extra` made-up patterns added to each, to see how both approaches scale."""
+    grown = {}
+    for category, keywords in patterns.items():
+        made_up = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 12))) for _ in range(extra)]
+        grown[category] = keywords + made_up
+    return grown
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<24} {elapsed / QUESTIONS * 1e6:6.2f} µs/question")
+    return result
+
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    corpus = make_corpus(QUESTIONS, rng)
+    unique = list(dict.fromkeys(corpus))
+    print(f"{QUESTIONS} questions ({len(unique)} distinct)")
+    for extra in (0, 100, 1000):
+        patterns = grow_patterns(QUESTION_PATTERNS, extra, rng) if extra else QUESTION_PATTERNS
+        classifier = QuestionClassifier(patterns)
+        print(f"{sum(len(keywords) for keywords in patterns.values())} patterns:")
+        expected = timed("any() per category", lambda: [classify_with_any(q, patterns) for q in corpus])
+        single = timed("classify()", lambda: [classifier.classify(q) for q in corpus])
+        batch = timed("classify_many()", lambda: classifier.classify_many(corpus))
+        assert single == expected and batch == expected
@@ -0,0 +1,83 @@
+# Benchmark: SemanticCache lookups in one namespace of near-identical FAQ-style questions
+# Run: python bench_semantic_cache.py [entries] [lookups]
+import random
+import sys
+import time
+
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+ENTRIES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+LOOKUPS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+TEMPLATES = [
+    "How do I {action} my {thing} on the {plan} plan?",
+    "Can I {action} the {thing} for order {number}?",
+    "What happens if I {action} my {thing} in {place}?",
+    "Why can't I {action} my {thing} after {number} days?",
+    "Is it possible to {action} a {thing} from {place}?",
+]
+REWORDINGS = [
+    ("How do I", "How can I"), ("Can I", "Could I"), ("What happens if", "What happens when"),
+    ("Why can't I", "Why is it that I can't"), ("Is it possible to", "Is it possible for me to"),
+]
+ACTIONS = ["reset", "cancel", "change", "update", "renew", "transfer", "refund", "upgrade", "pause", "delete"]
+THINGS = ["password", "subscription", "billing address", "payment card", "username", "email address",
+          "delivery date", "shipping method", "account", "phone number", "gift card", "invoice"]
+PLANS = ["basic", "premium", "family", "student", "business", "enterprise"]
+PLACES = ["Austria", "Australia", "Canada", "Germany", "Japan", "Brazil", "India", "France", "Spain", "Mexico"]
+
+
+def make_question(rng):
+    return rng.choice(TEMPLATES).format(
+        action=rng.choice(ACTIONS), thing=rng.choice(THINGS), plan=rng.choice(PLANS),
+        place=rng.choice(PLACES), number=rng.randint(1, 999999)
+    )
+
+
+def reword(question):
+    for old, new in REWORDINGS:
+        if question.startswith(old):
+            return question.replace(old, new, 1)
+    return question
+
+
+def timed(cache, questions):
+    times = []
+    hits = 0
+    for question in questions:
+        start = time.perf_counter()
+        answer, _ = cache.get(question)
+        times.append(time.perf_counter() - start)
+        hits += answer is not None
+    times = np.array(times) * 1000
+    return hits, float(np.mean(times)), float(np.percentile(times, 50)), float(np.percentile(times, 99))
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    cache = SemanticCache(default_threshold=0.85, max_entries=ENTRIES)
+    questions = {}
+    while len(questions) < ENTRIES:
+        questions[make_question(rng)] = None
+    questions = list(questions)
+    start = time.perf_counter()
+    for i, question in enumerate(questions):
+        cache.put(question, f"answer {i}")
+    print(f"Inserted {len(questions)} questions in {time.perf_counter() - start:.1f}s")
+
+    cached = rng.sample(questions, LOOKUPS)
+    sets = {
+        "reworded cached questions": [reword(question) for question in cached],
+        "new questions": [make_question(rng) for _ in range(LOOKUPS)],
+    }
+    for name, lookups in sets.items():
+        hits, mean, p50, p99 = timed(cache, lookups)
+        print(f"{name:28} {hits / len(lookups):6.1%} hits   mean {mean:.3f} ms   p50 {p50:.3f} ms   p99 {p99:.3f} ms")
+
+    # A hit must be for the same question: any other question's answer is a wrong answer served
+    index = {question: i for i, question in enumerate(questions)}
+    answers = [cache.get(question)[0] for question in sets["reworded cached questions"]]
+    wrong = sum(answer not in (None, f"answer {index[original]}") for answer, original in zip(answers, cached))
+    print(f"Reworded lookups answered with another question's answer: {wrong}/{LOOKUPS}")
@@ -0,0 +1,48 @@
+# Microbenchmark: finding which user owns a session by scanning every user vs. the session index
+# Run: python bench_user_sessions.py  (in-memory only, no files are written)
+import random
+import time
+
+from user_sessions import UserSessionIndex
+
+SESSIONS_PER_USER = 3
+LOOKUPS = 200
+
+
+def make_users(count):
+    return {f"user{i}": {'password_hash': "x", 'sessions': [f"user{i}-session{j}" for j in range(SESSIONS_PER_USER)]}
+            for i in range(count)}
+
+
+def scan_owner(users, session_id):
+    # What /ask used to do for a session_id without a matching login cookie
+    for username, user_data in users.items():
+        if session_id in user_data['sessions']:
+            return username
+    return None
+
+
+def bench(lookup, session_ids):
+    start = time.perf_counter()
+    for session_id in session_ids:
+        lookup(session_id)
+    return (time.perf_counter() - start) / len(session_ids) * 1e6
+
+
+if __name__ == "__main__":
+    print(f"{'users':>8} {'scan':>14} {'index':>12} {'logout (index)':>16}")
+    for count in (1000, 10000, 100000):
+        users = make_users(count)
+        # Half known sessions, half unknown (anonymous) ones, which make the scan check every user
+        session_ids = [f"user{random.randrange(count)}-session{random.randrange(SESSIONS_PER_USER)}"
+                       for _ in range(LOOKUPS // 2)] + [f"anonymous-{i}" for i in range(LOOKUPS // 2)]
+        scan = bench(lambda session_id: scan_owner(users, session_id), session_ids)
+
+        index = UserSessionIndex(users)
+        indexed = bench(index.owner, session_ids * 100)
+        logouts = list(users)[:LOOKUPS]
+        start = time.perf_counter()
+        for username in logouts:
+            index.remove(username, f"{username}-session0")
+        logout = (time.perf_counter() - start) / LOOKUPS * 1e6
+        print(f"{count:>8} {scan:>11.1f} µs {indexed:>9.2f} µs {logout:>13.2f} µs")
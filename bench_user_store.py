@@ -0,0 +1,37 @@
+# Microbenchmark: what /login and /logout cost in the user store as the number of users grows
+# Run: python bench_user_store.py  (password hashing is left out; files go to a temporary directory)
+import os
+import tempfile
+import time
+
+from user_store import JsonUserStore, SqliteUserStore
+
+LOGINS = 20
+
+
+def make_users(count):
+    return {f"user{i}": {'password_hash': "x", 'sessions': [f"user{i}-session0"]} for i in range(count)}
+
+
+def bench(store):
+    start = time.perf_counter()
+    for i in range(LOGINS):
+        username = f"user{i}"
+        store.get(username)
+        store.add_session(username, f"{username}-login")
+        store.flush()
+        store.remove_session(username, f"{username}-login")
+        store.flush()
+    return (time.perf_counter() - start) / LOGINS * 1000
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp(prefix="bench_user_store_")
+    print(f"{'users':>8} {'json':>12} {'sqlite':>12}   (login + logout)")
+    for count in (1000, 10000, 100000):
+        users = make_users(count)
+        json_store = JsonUserStore(os.path.join(directory, f"users-{count}.json"))
+        json_store.index.load(users)
+        sqlite_store = SqliteUserStore(os.path.join(directory, f"users-{count}.db"))
+        sqlite_store.import_users(users)
+        print(f"{count:>8} {bench(json_store):>9.2f} ms {bench(sqlite_store):>9.2f} ms")
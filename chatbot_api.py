@@ -1,13 +1,21 @@
 # Required imports
 import json
 import os
+import threading
 import uuid
 from datetime import datetime
 from functools import wraps
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify, session
-from werkzeug.security import generate_password_hash, check_password_hash
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import AzureChatOpenAI
+from context_builder import TranscriptCache, context_token_budget
+from history_pages import ask_history, ask_history_mode, etag_matches, history_etag, history_page, page_args
+from history_store import HistoryLog, SessionVersions, ShardedHistoryStore, SqliteHistoryStore, write_json_atomic
+from session_locks import SessionLocks
+from auth_tokens import TokenAuth, secret_keys_from_env, use_secret_keys
+from password_hashing import PasswordHasher, PasswordHasherBusy
+from user_store import JsonUserStore, SessionReaper, open_user_store
 
 # Load environment variables
 load_dotenv()
@@ -15,17 +23,57 @@ load_dotenv()
 # Constants
 HISTORY_DIR = "chat_histories"
 HISTORY_FILE = os.path.join(HISTORY_DIR, "chat_histories.json")
+HISTORY_LOG_FILE = os.path.join(HISTORY_DIR, "chat_histories.log.jsonl")
+HISTORY_DB_FILE = os.path.join(HISTORY_DIR, "chat_histories.db")
+HISTORY_SHARD_DIR = os.path.join(HISTORY_DIR, "sessions")
+HISTORY_STORAGE_MODE = os.getenv("HISTORY_STORAGE_MODE", "json")
+HISTORY_COMPACT_EVERY = int(os.getenv("HISTORY_COMPACT_EVERY", "500"))
+HISTORY_CACHE_MAX_SESSIONS = int(os.getenv("HISTORY_CACHE_MAX_SESSIONS", "10000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", "0"))
 USERS_FILE = os.path.join(HISTORY_DIR, "users.json")
-SECRET_KEY = os.urandom(24)
-MAX_HISTORY_LENGTH = 10
+USERS_DB_FILE = os.path.join(HISTORY_DIR, "users.db")
+USER_STORAGE_MODE = os.getenv("USER_STORAGE_MODE", "json")
+# Login sessions expire SESSION_IDLE_TTL_SECONDS after their last use or SESSION_MAX_AGE_SECONDS after
+# login (0 means never); a background thread removes expired ones in batches
+SESSION_IDLE_TTL_SECONDS = int(os.getenv("SESSION_IDLE_TTL_SECONDS", "86400"))
+SESSION_MAX_AGE_SECONDS = int(os.getenv("SESSION_MAX_AGE_SECONDS", "604800"))
+SESSION_REAP_INTERVAL_SECONDS = float(os.getenv("SESSION_REAP_INTERVAL_SECONDS", "60"))
+SESSION_REAP_BATCH_SIZE = int(os.getenv("SESSION_REAP_BATCH_SIZE", "1000"))
+# Set SECRET_KEY to the same value on every worker so all of them accept the same cookies and tokens
+SECRET_KEYS = secret_keys_from_env()
+# Turns stored per session; the context sent to the model is cut by CONTEXT_TOKEN_BUDGET, so this
+# is kept high enough that the budget, not the stored-turn cap, decides what is sent
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "50"))
+# Only the most recent turns that fit in this many tokens are sent as context
+CONTEXT_TOKEN_BUDGET = context_token_budget(os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"))
+# /ask responses carry the session's whole history ("full") or just the new turn ("delta");
+# a request can pick its own with "history_mode"
+ASK_HISTORY_MODE = ask_history_mode(os.getenv("ASK_HISTORY_MODE"))
 
 # Initialize Flask app
 app = Flask(__name__)
-app.config['SECRET_KEY'] = SECRET_KEY
+use_secret_keys(app, SECRET_KEYS)
+# /login also returns a bearer token, checked with one HMAC on any worker without reading the user store
+token_auth = TokenAuth(SECRET_KEYS, int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "86400")))
 
 # Create directories if they don't exist
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
+# Password hashing runs in worker processes so a burst of logins doesn't stall other requests.
+# Built before anything below starts a thread (the session reaper), as it forks its workers.
+# PASSWORD_HASH_METHOD is a werkzeug method string, e.g. "scrypt" or "pbkdf2:sha256:600000".
+password_hasher = PasswordHasher(os.getenv("PASSWORD_HASH_METHOD", "scrypt"),
+                                 int(os.getenv("PASSWORD_HASH_WORKERS", "2")),
+                                 int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64")))
+
+history_log = HistoryLog(HISTORY_FILE, HISTORY_LOG_FILE, HISTORY_COMPACT_EVERY) if HISTORY_STORAGE_MODE == "log" else None
+session_store = None
+if HISTORY_STORAGE_MODE == "sqlite":
+    session_store = SqliteHistoryStore(HISTORY_DB_FILE)
+elif HISTORY_STORAGE_MODE == "sharded":
+    session_store = ShardedHistoryStore(HISTORY_SHARD_DIR, max_sessions=HISTORY_CACHE_MAX_SESSIONS,
+                                        max_bytes=HISTORY_CACHE_MAX_BYTES)
+
 # Initialize Azure OpenAI client
 llm = AzureChatOpenAI(
     openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
@@ -34,23 +82,36 @@ llm = AzureChatOpenAI(
     max_tokens=500
 )
 
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-
-# Initialize the chain
-chain = ConversationChain(
-    llm=llm,
-    memory=ConversationBufferMemory()
-)
+# Stateless chain: each session's context comes from its own stored history,
+# trimmed to CONTEXT_TOKEN_BUDGET, rather than from one memory shared by every session
+prompt_template = ChatPromptTemplate.from_messages([
+    ("system", "You are a helpful assistant providing concise and accurate answers. Maintain context from the conversation history."),
+    ("human", "{question}")
+])
+chain = prompt_template | llm
 
 # Load and save chat histories
 def save_chat_histories():
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(chat_histories, f, indent=2)
+    if session_store:
+        session_store.flush()
+        return
+    if history_log:
+        history_log.compact(chat_histories)
+        return
+    # Histories are replaced rather than mutated, so a shallow copy is a consistent snapshot
+    with save_lock:
+        write_json_atomic(HISTORY_FILE, dict(chat_histories))
 
 def load_chat_histories():
     global chat_histories
-    if os.path.exists(HISTORY_FILE):
+    if session_store:
+        # Sessions are read from the database on demand; import a legacy JSON file once
+        if session_store.is_empty() and os.path.exists(HISTORY_FILE):
+            with open(HISTORY_FILE, 'r') as f:
+                session_store.import_histories(json.load(f))
+    elif history_log:
+        chat_histories = history_log.load(MAX_HISTORY_LENGTH)
+    elif os.path.exists(HISTORY_FILE):
         with open(HISTORY_FILE, 'r') as f:
             chat_histories = json.load(f)
     else:
@@ -58,42 +119,121 @@ def load_chat_histories():
 
 chat_histories = {}
 load_chat_histories()
+# Version numbers of the sessions in chat_histories, for the /history ETag
+history_versions = SessionVersions()
+transcripts = TranscriptCache(HISTORY_CACHE_MAX_SESSIONS)
+# One lock per session serializes its updates; full saves run one at a time
+session_locks = SessionLocks()
+save_lock = threading.Lock()
+
+# Per-session history helpers
+def get_session_history(session_id):
+    if session_store:
+        return session_store.get_session(session_id)
+    return chat_histories.get(session_id)
+
+def get_session_version(session_id):
+    """(tag, version) identifying the current state of a session's history, for its ETag."""
+    if session_store:
+        return session_store.version_tag, session_store.session_version(session_id)
+    return history_versions.tag, history_versions.get(session_id)
+
+def append_session_turn(session_id, entry):
+    """Store a new turn. Returns the session history and its version right after this turn."""
+    with session_locks.hold(session_id):
+        # `entry` is timestamped under the lock so turns are stored in timestamp order
+        entry["timestamp"] = str(datetime.now())
+        if session_store:
+            history, version = session_store.append_turn(session_id, entry, MAX_HISTORY_LENGTH)
+        elif history_log:
+            # The log updates chat_histories itself, in step with the record it writes
+            history = history_log.append_turn(session_id, entry, chat_histories, MAX_HISTORY_LENGTH)
+            version = history_versions.bump(session_id)
+        else:
+            history = (chat_histories.get(session_id) or []) + [entry]
+            history = chat_histories[session_id] = history[-MAX_HISTORY_LENGTH:]
+            version = history_versions.bump(session_id)
+            save_chat_histories()
+        transcripts.update(session_id, history)
+    return history, version
+
+def create_session_history(session_id):
+    if session_store:
+        session_store.create_session(session_id)
+        return
+    with session_locks.hold(session_id):
+        chat_histories[session_id] = []
+        history_versions.bump(session_id)
+        if history_log:
+            history_log.create_session(session_id, chat_histories)
+            return
+    save_chat_histories()
+
+def clear_session_history(session_id):
+    with session_locks.hold(session_id):
+        transcripts.discard(session_id)
+        if session_store:
+            session_store.clear_session(session_id)
+            return
+        chat_histories[session_id] = []
+        history_versions.bump(session_id)
+        if history_log:
+            history_log.clear_session(session_id, chat_histories)
+
+def clear_all_histories():
+    transcripts.clear()
+    if session_store:
+        return session_store.clear_all()
+    session_count = len(chat_histories)
+    # Cleared in place so requests that already looked up the dict don't write to a stale one
+    chat_histories.clear()
+    history_versions.clear()
+    if history_log:
+        history_log.clear_all(chat_histories)
+    return session_count
 
 # User management functions
-def save_users(users):
-    with open(USERS_FILE, 'w') as f:
-        json.dump(users, f, indent=2)
+def save_users():
+    users.flush()
 
 def load_users():
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r') as f:
-                data = json.load(f)
-                # Ensure we have a dictionary
-                if not isinstance(data, dict):
-                    print(f"Warning: users file content is not a dictionary. Resetting to empty dictionary.")
-                    data = {}
-                    # Save the corrected format
-                    with open(USERS_FILE, 'w') as fw:
-                        json.dump(data, fw, indent=2)
-                return data
-    except json.JSONDecodeError as e:
+        return open_user_store(USER_STORAGE_MODE, USERS_FILE, USERS_DB_FILE,
+                               SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
+    except ValueError as e:
         print(f"Error loading users file: {e}. Resetting to empty dictionary.")
-        # If JSON is invalid, reset the file with an empty dictionary
-        with open(USERS_FILE, 'w') as f:
-            json.dump({}, f, indent=2)
+        # If the file is invalid (bad JSON or not a dictionary), reset it to an empty dictionary
+        write_json_atomic(USERS_FILE, {})
+        return JsonUserStore(USERS_FILE, SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
     except Exception as e:
         print(f"Unexpected error loading users file: {e}. Using empty dictionary.")
-    
-    return {}
+    return JsonUserStore(None, SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
 
+# Users, plus which user owns each login session without scanning every user
 users = load_users()
+session_reaper = SessionReaper(users, SESSION_REAP_INTERVAL_SECONDS, SESSION_REAP_BATCH_SIZE, on_reaped=save_users)
 
 # Authentication decorator
+def current_login():
+    """The {"username", "session_id"} of a valid bearer token, else of the session cookie; {} if neither."""
+    login_state = token_auth.verify_header(request.headers.get('Authorization'))
+    if login_state:
+        # Like the cookie, the token is only good while its login session hasn't expired or been logged out
+        if users.touch(login_state.get('session_id')) == login_state.get('username'):
+            return login_state
+        return {}
+    if 'username' in session:
+        # The cookie is only good while its login session hasn't expired or been logged out
+        if users.touch(session.get('session_id')) == session['username']:
+            return {"username": session['username'], "session_id": session.get('session_id')}
+        session.pop('username', None)
+        session.pop('session_id', None)
+    return {}
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'username' not in session:
+        if not current_login():
             return jsonify({"error": "Authentication required"}), 401
         return f(*args, **kwargs)
     return decorated_function
@@ -107,9 +247,13 @@ def register():
 
     if username in users:
         return jsonify({"error": "Username already exists"}), 400
-
-    users[username] = {'password_hash': generate_password_hash(password), 'sessions': []}
-    save_users(users)
+    try:
+        password_hash = password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return jsonify({"error": "Too many logins in progress, try again shortly"}), 503
+    if not users.add_user(username, password_hash):
+        return jsonify({"error": "Username already exists"}), 400
+    save_users()
     return jsonify({"message": f"User {username} registered successfully", "status": "success"}), 201
 
 @app.route('/login', methods=['POST'])
@@ -118,102 +262,117 @@ def login():
     username = data['username']
     password = data['password']
 
-    if username not in users or not check_password_hash(users[username]['password_hash'], password):
+    user = users.get(username)
+    try:
+        valid = user is not None and password_hasher.verify(user['password_hash'], password)
+    except PasswordHasherBusy:
+        return jsonify({"error": "Too many logins in progress, try again shortly"}), 503
+    if not valid:
         return jsonify({"error": "Invalid username or password"}), 401
 
     session_id = str(uuid.uuid4())
-    users[username]['sessions'].append(session_id)
+    users.add_session(username, session_id)
     session['username'] = username
     session['session_id'] = session_id
-    save_users(users)
+    save_users()
 
-    return jsonify({"message": f"User {username} logged in successfully", "session_id": session_id}), 200
+    return jsonify({"message": f"User {username} logged in successfully", "session_id": session_id,
+                    "token": token_auth.issue(username, session_id), "expires_in": token_auth.ttl_seconds}), 200
 
 @app.route('/logout', methods=['POST'])
 @login_required
 def logout():
-    username = session.get('username')
-    session_id = session.get('session_id')
+    login_state = current_login()
+    username = login_state.get('username')
+    session_id = login_state.get('session_id')
 
-    users[username]['sessions'].remove(session_id)
+    users.remove_session(username, session_id)
     session.pop('username', None)
     session.pop('session_id', None)
-    save_users(users)
+    save_users()
 
     return jsonify({"message": "Logged out successfully"}), 200
 
 @app.route('/ask', methods=['POST'])
 def ask_question():
-    global chat_histories
-
     data = request.get_json()
     if not data or 'question' not in data:
         return jsonify({"error": "Missing 'question' in request body"}), 400
 
     question = data['question']
     session_id = data.get('session_id', 'default_session')
+    try:
+        history_mode = ask_history_mode(data.get('history_mode'), ASK_HISTORY_MODE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    if session_id not in chat_histories:
-        chat_histories[session_id] = []
-
-    session_history = chat_histories[session_id]
-    context = ""
-    if session_history:
-        context = "Previous conversation:\n"
-        for entry in session_history:
-            context += f"Human: {entry['question']}\nAI: {entry['answer']}\n"
+    with session_locks.hold(session_id):
+        session_history = get_session_history(session_id) or []
+    context = transcripts.context(session_id, session_history, CONTEXT_TOKEN_BUDGET)
 
     contextualized_question = f"{context}\nHuman: {question}" if context else question
 
     # Get response from the chain
-    response = chain.invoke({"input": question})
-    ai_response = response["response"]
+    ai_response = chain.invoke({"question": contextualized_question}).content
 
-    chat_histories[session_id].append({
-        "question": question,
-        "answer": ai_response,
-        "timestamp": str(datetime.now())
-    })
-
-    if len(chat_histories[session_id]) > MAX_HISTORY_LENGTH:
-        chat_histories[session_id] = chat_histories[session_id][-MAX_HISTORY_LENGTH:]
+    turn = {"question": question, "answer": ai_response}
+    session_history, version = append_session_turn(session_id, turn)
 
     return jsonify({
         "answer": ai_response,
         "status": "success",
         "session_id": session_id,
-        "history": chat_histories[session_id]
+        **ask_history(history_mode, session_history, turn, version)
     }), 200
 
 @app.route('/history', methods=['GET'])
 def get_history():
     session_id = request.args.get('session_id', 'default_session')
-    return jsonify({
-        "history": chat_histories.get(session_id, []),
-        "count": len(chat_histories.get(session_id, [])),
+    try:
+        limit, before, after = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Version first, so a turn stored in between only makes the ETag too old, never too new
+    tag, version = get_session_version(session_id)
+    etag = history_etag(tag, version)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return "", 304, {"ETag": etag}
+    session_history = get_session_history(session_id) or []
+    response = jsonify({
+        **history_page(session_history, limit, before, after),
+        "version": version,
         "session_id": session_id
-    }), 200
+    })
+    response.headers["ETag"] = etag
+    return response, 200
 
 @app.route('/clear-history', methods=['POST'])
 def clear_history():
     data = request.get_json() or {}
     session_id = data.get('session_id', 'default_session')
-    chat_histories[session_id] = []
+    clear_session_history(session_id)
     return jsonify({"message": f"Chat history for session {session_id} cleared successfully", "status": "success"}), 200
 
 @app.route('/clear-all-history', methods=['POST'])
 def clear_all_history():
-    global chat_histories
-    session_count = len(chat_histories)
-    chat_histories = {}
+    session_count = clear_all_histories()
     return jsonify({"message": f"Chat history cleared for all {session_count} sessions", "status": "success"}), 200
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    if HISTORY_STORAGE_MODE != "sharded":
+        return jsonify({"message": f"No session cache in {HISTORY_STORAGE_MODE} mode", "status": "success"}), 200
+    return jsonify({"cache": session_store.sessions.stats(), "status": "success"}), 200
+
+@app.route('/session-stats', methods=['GET'])
+def session_stats():
+    return jsonify({"sessions": users.stats(), "password_hashing": password_hasher.stats(), "status": "success"}), 200
+
 @app.route('/generate-session', methods=['GET'])
 def generate_session():
     session_id = str(uuid.uuid4())
     # Initialize an empty history for the new session
-    chat_histories[session_id] = []
-    save_chat_histories()
+    create_session_history(session_id)
     return jsonify({"session_id": session_id}), 200
 
 
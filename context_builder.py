@@ -0,0 +1,195 @@
+# Builds the "Previous conversation:" context sent along with each question
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# tiktoken downloads an encoding the first time it is used. It looks in TIKTOKEN_CACHE_DIR
+# first, so point that at a directory next to the code: fill it once with
+# `python context_builder.py` and ship it, and token counts never depend on network access.
+TIKTOKEN_CACHE_DIR = os.environ.setdefault(
+    "TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache"))
+
+CONTEXT_HEADER = "Previous conversation:\n"
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+
+def make_token_counter(encoding_name=None):
+    """
+    Return a function that counts the tokens in a string without calling the API.
+    Uses tiktoken when it's installed and the encoding is cached in TIKTOKEN_CACHE_DIR
+    (or can be downloaded), otherwise estimates about 4 characters per token.
+    CONTEXT_TOKEN_ENCODING=estimate always estimates.
+    """
+    encoding_name = encoding_name or os.getenv("CONTEXT_TOKEN_ENCODING", "o200k_base")
+    if encoding_name == "estimate":
+        return estimate_tokens
+    if tiktoken is None:
+        print(f"WARNING: tiktoken is not installed; context budgets use estimated token counts "
+              f"(~4 characters per token) instead of {encoding_name}")
+        return estimate_tokens
+    try:
+        encoding = tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        print(f"WARNING: could not load tokenizer {encoding_name} ({type(e).__name__}); context budgets "
+              f"use estimated token counts (~4 characters per token). Run `python context_builder.py` "
+              f"with network access to cache it in {TIKTOKEN_CACHE_DIR}, or set CONTEXT_TOKEN_ENCODING=estimate.")
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text))
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+def context_token_budget(deployment=None):
+    """
+    Token budget for the conversation context of a deployment. CONTEXT_TOKEN_BUDGETS
+    may map deployment names to budgets (JSON); anything else gets CONTEXT_TOKEN_BUDGET.
+    """
+    budgets = json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS", "{}"))
+    if deployment in budgets:
+        return int(budgets[deployment])
+    return int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+
+
+def render_turn(entry):
+    return f"Human: {entry['question']}\nAI: {entry['answer']}\n"
+
+
+def turn_key(entry):
+    # Cheap identity check for "is this the turn the cached transcript ends with?"
+    return (entry.get('timestamp'), entry['question'])
+
+
+class Transcript:
+    """Rendered turns of one session with their token counts, plus the joined text once somebody asks for it."""
+
+    def __init__(self, history, count_tokens):
+        self.lines = deque()
+        self.tokens = deque()
+        self.total_tokens = 0
+        for entry in history:
+            self.push(render_turn(entry), count_tokens)
+        self.last_key = turn_key(history[-1]) if history else None
+        self.text = None
+
+    def push(self, line, count_tokens):
+        tokens = count_tokens(line)
+        self.lines.append(line)
+        self.tokens.append(tokens)
+        self.total_tokens += tokens
+
+    def drop_oldest(self):
+        self.lines.popleft()
+        self.total_tokens -= self.tokens.popleft()
+
+    def window(self, token_budget, max_turns=None):
+        """The newest turns (at most `max_turns`) that fit in `token_budget`, joined oldest first."""
+        if self.total_tokens <= token_budget and (max_turns is None or max_turns >= len(self.lines)):
+            if self.text is None:
+                self.text = "".join(self.lines)
+            return self.text
+        selected = []
+        used = 0
+        for line, tokens in zip(reversed(self.lines), reversed(self.tokens)):
+            if used + tokens > token_budget or len(selected) == max_turns:
+                break
+            selected.append(line)
+            used += tokens
+        return "".join(reversed(selected))
+
+    def matches(self, history):
+        if not history:
+            return not self.lines
+        return len(self.lines) == len(history) and self.last_key == turn_key(history[-1])
+
+
+class TranscriptCache:
+    """
+    Per-session rendered transcripts, kept in step with the stored history one
+    turn at a time instead of re-concatenating every turn on every request.
+    Each turn's token count is computed once, when the turn is rendered.
+    Holds at most `max_sessions` transcripts, least recently used first out.
+    """
+
+    def __init__(self, max_sessions=10000, count_tokens=None):
+        self.max_sessions = max_sessions
+        self.count_tokens = count_tokens or make_token_counter()
+        self.header_tokens = self.count_tokens(CONTEXT_HEADER)
+        self.hits = 0
+        self.rebuilds = 0
+        self._transcripts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _put(self, session_id, transcript):
+        self._transcripts[session_id] = transcript
+        self._transcripts.move_to_end(session_id)
+        while self.max_sessions and len(self._transcripts) > self.max_sessions:
+            self._transcripts.popitem(last=False)
+
+    def context(self, session_id, history, token_budget=None, summary=None, max_turns=None):
+        """
+        Return the context string for `history`, or "" when there is no history yet.
+        With a `token_budget`, only the most recent turns that fit in it are included.
+        A `summary` of older turns goes first, followed by at most `max_turns` turns.
+        """
+        prefix = f"{SUMMARY_HEADER}{summary}\n\n" if summary else ""
+        if not history:
+            return prefix
+        with self._lock:
+            transcript = self._transcripts.get(session_id)
+            if transcript is not None and transcript.matches(history):
+                self.hits += 1
+                self._transcripts.move_to_end(session_id)
+            else:
+                self.rebuilds += 1
+                transcript = Transcript(history, self.count_tokens)
+                self._put(session_id, transcript)
+            if token_budget is None:
+                text = transcript.window(transcript.total_tokens, max_turns)
+            else:
+                remaining = token_budget - self.header_tokens
+                if prefix:
+                    remaining -= self.count_tokens(prefix)
+                text = transcript.window(remaining, max_turns)
+            return prefix + CONTEXT_HEADER + text if text else prefix
+
+    def update(self, session_id, history):
+        """
+        Bring the transcript up to date with `history` right after a turn was appended
+        (and the oldest turns possibly trimmed). Falls back to a rebuild if the cached
+        transcript wasn't in step with the history before that turn.
+        """
+        with self._lock:
+            transcript = self._transcripts.get(session_id)
+            previous_key = turn_key(history[-2]) if len(history) > 1 else None
+            if transcript is None or transcript.last_key != previous_key:
+                self._put(session_id, Transcript(history, self.count_tokens))
+                return
+            transcript.push(render_turn(history[-1]), self.count_tokens)
+            while len(transcript.lines) > len(history):
+                transcript.drop_oldest()
+            transcript.last_key = turn_key(history[-1])
+            transcript.text = None
+            self._transcripts.move_to_end(session_id)
+
+    def discard(self, session_id):
+        with self._lock:
+            self._transcripts.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._transcripts.clear()
+
+
+if __name__ == "__main__":
+    # Download the encoding into TIKTOKEN_CACHE_DIR so later starts work offline
+    encoding_name = os.getenv("CONTEXT_TOKEN_ENCODING", "o200k_base")
+    tiktoken.get_encoding(encoding_name)
+    print(f"Cached tokenizer {encoding_name} in {TIKTOKEN_CACHE_DIR}")
@@ -3,10 +3,19 @@ from flask import Flask, jsonify, request
 import json
 import os
 import datetime
+import threading
 from dotenv import load_dotenv
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 import uuid
+from context_builder import TranscriptCache, context_token_budget
+from summarizer import RollingSummarizer, make_llm_summarizer
+from response_cache import ResponseCache, prompt_cache_key
+from session_locks import SessionLocks
+from single_flight import SingleFlight
+from streaming import sse_response, stream_answer
+from history_pages import ask_history, ask_history_mode, etag_matches, history_etag, history_page, page_args
+from history_store import HistoryLog, SessionVersions, ShardedHistoryStore, SqliteHistoryStore, WriteBehindFlusher, write_json_atomic
 
 app = Flask(__name__)
 
@@ -43,19 +52,86 @@ prompt_template = ChatPromptTemplate.from_messages([
 
 chain = prompt_template | llm
 
+# Answers to identical prompts (same question with the same conversation context) are reused
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(10 * 1024 * 1024))),
+    ttl_seconds=int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+)
+# ...and identical prompts still being answered share the one LLM call in flight
+single_flight = SingleFlight()
+
 # Constants for persistence
 HISTORY_DIR = "chat_histories"
 HISTORY_FILE = os.path.join(HISTORY_DIR, "chat_histories.json")
+HISTORY_LOG_FILE = os.path.join(HISTORY_DIR, "chat_histories.log.jsonl")
+HISTORY_DB_FILE = os.path.join(HISTORY_DIR, "chat_histories.db")
+HISTORY_SHARD_DIR = os.path.join(HISTORY_DIR, "sessions")
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
-# Initialize chat histories
+# "json" rewrites HISTORY_FILE on every change, "log" appends each change to HISTORY_LOG_FILE,
+# "sqlite" keeps one row per turn in HISTORY_DB_FILE and "sharded" keeps one file per session
+# under HISTORY_SHARD_DIR; the last two never load every session into memory
+HISTORY_STORAGE_MODE = os.getenv("HISTORY_STORAGE_MODE", "json")
+HISTORY_COMPACT_EVERY = int(os.getenv("HISTORY_COMPACT_EVERY", "500"))
+
+# Write-behind for "json" and "sharded" modes: /ask only marks the session dirty and a background
+# thread writes it out once per HISTORY_FLUSH_INTERVAL_MS or HISTORY_FLUSH_MAX_PENDING changes
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "false").lower() == "true"
+HISTORY_FLUSH_INTERVAL_MS = int(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "500"))
+HISTORY_FLUSH_MAX_PENDING = int(os.getenv("HISTORY_FLUSH_MAX_PENDING", "100"))
+
+# "sharded" mode keeps at most this many sessions (0 = unlimited) or bytes of turns in memory
+HISTORY_CACHE_MAX_SESSIONS = int(os.getenv("HISTORY_CACHE_MAX_SESSIONS", "10000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", "0"))
+
+history_log = HistoryLog(HISTORY_FILE, HISTORY_LOG_FILE, HISTORY_COMPACT_EVERY) if HISTORY_STORAGE_MODE == "log" else None
+session_store = None
+if HISTORY_STORAGE_MODE == "sqlite":
+    session_store = SqliteHistoryStore(HISTORY_DB_FILE)
+elif HISTORY_STORAGE_MODE == "sharded":
+    session_store = ShardedHistoryStore(HISTORY_SHARD_DIR, HISTORY_WRITE_BEHIND, HISTORY_FLUSH_INTERVAL_MS, HISTORY_FLUSH_MAX_PENDING,
+                                        HISTORY_CACHE_MAX_SESSIONS, HISTORY_CACHE_MAX_BYTES)
+
+# Initialize chat histories and their version numbers (unused when a session_store is configured)
 chat_histories = {}
-MAX_HISTORY_LENGTH = 10
+history_versions = SessionVersions()
+# Turns stored per session; the context sent to the model is cut by CONTEXT_TOKEN_BUDGET, so this
+# is kept high enough that the budget, not the stored-turn cap, decides what is sent
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "50"))
+# Only the most recent turns that fit in this many tokens are sent as context
+CONTEXT_TOKEN_BUDGET = context_token_budget(os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"))
+# /ask responses carry the session's whole history ("full") or just the new turn ("delta");
+# a request can pick its own with "history_mode"
+ASK_HISTORY_MODE = ask_history_mode(os.getenv("ASK_HISTORY_MODE"))
+
+# Rendered "Previous conversation:" transcripts, kept in step with the histories above
+transcripts = TranscriptCache(HISTORY_CACHE_MAX_SESSIONS)
+
+# Serializes updates to one session's history; requests for other sessions don't wait
+session_locks = SessionLocks()
+
+# Optional rolling summary of everything but the last SUMMARY_KEEP_TURNS turns, built in the background
+HISTORY_SUMMARIZE = os.getenv("HISTORY_SUMMARIZE", "false").lower() == "true"
+SUMMARY_KEEP_TURNS = int(os.getenv("SUMMARY_KEEP_TURNS", "4"))
+SUMMARIES_FILE = os.path.join(HISTORY_DIR, "summaries.json")
+summarizer = RollingSummarizer(make_llm_summarizer(llm), SUMMARY_KEEP_TURNS, SUMMARIES_FILE) if HISTORY_SUMMARIZE else None
 
 
 def load_chat_histories():
     global chat_histories
     try:
+        if session_store:
+            # One-time import of an existing JSON history file into an empty store
+            if session_store.is_empty() and os.path.exists(HISTORY_FILE):
+                with open(HISTORY_FILE, 'r') as f:
+                    session_store.import_histories(json.load(f))
+                print(f"Chat histories imported from {HISTORY_FILE} into {HISTORY_STORAGE_MODE} storage")
+            return True
+        if history_log:
+            chat_histories = history_log.load(MAX_HISTORY_LENGTH)
+            print(f"Chat histories replayed from {HISTORY_FILE} and {HISTORY_LOG_FILE}")
+            return True
         if os.path.exists(HISTORY_FILE):
             with open(HISTORY_FILE, 'r') as f:
                 chat_histories = json.load(f)
@@ -72,13 +148,34 @@ def load_chat_histories():
 load_chat_histories()
 
 
+# Full saves take their snapshot and replace the file one at a time, so an older
+# snapshot can never overwrite a newer one
+save_lock = threading.Lock()
+
+
+def flush_chat_histories(dirty_sessions):
+    # Copy the top-level dict so request threads can keep adding sessions while we serialize
+    with save_lock:
+        write_json_atomic(HISTORY_FILE, dict(chat_histories))
+    print(f"Chat histories flushed to {HISTORY_FILE} ({len(dirty_sessions)} sessions changed)")
+
+
+history_flusher = None
+if HISTORY_WRITE_BEHIND and HISTORY_STORAGE_MODE == "json":
+    history_flusher = WriteBehindFlusher(flush_chat_histories, HISTORY_FLUSH_INTERVAL_MS, HISTORY_FLUSH_MAX_PENDING)
+
+
 def save_chat_histories():
     try:
-        serializable_histories = {}
-        for session_id, history in chat_histories.items():
-            serializable_histories[session_id] = history
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(serializable_histories, f, indent=2)
+        if session_store:
+            session_store.flush()
+            return True
+        if history_log:
+            history_log.compact(chat_histories)
+            return True
+        # Histories are replaced rather than mutated, so a shallow copy is a consistent snapshot
+        with save_lock:
+            write_json_atomic(HISTORY_FILE, dict(chat_histories))
         print(f"Chat histories saved to {HISTORY_FILE}")
         return True
     except Exception as e:
@@ -86,6 +183,107 @@ def save_chat_histories():
         return False
 
 
+# Per-session history helpers, so the routes don't care which storage mode is active
+def get_session_history(session_id):
+    """Return the stored turns for a session, or None if the session doesn't exist."""
+    if session_store:
+        return session_store.get_session(session_id)
+    return chat_histories.get(session_id)
+
+
+def get_session_version(session_id):
+    """(tag, version) identifying the current state of a session's history, for its ETag."""
+    if session_store:
+        return session_store.version_tag, session_store.session_version(session_id)
+    return history_versions.tag, history_versions.get(session_id)
+
+
+def build_context(session_id, session_history):
+    """Context for the next question: the session summary (if any) plus the turns it doesn't cover yet."""
+    if not summarizer:
+        return transcripts.context(session_id, session_history, CONTEXT_TOKEN_BUDGET)
+    summary, _ = summarizer.get(session_id)
+    return transcripts.context(session_id, session_history, CONTEXT_TOKEN_BUDGET, summary,
+                               summarizer.unfolded_turns(session_id, session_history))
+
+
+def append_session_turn(session_id, entry):
+    """
+    Store a new turn, keeping the last MAX_HISTORY_LENGTH entries. Returns the session history
+    and its version right after this turn.
+    `entry` is timestamped once the session's lock is held, so turns are stored in timestamp order.
+    """
+    with session_locks.hold(session_id):
+        entry["timestamp"] = str(datetime.datetime.now())
+        history, version = _store_session_turn(session_id, entry)
+        transcripts.update(session_id, history)
+        if summarizer:
+            summarizer.schedule(session_id, history)
+    return history, version
+
+
+def _store_session_turn(session_id, entry):
+    if session_store:
+        return session_store.append_turn(session_id, entry, MAX_HISTORY_LENGTH)
+
+    # In log mode only the new turn is written, and the log updates chat_histories
+    # itself so a compaction can't snapshot the turn and then see it logged again
+    if history_log:
+        history = history_log.append_turn(session_id, entry, chat_histories, MAX_HISTORY_LENGTH)
+        return history, history_versions.bump(session_id)
+
+    # Build a new list, limited to MAX_HISTORY_LENGTH entries, so a save in progress
+    # or a response still serializing the old one never sees it half-updated
+    history = (chat_histories.get(session_id) or []) + [entry]
+    history = chat_histories[session_id] = history[-MAX_HISTORY_LENGTH:]
+    version = history_versions.bump(session_id)
+    if history_flusher:
+        history_flusher.mark_dirty(session_id)
+    else:
+        save_chat_histories()
+    return history, version
+
+
+def clear_session_history(session_id):
+    """Empty a session's history. Returns False if the session doesn't exist."""
+    with session_locks.hold(session_id):
+        transcripts.discard(session_id)
+        if summarizer:
+            summarizer.discard(session_id)
+        if session_store:
+            return session_store.clear_session(session_id)
+
+        found = session_id in chat_histories
+        if found:
+            chat_histories[session_id] = []
+            history_versions.bump(session_id)
+            if history_log:
+                history_log.clear_session(session_id, chat_histories)
+            elif history_flusher:
+                history_flusher.mark_dirty(session_id)
+    if not history_log and not history_flusher:
+        save_chat_histories()
+    return found
+
+
+def clear_all_histories():
+    """Drop every session. Returns the number of sessions removed."""
+    transcripts.clear()
+    if summarizer:
+        summarizer.clear()
+    if session_store:
+        return session_store.clear_all()
+
+    # Cleared in place: rebinding the global would lose turns stored by requests
+    # that already looked up the old dict
+    session_count = len(chat_histories)
+    chat_histories.clear()
+    history_versions.clear()
+    if history_log:
+        history_log.clear_all(chat_histories)
+    return session_count
+
+
 @app.route('/save-histories', methods=['POST'])
 def save_histories_endpoint():
     success = save_chat_histories()
@@ -95,15 +293,39 @@ def save_histories_endpoint():
         return jsonify({"message": "Failed to save chat histories", "status": "error"}), 500
 
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """
+    REST API endpoint to inspect the in-memory caches.
+    Returns hit/miss/eviction counters for the response cache, and for the
+    session cache when running in sharded mode.
+    """
+    stats = {"responses": response_cache.stats(), "single_flight": single_flight.stats(), "status": "success"}
+    if HISTORY_STORAGE_MODE == "sharded":
+        stats["cache"] = session_store.sessions.stats()
+    return jsonify(stats), 200
+
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_question_stream():
+    """
+    REST API endpoint to ask a question and stream the answer as Server-Sent Events.
+    Same as /ask with "stream": true.
+    """
+    return ask_question(stream=True)
+
+
 @app.route('/ask', methods=['POST'])
-def ask_question():
+def ask_question(stream=False):
     """
     REST API endpoint to ask a question to GPT-4o.
     Expects a JSON payload with 'question' field and optional 'session_id'.
-    Returns the model's response as JSON along with the chat history for that session.
+    Returns the model's response as JSON along with the chat history for that session,
+    or only the new turn with "history_mode": "delta" (see ASK_HISTORY_MODE).
+    With "stream": true the answer is sent as "token" events while it is generated,
+    followed by a "done" event with the usual response; the turn is only stored once
+    the answer is complete.
     """
-    global chat_histories
-
     try:
         # Get JSON data from the request
         data = request.get_json()
@@ -113,53 +335,62 @@ def ask_question():
         # Extract question and session_id from the request
         question = data['question']
         session_id = data.get('session_id', 'default_session')
+        try:
+            history_mode = ask_history_mode(data.get('history_mode'), ASK_HISTORY_MODE)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         print(f"Question received from session {session_id}: {question}")
 
-        # Initialize session history if it doesn't exist
-        if session_id not in chat_histories:
-            chat_histories[session_id] = []
-
-        # Get the chat history for this session
-        session_history = chat_histories[session_id]
+        # Get the chat history for this session, under its lock so a turn being stored
+        # right now is either fully in it or not at all
+        with session_locks.hold(session_id):
+            session_history = get_session_history(session_id) or []
 
-        # Create context from chat history
-        context = ""
-        if session_history:
-            context = "Previous conversation:\n"
-            for entry in session_history:
-                context += f"Human: {entry['question']}\nAI: {entry['answer']}\n"
+        # Create context from chat history (cached per session, updated one turn at a time)
+        context = build_context(session_id, session_history)
 
         # Prepare the question with context if there's history
         contextualized_question = question
         if context:
             contextualized_question = f"{context}\nHuman: {question}"
 
-        # Invoke the chain with the user's question
-        response = chain.invoke({
-            "question": contextualized_question
-        })
-        print(f"Response for session {session_id}: {response.content}")
-
-        # Update chat history for this session
-        chat_histories[session_id].append({
-            "question": question,
-            "answer": response.content,
-            "timestamp": str(datetime.datetime.now())
-        })
-
-        # Limit chat history to MAX_HISTORY_LENGTH entries
-        if len(chat_histories[session_id]) > MAX_HISTORY_LENGTH:
-            chat_histories[session_id] = chat_histories[session_id][-MAX_HISTORY_LENGTH:]
-
-        save_chat_histories()
-
-        # Return the response with chat history for this session
-        return jsonify({
-            "answer": response.content,
-            "status": "success",
-            "session_id": session_id,
-            "history": chat_histories[session_id]
-        }), 200
+        # Reuse the answer if this exact prompt (context included) was answered recently.
+        # Send "cache": false to force a fresh answer.
+        messages = prompt_template.format_messages(question=contextualized_question)
+        cache_key = prompt_cache_key(messages)
+        answer = response_cache.get(cache_key) if data.get('cache', True) else None
+        cached = answer is not None
+
+        def finish(answer):
+            if not cached:
+                response_cache.put(cache_key, answer)
+            print(f"Response for session {session_id}{' (cached)' if cached else ''}: {answer}")
+
+            # Update chat history for this session
+            turn = {"question": question, "answer": answer}
+            session_history, version = append_session_turn(session_id, turn)
+
+            # Return the response with the chat history (or just the new turn) for this session
+            return {
+                "answer": answer,
+                "status": "success",
+                "session_id": session_id,
+                "cached": cached,
+                **ask_history(history_mode, session_history, turn, version)
+            }
+
+        if stream or data.get('stream', False):
+            chunks = [answer] if cached else (
+                chunk.content for chunk in chain.stream({"question": contextualized_question}))
+            return sse_response(stream_answer(chunks, finish))
+
+        # Invoke the chain with the user's question. Identical prompts already being
+        # answered for another request share that call instead of making their own.
+        if not cached:
+            answer, _ = single_flight.do(cache_key, lambda: chain.invoke({
+                "question": contextualized_question
+            }).content)
+        return jsonify(finish(answer)), 200
 
     except KeyError as e:
         return jsonify({"error": f"KeyError: {str(e)}"}), 500
@@ -177,14 +408,11 @@ def clear_history():
     data = request.get_json() or {}
     session_id = data.get('session_id', 'default_session')
 
-    if session_id in chat_histories:
-        chat_histories[session_id] = []
+    if clear_session_history(session_id):
         message = f"Chat history for session {session_id} cleared successfully"
     else:
         message = f"No history found for session {session_id}"
 
-    save_chat_histories()
-
     return jsonify({
         "message": message,
         "status": "success",
@@ -198,9 +426,7 @@ def clear_all_history():
     REST API endpoint to clear all chat histories for all sessions.
     Returns a confirmation message.
     """
-    global chat_histories
-    session_count = len(chat_histories)
-    chat_histories = {}
+    session_count = clear_all_histories()
     return jsonify({
         "message": f"Chat history cleared for all {session_count} sessions",
         "status": "success"
@@ -224,23 +450,36 @@ def generate_session():
 def get_history():
     """
     REST API endpoint to retrieve the chat history for a specific session.
-    Expects a query parameter 'session_id'.
-    Returns the chat history for that session as JSON.
+    Expects a query parameter 'session_id', and optionally 'limit' and a
+    'before' / 'after' cursor to fetch only part of it.
+    Returns the chat history for that session as JSON, with the session's
+    version as ETag; a matching If-None-Match gets an empty 304 instead.
     """
     session_id = request.args.get('session_id', 'default_session')
-
-    if session_id not in chat_histories:
-        return jsonify({
-            "history": [],
-            "count": 0,
-            "session_id": session_id
-        }), 200
-
-    return jsonify({
-        "history": chat_histories[session_id],
-        "count": len(chat_histories[session_id]),
+    try:
+        limit, before, after = page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Read the version before the turns: if a turn is stored in between, the
+    # client gets the newer turns under the older ETag and just refetches next time
+    tag, version = get_session_version(session_id)
+    summary, summary_through = summarizer.get(session_id) if summarizer else ("", None)
+    etag = history_etag(tag, version, summary_through)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return "", 304, {"ETag": etag}
+
+    session_history = get_session_history(session_id) or []
+    response = {
+        **history_page(session_history, limit, before, after),
+        "version": version,
         "session_id": session_id
-    }), 200
+    }
+    if summarizer:
+        response["summary"] = summary
+    response = jsonify(response)
+    response.headers["ETag"] = etag
+    return response, 200
 
 
 if __name__ == "__main__":
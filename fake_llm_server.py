@@ -0,0 +1,67 @@
+# Local stand-in for the Azure OpenAI chat completions API, for testing without credentials or costs.
+# Run: python fake_llm_server.py  then point the apps at it with AZURE_OPENAI_ENDPOINT=http://localhost:8081
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from aiohttp import web
+
+# How long each completion takes, to mimic a real model's generation time
+FAKE_LLM_DELAY_MS = int(os.getenv("FAKE_LLM_DELAY_MS", "500"))
+FAKE_LLM_PORT = int(os.getenv("FAKE_LLM_PORT", "8081"))
+
+
+def make_answer(messages):
+    question = messages[-1]["content"].splitlines()[-1] if messages else ""
+    return f"This is a fake answer to: {question.removeprefix('Human: ')}"
+
+
+def completion_chunk(completion_id, deployment, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": deployment,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+
+async def chat_completions(request):
+    body = await request.json()
+    deployment = request.match_info["deployment"]
+    answer = make_answer(body.get("messages", []))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    if not body.get("stream"):
+        await asyncio.sleep(FAKE_LLM_DELAY_MS / 1000)
+        words = len(answer.split())
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": words, "total_tokens": words}
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    tokens = [word + " " for word in answer.split()]
+    tokens[-1] = tokens[-1].rstrip()
+    chunks = [{"role": "assistant", "content": ""}] + [{"content": token} for token in tokens]
+    for delta in chunks:
+        await asyncio.sleep(FAKE_LLM_DELAY_MS / 1000 / len(chunks))
+        await response.write(f"data: {json.dumps(completion_chunk(completion_id, deployment, delta))}\n\n".encode())
+    await response.write(f"data: {json.dumps(completion_chunk(completion_id, deployment, {}, 'stop'))}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+app = web.Application()
+app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+
+
+if __name__ == "__main__":
+    web.run_app(app, host="localhost", port=FAKE_LLM_PORT, backlog=4096)
@@ -0,0 +1,101 @@
+# Cursor pagination and ETags for the /history and /sessions endpoints, and the
+# history part of /ask responses
+import re
+
+# /sessions returns at most this many session IDs per page unless asked for fewer
+SESSIONS_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# How much of the session's history an /ask response carries
+ASK_HISTORY_MODES = ("full", "delta")
+
+
+def page_args(args, default_limit=None):
+    """
+    (limit, before, after) from a request's query parameters. Raises ValueError
+    if `limit` isn't a positive integer; it is capped at MAX_PAGE_SIZE.
+    """
+    limit = args.get('limit', default_limit)
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValueError("'limit' must be a positive integer")
+        limit = min(limit, MAX_PAGE_SIZE)
+    return limit, args.get('before'), args.get('after')
+
+
+def history_page(history, limit=None, before=None, after=None):
+    """
+    The turns of `history` (oldest first) newer than the `after` cursor and older
+    than `before`, as the body of a /history response. Cursors are turn
+    timestamps. With a `limit`, the newest `limit` of those turns are returned,
+    or the oldest when paging forward with `after`. "before_cursor" fetches the
+    turns just older than the page (None if there are none) and "after_cursor"
+    the ones newer than it, which is what a client polling for new turns sends.
+    """
+    turns = [entry for entry in history
+             if (after is None or (entry.get("timestamp") or "") > after)
+             and (before is None or (entry.get("timestamp") or "") < before)]
+    if limit is not None and len(turns) > limit:
+        turns = turns[:limit] if after is not None else turns[-limit:]
+    return {
+        "history": turns,
+        "count": len(turns),
+        "total": len(history),
+        "before_cursor": turns[0].get("timestamp") if turns and turns[0] is not history[0] else None,
+        "after_cursor": turns[-1].get("timestamp") if turns else after
+    }
+
+
+def session_page(session_ids, limit):
+    """
+    The body of a /sessions response from up to `limit` + 1 session IDs, in ID
+    order. "next_cursor" is the `after` value for the next page, or None on the last.
+    """
+    page = session_ids[:limit]
+    return {
+        "sessions": page,
+        "count": len(page),
+        "next_cursor": page[-1] if len(session_ids) > limit else None
+    }
+
+
+def history_etag(tag, version, *parts):
+    """
+    Strong ETag for `version` of a session's history in the store identified by
+    `tag`, plus any other `parts` the response depends on (e.g. its summary).
+    """
+    parts = [tag, str(version)] + [re.sub(r"[^0-9A-Za-z]", "", str(part)) for part in parts if part]
+    return '"' + "-".join(parts) + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value (which may be None) lists `etag` or is "*"."""
+    for candidate in (if_none_match or "").split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def ask_history_mode(requested, default="full"):
+    """The history mode an /ask request asked for, else `default`. Raises ValueError for an unknown mode."""
+    mode = requested or default
+    if mode not in ASK_HISTORY_MODES:
+        raise ValueError(f"'history_mode' must be one of: {', '.join(ASK_HISTORY_MODES)}")
+    return mode
+
+
+def ask_history(mode, history, turn, version):
+    """
+    The history fields of an /ask response once `turn` is stored: the whole
+    session `history` in "full" mode, or only `turn` in "delta" mode, plus the
+    number of stored turns and the session's `version` either way. A delta
+    client keeps its own copy and catches up on turns stored by other requests
+    with /history?after=<its newest timestamp>.
+    """
+    fields = {"turn": turn} if mode == "delta" else {"history": history}
+    fields.update(total=len(history), version=version)
+    return fields
@@ -0,0 +1,696 @@
+# Storage backends for chat histories
+import atexit
+import bisect
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+from session_cache import SessionCache
+from session_locks import SessionLocks
+
+
+def write_json_atomic(path, data):
+    """Write `data` as JSON to `path` via a temp file so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class SessionVersions:
+    """
+    Version numbers for the sessions of an in-process store. Every change to a
+    session takes the next number from one counter, so a number is never
+    reused, even after the session is cleared or dropped; sessions never
+    changed are at version 0. Numbers start over when the process restarts, so
+    they only identify a history together with the random per-process `tag`.
+    """
+
+    def __init__(self):
+        self.tag = os.urandom(4).hex()
+        self._counter = itertools.count(1)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        return self._versions.get(session_id, 0)
+
+    def bump(self, session_id):
+        with self._lock:
+            version = self._versions[session_id] = next(self._counter)
+        return version
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+
+
+class SessionIndex:
+    """
+    The session IDs of an in-process store, kept sorted as sessions are added,
+    so a page of them is a bisect and a slice instead of listing and sorting
+    every session on each request.
+    """
+
+    def __init__(self, session_ids=()):
+        self._ids = sorted(set(session_ids))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, session_id):
+        with self._lock:
+            i = bisect.bisect_left(self._ids, session_id)
+            if i == len(self._ids) or self._ids[i] != session_id:
+                self._ids.insert(i, session_id)
+
+    def ids(self):
+        return list(self._ids)
+
+    def page(self, after=None, limit=None):
+        """Session IDs after `after`, at most `limit` of them."""
+        with self._lock:
+            start = 0 if after is None else bisect.bisect_right(self._ids, after)
+            return self._ids[start:None if limit is None else start + limit]
+
+
+class HistoryLog:
+    """
+    Append-only JSONL log of chat history changes on top of a JSON snapshot.
+    Every change is applied to the in-memory histories and written as a single
+    line in one step under the log's lock, so a compaction either snapshots it
+    and drops its line or runs before it; replaying can never apply it twice.
+    After `compact_every` records the full state is written to the snapshot and
+    the log starts over.
+    """
+
+    def __init__(self, snapshot_file, log_file, compact_every=500):
+        self.snapshot_file = snapshot_file
+        self.log_file = log_file
+        self.pending_file = f"{log_file}.compacting"
+        self.compact_every = compact_every
+        self.records_since_compaction = 0
+        self._torn = False
+        self._lock = threading.Lock()
+
+    def load(self, max_length=None):
+        """Read the snapshot and replay the log on top of it. Returns the histories dict."""
+        histories = {}
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r') as f:
+                histories = json.load(f)
+
+        # A leftover pending log means we crashed mid-compaction. It is only
+        # newer than the snapshot if the snapshot was never replaced.
+        interrupted = os.path.exists(self.pending_file)
+        if interrupted:
+            if (not os.path.exists(self.snapshot_file)
+                    or os.path.getmtime(self.pending_file) >= os.path.getmtime(self.snapshot_file)):
+                self._replay(self.pending_file, histories, max_length)
+
+        self.records_since_compaction = self._replay(self.log_file, histories, max_length)
+
+        # Compacting also drops a torn tail so new records are never appended after it
+        if interrupted or self._torn:
+            self.compact(histories)
+        return histories
+
+    def _replay(self, path, histories, max_length):
+        self._torn = False
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write at the tail of the log; everything before it is intact.
+                    print(f"Skipping truncated record in {path}")
+                    self._torn = True
+                    break
+                self._apply(record, histories, max_length)
+                count += 1
+        return count
+
+    @staticmethod
+    def _apply(record, histories, max_length):
+        op = record.get("op")
+        session_id = record.get("session_id")
+        if op == "append":
+            # A new list, so a save or response still using the old one never sees it half-updated
+            history = (histories.get(session_id) or []) + [record["entry"]]
+            histories[session_id] = history[-max_length:] if max_length else history
+        elif op == "create":
+            histories.setdefault(session_id, [])
+        elif op == "clear":
+            histories[session_id] = []
+        elif op == "clear_all":
+            histories.clear()
+
+    def _write(self, record, histories, max_length=None):
+        with self._lock:
+            self._apply(record, histories, max_length)
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+            self.records_since_compaction += 1
+            due = self.records_since_compaction >= self.compact_every
+        if due:
+            self.compact(histories)
+
+    def append_turn(self, session_id, entry, histories, max_length=None):
+        """Append `entry` to the session in `histories`, keeping `max_length` turns, and log it. Returns the session."""
+        self._write({"op": "append", "session_id": session_id, "entry": entry}, histories, max_length)
+        return histories[session_id]
+
+    def create_session(self, session_id, histories):
+        self._write({"op": "create", "session_id": session_id}, histories)
+
+    def clear_session(self, session_id, histories):
+        self._write({"op": "clear", "session_id": session_id}, histories)
+
+    def clear_all(self, histories):
+        self._write({"op": "clear_all"}, histories)
+
+    def compact(self, histories):
+        """Write the full state to the snapshot and drop the log records it covers."""
+        with self._lock:
+            if os.path.exists(self.log_file):
+                os.replace(self.log_file, self.pending_file)
+            # Copy the top-level dict so other sessions can keep changing while we serialize
+            write_json_atomic(self.snapshot_file, dict(histories))
+            if os.path.exists(self.pending_file):
+                os.remove(self.pending_file)
+            self.records_since_compaction = 0
+        print(f"Chat history log compacted into {self.snapshot_file}")
+
+
+class SqliteHistoryStore:
+    """
+    Chat histories kept as one row per turn in an embedded SQLite database.
+    Every call reads or writes the rows of a single session only.
+    Every change to a session stamps it with the next number of a counter
+    kept in the database, so versions are shared by every process using it.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, created_at TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0)"
+            )
+            # Databases created before sessions had versions start them at 0
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]
+            if "version" not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS history_version ("
+                "id INTEGER PRIMARY KEY CHECK (id = 1), tag TEXT NOT NULL, version INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO history_version (id, tag, version) VALUES (1, ?, 0)",
+                (os.urandom(4).hex(),)
+            )
+            self.version_tag = conn.execute("SELECT tag FROM history_version").fetchone()[0]
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+                "timestamp TEXT, entry TEXT NOT NULL)"
+            )
+            # Turns are ordered by id, the order they were stored in: timestamps come from each
+            # worker's clock and can be skewed between workers
+            conn.execute("DROP INDEX IF EXISTS idx_turns_session_timestamp")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_turns_session_id ON turns (session_id, id)")
+
+    def _connect(self):
+        # sqlite3 connections can't be shared across threads, so each Flask worker thread gets its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def session_version(self, session_id):
+        """The version of `session_id`, or 0 if it doesn't exist."""
+        conn = self._connect()
+        row = conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump_version(self, conn, session_id):
+        # Called inside the write transaction, which SQLite runs one at a time
+        conn.execute("UPDATE history_version SET version = version + 1")
+        conn.execute(
+            "UPDATE sessions SET version = (SELECT version FROM history_version) WHERE session_id = ?",
+            (session_id,)
+        )
+        return conn.execute("SELECT version FROM history_version").fetchone()[0]
+
+    def get_session(self, session_id):
+        """Return the turns of `session_id` in the order they were stored, or None if the session doesn't exist."""
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT entry FROM turns WHERE session_id = ? ORDER BY id",
+            (session_id,)
+        ).fetchall()
+        if rows:
+            return [json.loads(row[0]) for row in rows]
+        exists = conn.execute(
+            "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return [] if exists else None
+
+    def create_session(self, session_id):
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, created_at) VALUES (?, ?)",
+                (session_id, str(datetime.now()))
+            )
+            if cursor.rowcount == 1:
+                self._bump_version(conn, session_id)
+
+    def append_turn(self, session_id, entry, max_length=None):
+        """
+        Store one turn and trim the session to its `max_length` newest turns. Returns
+        (history, version): the session and its version right after this change.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, created_at) VALUES (?, ?)",
+                (session_id, str(datetime.now()))
+            )
+            conn.execute(
+                "INSERT INTO turns (session_id, timestamp, entry) VALUES (?, ?, ?)",
+                (session_id, entry.get("timestamp"), json.dumps(entry))
+            )
+            if max_length:
+                conn.execute(
+                    "DELETE FROM turns WHERE session_id = ? AND id NOT IN ("
+                    "SELECT id FROM turns WHERE session_id = ? "
+                    "ORDER BY id DESC LIMIT ?)",
+                    (session_id, session_id, max_length)
+                )
+            version = self._bump_version(conn, session_id)
+            # Read back before committing, so no other worker's turn can land in between
+            history = self.get_session(session_id)
+        return history, version
+
+    def clear_session(self, session_id):
+        """Delete the turns of `session_id`. Returns False if the session doesn't exist."""
+        conn = self._connect()
+        with conn:
+            exists = conn.execute(
+                "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            if exists:
+                self._bump_version(conn, session_id)
+        return exists is not None
+
+    def clear_all(self):
+        """Delete every session. Returns the number of sessions removed."""
+        conn = self._connect()
+        with conn:
+            count = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            conn.execute("DELETE FROM turns")
+            conn.execute("DELETE FROM sessions")
+        return count
+
+    def session_ids(self):
+        conn = self._connect()
+        return [row[0] for row in conn.execute("SELECT session_id FROM sessions ORDER BY created_at")]
+
+    def session_id_page(self, after=None, limit=None):
+        """Session IDs in ID order, only those after `after` and at most `limit` of them."""
+        conn = self._connect()
+        return [row[0] for row in conn.execute(
+            "SELECT session_id FROM sessions WHERE ? IS NULL OR session_id > ? ORDER BY session_id LIMIT ?",
+            (after, after, limit if limit is not None else -1)
+        )]
+
+    def flush(self):
+        # Every change is committed as it happens
+        pass
+
+    def is_empty(self):
+        conn = self._connect()
+        return conn.execute("SELECT 1 FROM sessions LIMIT 1").fetchone() is None
+
+    def import_histories(self, histories):
+        """Bulk-load a {session_id: [turns]} dict, e.g. an existing chat_histories.json."""
+        conn = self._connect()
+        now = str(datetime.now())
+        with conn:
+            for session_id, history in histories.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO sessions (session_id, created_at) VALUES (?, ?)",
+                    (session_id, now)
+                )
+                conn.executemany(
+                    "INSERT INTO turns (session_id, timestamp, entry) VALUES (?, ?, ?)",
+                    [(session_id, entry.get("timestamp"), json.dumps(entry)) for entry in history]
+                )
+                self._bump_version(conn, session_id)
+
+
+class ShardedHistoryStore:
+    """
+    One JSON file per session under `directory`, bucketed by a hash prefix.
+    Sessions are read from disk the first time they are accessed and each
+    change rewrites only the affected session's file, so startup does no I/O.
+    At most `max_sessions` sessions (or about `max_bytes`) stay in memory.
+    """
+
+    def __init__(self, directory, write_behind=False, interval_ms=500, max_pending=100,
+                 max_sessions=None, max_bytes=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.sessions = SessionCache(max_sessions, max_bytes, loader=self.read_session, on_evict=self._spill)
+        self.flusher = WriteBehindFlusher(self.write_sessions, interval_ms, max_pending) if write_behind else None
+        self.versions = SessionVersions()
+        self.version_tag = self.versions.tag
+        # Orders the direct writes of one session when write-behind is off
+        self._write_locks = SessionLocks()
+        # Built from the files the first time session IDs are listed, then kept up to date
+        self._index = None
+
+    def _path(self, session_id):
+        # Hash the id so client-supplied session ids can't escape the directory
+        digest = hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.json")
+
+    def read_session(self, session_id):
+        """Read a session straight from its file. Returns None if there is none."""
+        path = self._path(session_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)["history"]
+
+    def write_session(self, session_id, history):
+        """Write a session straight to its file."""
+        path = self._path(session_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json_atomic(path, {"session_id": session_id, "history": history})
+
+    def write_sessions(self, session_ids):
+        for session_id in session_ids:
+            # Under the write lock, so an eviction spilling a newer version writes after us
+            with self._write_locks.hold(session_id):
+                history = self.sessions.peek(session_id)
+                # Anything no longer cached was written when it was evicted
+                if history is not None:
+                    self.write_session(session_id, history)
+
+    def _spill(self, session_id, history):
+        # Even without write-behind the direct write of the newest change may not have
+        # landed yet, and the next load must not read an older file
+        with self._write_locks.hold(session_id):
+            self.write_session(session_id, history)
+
+    def _changed(self, session_id, history, version):
+        """
+        Persist `history`, which became `version` of the session under self._lock.
+        Without write-behind it is written as is rather than read back from the
+        cache, which may already have evicted it; a change overtaken by a newer
+        one (or by the eviction that spilled it) leaves the file to that one.
+        """
+        if self.flusher:
+            self.flusher.mark_dirty(session_id)
+            return
+        with self._write_locks.hold(session_id):
+            if self.versions.get(session_id) == version:
+                self.write_session(session_id, history)
+
+    def get_session(self, session_id):
+        """Return the turns of `session_id`, or None if the session doesn't exist."""
+        return self.sessions.get(session_id)
+
+    def session_version(self, session_id):
+        """The version of `session_id`, or 0 if it hasn't changed since this process started."""
+        return self.versions.get(session_id)
+
+    def create_session(self, session_id):
+        with self._lock:
+            if self.sessions.get(session_id) is not None:
+                return
+            self.sessions[session_id] = []
+            version = self.versions.bump(session_id)
+            self._indexed(session_id)
+        self._changed(session_id, [], version)
+
+    def append_turn(self, session_id, entry, max_length=None):
+        """
+        Store one turn and trim the session to its `max_length` newest turns. Returns
+        (history, version): the session and its version right after this change.
+        """
+        with self._lock:
+            # Build a new list so a flush in progress never sees it half-updated
+            history = (self.sessions.get(session_id) or []) + [entry]
+            if max_length and len(history) > max_length:
+                history = history[-max_length:]
+            self.sessions[session_id] = history
+            version = self.versions.bump(session_id)
+            self._indexed(session_id)
+        self._changed(session_id, history, version)
+        return history, version
+
+    def clear_session(self, session_id):
+        """Empty `session_id`. Returns False if the session doesn't exist."""
+        with self._lock:
+            if self.sessions.get(session_id) is None:
+                return False
+            self.sessions[session_id] = []
+            version = self.versions.bump(session_id)
+        self._changed(session_id, [], version)
+        return True
+
+    def clear_all(self):
+        """Delete every session file. Returns the number of sessions removed."""
+        if self.flusher:
+            self.flusher.flush()
+        with self._lock:
+            count = len(self._session_index())
+            self.sessions.clear()
+            self.versions.clear()
+            self._index = SessionIndex()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+        return count
+
+    def _files(self):
+        for bucket in os.scandir(self.directory):
+            if bucket.is_dir():
+                for entry in os.scandir(bucket.path):
+                    if entry.name.endswith(".json"):
+                        yield entry.path
+
+    def _indexed(self, session_id):
+        # Called under self._lock, like _session_index()
+        if self._index is not None:
+            self._index.add(session_id)
+
+    def _session_index(self):
+        if self._index is None:
+            # File names are hashes, so the first listing has to open every shard once
+            ids = set(self.sessions)
+            for path in self._files():
+                with open(path, 'r') as f:
+                    ids.add(json.load(f)["session_id"])
+            self._index = SessionIndex(ids)
+        return self._index
+
+    def session_ids(self):
+        with self._lock:
+            return self._session_index().ids()
+
+    def session_id_page(self, after=None, limit=None):
+        """Session IDs in ID order, only those after `after` and at most `limit` of them."""
+        with self._lock:
+            index = self._session_index()
+        return index.page(after, limit)
+
+    def flush(self):
+        if self.flusher:
+            self.flusher.flush()
+
+    def is_empty(self):
+        return len(self.sessions) == 0 and next(self._files(), None) is None
+
+    def import_histories(self, histories):
+        """Bulk-load a {session_id: [turns]} dict, e.g. an existing chat_histories.json."""
+        for session_id, history in histories.items():
+            self.write_session(session_id, history)
+            with self._lock:
+                self._indexed(session_id)
+
+
+class LocalHistoryStore:
+    """
+    Chat histories that live only in this process: at most `max_sessions`
+    sessions (or about `max_bytes`) stay in memory and colder ones spill to
+    per-session files under `spill_dir`, which is emptied on start. Same
+    interface as SqliteHistoryStore, which is what several worker processes
+    need to share one conversation state.
+    """
+
+    def __init__(self, spill_dir, max_sessions=None, max_bytes=None):
+        self.spill_store = ShardedHistoryStore(spill_dir)
+        # Nothing is kept across restarts, so leftovers from a previous run are discarded
+        self.spill_store.clear_all()
+        self.sessions = SessionCache(max_sessions, max_bytes, loader=self.spill_store.read_session,
+                                     on_evict=self.spill_store.write_session)
+        self.versions = SessionVersions()
+        self.version_tag = self.versions.tag
+        self.index = SessionIndex()
+        self._lock = threading.Lock()
+
+    def get_session(self, session_id):
+        """Return the turns of `session_id`, or None if the session doesn't exist."""
+        return self.sessions.get(session_id)
+
+    def session_version(self, session_id):
+        """The version of `session_id`, or 0 if it doesn't exist."""
+        return self.versions.get(session_id)
+
+    def create_session(self, session_id):
+        with self._lock:
+            if self.sessions.get(session_id) is None:
+                self.sessions[session_id] = []
+                self.versions.bump(session_id)
+                self.index.add(session_id)
+
+    def append_turn(self, session_id, entry, max_length=None):
+        """
+        Store one turn and trim the session to its `max_length` newest turns. Returns
+        (history, version): the session and its version right after this change.
+        """
+        with self._lock:
+            # Build a new list so a response still serializing the old one never sees it half-updated,
+            # and always reassign so the cache sees the new size
+            history = (self.sessions.get(session_id) or []) + [entry]
+            if max_length and len(history) > max_length:
+                history = history[-max_length:]
+            self.sessions[session_id] = history
+            version = self.versions.bump(session_id)
+            self.index.add(session_id)
+        return history, version
+
+    def clear_session(self, session_id):
+        """Empty `session_id`. Returns False if the session doesn't exist."""
+        with self._lock:
+            if self.sessions.get(session_id) is None:
+                return False
+            self.sessions[session_id] = []
+            self.versions.bump(session_id)
+        return True
+
+    def clear_all(self):
+        """Drop every session. Returns the number of sessions removed."""
+        with self._lock:
+            count = len(self.index)
+            self.sessions.clear()
+            self.spill_store.clear_all()
+            self.versions.clear()
+            self.index = SessionIndex()
+        return count
+
+    def session_ids(self):
+        """Session IDs held in memory plus the ones spilled to disk."""
+        return self.index.ids()
+
+    def session_id_page(self, after=None, limit=None):
+        """Session IDs in ID order, only those after `after` and at most `limit` of them."""
+        return self.index.page(after, limit)
+
+    def flush(self):
+        pass
+
+    def is_empty(self):
+        return len(self.sessions) == 0 and self.spill_store.is_empty()
+
+    def stats(self):
+        return self.sessions.stats()
+
+
+class WriteBehindFlusher:
+    """
+    Tracks dirty session ids and hands them to `flush_fn` from a background thread,
+    at most every `interval_ms` or as soon as `max_pending` changes have piled up.
+    Whatever is still dirty is flushed when the process exits.
+    """
+
+    def __init__(self, flush_fn, interval_ms=500, max_pending=100):
+        self.flush_fn = flush_fn
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self.dirty = set()
+        self.pending_changes = 0
+        self.flush_count = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="history-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def mark_dirty(self, session_id):
+        with self._cond:
+            self.dirty.add(session_id)
+            self.pending_changes += 1
+            if self.pending_changes >= self.max_pending:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and self.pending_changes < self.max_pending:
+                    self._cond.wait(self.interval)
+                stopped = self._stopped
+            self.flush()
+            if stopped:
+                return
+
+    def flush(self):
+        """Write out everything marked dirty so far, coalesced into a single flush_fn call."""
+        with self._flush_lock:
+            with self._cond:
+                dirty, self.dirty = self.dirty, set()
+                self.pending_changes = 0
+            if not dirty:
+                return
+            try:
+                self.flush_fn(dirty)
+                self.flush_count += 1
+            except Exception as e:
+                print(f"Error flushing chat histories: {str(e)}")
+                # Keep them dirty so the next round retries
+                with self._cond:
+                    self.dirty |= dirty
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout=10)
+        self.flush()
@@ -0,0 +1,80 @@
+# Password hashing in worker processes, so key derivation never holds the request threads' GIL
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when `max_pending` hashes are already queued or running."""
+
+
+class PasswordHasher:
+    """
+    hash() and verify() run werkzeug's generate_password_hash / check_password_hash
+    in a pool of `workers` processes and wait for the result. `method` is any
+    werkzeug method string, e.g. "scrypt" or "pbkdf2:sha256:600000". At most
+    `max_pending` calls may be queued or running; more raise PasswordHasherBusy
+    instead of piling up. With workers=0 hashing runs on the calling thread.
+    """
+
+    def __init__(self, method="scrypt", workers=2, max_pending=64):
+        self.method = method
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        if workers > 0:
+            # Fork so the workers don't re-import the app module; start them now, before
+            # the server has threads that could be holding a lock at fork time
+            context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+            if context and threading.active_count() > 1:
+                print(f"WARNING: PasswordHasher forks its workers while {threading.active_count() - 1} other threads "
+                      "are running; build it before starting any")
+            self._pool = ProcessPoolExecutor(workers, mp_context=context)
+            self._pool.submit(generate_password_hash, "", method).result()
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordHasherBusy(f"{self.pending} password hashes already pending")
+            self.pending += 1
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def hash(self, password):
+        if not self._pool:
+            return generate_password_hash(password, self.method)
+        return self._submit(generate_password_hash, password, self.method).result()
+
+    def verify(self, password_hash, password):
+        if not self._pool:
+            return check_password_hash(password_hash, password)
+        return self._submit(check_password_hash, password_hash, password).result()
+
+    async def hash_async(self, password):
+        if not self._pool:
+            return await asyncio.to_thread(generate_password_hash, password, self.method)
+        return await asyncio.wrap_future(self._submit(generate_password_hash, password, self.method))
+
+    async def verify_async(self, password_hash, password):
+        if not self._pool:
+            return await asyncio.to_thread(check_password_hash, password_hash, password)
+        return await asyncio.wrap_future(self._submit(check_password_hash, password_hash, password))
+
+    def stats(self):
+        return {"method": self.method, "pending": self.pending, "max_pending": self.max_pending,
+                "rejected": self.rejected}
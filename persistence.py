@@ -1,9 +1,12 @@
 from flask import Flask, jsonify, request
 import json
 import os
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
 from langchain_openai import AzureChatOpenAI
+from history_store import HistoryLog, write_json_atomic
+from session_locks import SessionLocks
 
 app = Flask(__name__)
 
@@ -13,6 +16,9 @@ load_dotenv()
 # Constants
 HISTORY_DIR = "chat_history"
 HISTORY_FILE = os.path.join(HISTORY_DIR, "history.json")
+HISTORY_LOG_FILE = os.path.join(HISTORY_DIR, "history.log.jsonl")
+HISTORY_STORAGE_MODE = os.getenv("HISTORY_STORAGE_MODE", "json")
+HISTORY_COMPACT_EVERY = int(os.getenv("HISTORY_COMPACT_EVERY", "500"))
 MAX_HISTORY_LENGTH = 10
 chat_histories = {}
 
@@ -36,13 +42,20 @@ llm = AzureChatOpenAI(
 
 # Ensure history directory exists
 os.makedirs(HISTORY_DIR, exist_ok=True)
+history_log = HistoryLog(HISTORY_FILE, HISTORY_LOG_FILE, HISTORY_COMPACT_EVERY) if HISTORY_STORAGE_MODE == "log" else None
+# One lock per session serializes its updates; full saves run one at a time
+session_locks = SessionLocks()
+save_lock = threading.Lock()
 
 # Persistence functions
 def save_chat_histories():
     try:
-        serializable_histories = {sid: hist for sid, hist in chat_histories.items()}
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(serializable_histories, f, indent=2)
+        if history_log:
+            history_log.compact(chat_histories)
+            return True
+        # Histories are replaced rather than mutated, so a shallow copy is a consistent snapshot
+        with save_lock:
+            write_json_atomic(HISTORY_FILE, dict(chat_histories))
         print(f"Chat histories saved to {HISTORY_FILE}")
         return True
     except Exception as e:
@@ -52,6 +65,10 @@ def save_chat_histories():
 def load_chat_histories():
     global chat_histories
     try:
+        if history_log:
+            chat_histories = history_log.load(MAX_HISTORY_LENGTH)
+            print(f"Chat histories replayed from {HISTORY_FILE} and {HISTORY_LOG_FILE}")
+            return True
         if os.path.exists(HISTORY_FILE):
             with open(HISTORY_FILE, 'r') as f:
                 chat_histories = json.load(f)
@@ -75,21 +92,26 @@ def ask_question():
     question = data['question']
     session_id = data.get('session_id', 'default_session')
     
-    if session_id not in chat_histories:
-        chat_histories[session_id] = []
-    
     response = llm.invoke(question)
-    chat_histories[session_id].append({
-        "question": question,
-        "answer": response.content,
-        "timestamp": str(datetime.now())
-    })
-    
-    if len(chat_histories[session_id]) > MAX_HISTORY_LENGTH:
-        chat_histories[session_id] = chat_histories[session_id][-MAX_HISTORY_LENGTH:]
+
+    # Read, extend and store the history under the session's lock so concurrent
+    # requests for the same session don't overwrite each other's turns
+    with session_locks.hold(session_id):
+        entry = {
+            "question": question,
+            "answer": response.content,
+            "timestamp": str(datetime.now())
+        }
+        if history_log:
+            # The log updates chat_histories itself, in step with the record it writes
+            history = history_log.append_turn(session_id, entry, chat_histories, MAX_HISTORY_LENGTH)
+        else:
+            history = (chat_histories.get(session_id) or []) + [entry]
+            history = chat_histories[session_id] = history[-MAX_HISTORY_LENGTH:]
     
-    save_chat_histories()
-    return jsonify({"answer": response.content, "history": chat_histories[session_id]}), 200
+    if not history_log:
+        save_chat_histories()
+    return jsonify({"answer": response.content, "history": history}), 200
 
 @app.route('/save-histories', methods=['POST'])
 def save_histories_endpoint():
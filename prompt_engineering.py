@@ -1,9 +1,17 @@
 # Spices up responses with personas and examples
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from langchain_openai import AzureChatOpenAI
 from langchain.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
+import atexit
+import json
 import os
+from collections import deque
 from dotenv import load_dotenv
+from prompt_registry import PromptRegistry
+from question_classifier import QuestionClassifier, load_question_patterns
+from response_cache import ResponseCache, prompt_cache_key
+from single_flight import SingleFlight
 
 app = Flask(__name__)
 
@@ -18,6 +26,37 @@ llm = AzureChatOpenAI(
     max_tokens=500
 )
 
+# Answers to identical rendered prompts are served from here instead of calling the LLM again
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(10 * 1024 * 1024))),
+    ttl_seconds=int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+)
+
+# Identical prompts that arrive while the first one is still being answered wait for its answer
+single_flight = SingleFlight()
+
+# Reworded versions of an answered question are served from here (off unless SEMANTIC_CACHE_ENABLED=true)
+semantic_cache = None
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", "semantic_cache")
+if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true":
+    from semantic_cache import SemanticCache
+    semantic_cache = SemanticCache(
+        default_threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9")),
+        thresholds=json.loads(os.getenv("SEMANTIC_CACHE_THRESHOLDS", "{}")),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "100000")),
+        max_candidates=int(os.getenv("SEMANTIC_CACHE_MAX_CANDIDATES", "2000"))
+    )
+    try:
+        semantic_cache.load(SEMANTIC_CACHE_DIR)
+    except Exception as e:
+        print(f"Error loading semantic cache: {str(e)}")
+    atexit.register(semantic_cache.save, SEMANTIC_CACHE_DIR)
+
+# /ask-batch sends at most this many questions to the LLM at once
+ASK_BATCH_MAX_CONCURRENCY = int(os.getenv("ASK_BATCH_MAX_CONCURRENCY", "8"))
+ASK_BATCH_MAX_ITEMS = int(os.getenv("ASK_BATCH_MAX_ITEMS", "10000"))
+
 # Persona constants
 PERSONAS = {
     "default": "You are a helpful assistant providing concise and accurate answers.",
@@ -43,15 +82,17 @@ FEW_SHOT_EXAMPLES = {
 }
 
 
+# Keywords per question type, checked in this order (QUESTION_PATTERNS_FILE can replace them)
+QUESTION_PATTERNS = {
+    "factual": ["what is", "who is", "when did", "where is", "how many"],
+    "opinion": ["what do you think", "opinion", "best", "worst", "should i"],
+    "instruction": ["how do i", "how to", "steps", "guide", "instructions"]
+}
+question_classifier = QuestionClassifier(load_question_patterns(QUESTION_PATTERNS))
+
+
 def classify_question_type(question):
-    question = question.lower()
-    if any(q in question for q in ["what is", "who is", "when did", "where is", "how many"]):
-        return "factual"
-    if any(q in question for q in ["what do you think", "opinion", "best", "worst", "should i"]):
-        return "opinion"
-    if any(q in question for q in ["how do i", "how to", "steps", "guide", "instructions"]):
-        return "instruction"
-    return None
+    return question_classifier.classify(question)
 
 
 def create_prompt_template(persona="default", question_type=None):
@@ -67,11 +108,25 @@ def create_prompt_template(persona="default", question_type=None):
     return ChatPromptTemplate.from_messages(messages)
 
 
+# Every persona × question type template and chain, built once at startup
+prompt_registry = PromptRegistry(create_prompt_template, llm, PERSONAS)
+prompt_registry.warm([None] + list(FEW_SHOT_EXAMPLES))
+
+
 @app.route('/personas', methods=['GET'])
 def get_personas():
     return jsonify({"personas": list(PERSONAS.keys()), "descriptions": PERSONAS}), 200
 
 
+@app.route('/cache-stats', methods=['GET'])
+def get_cache_stats():
+    stats = {"cache": response_cache.stats(), "prompts": prompt_registry.stats(),
+             "single_flight": single_flight.stats(), "status": "success"}
+    if semantic_cache:
+        stats["semantic_cache"] = semantic_cache.stats()
+    return jsonify(stats), 200
+
+
 @app.route('/ask', methods=['POST'])
 def ask_question():
     try:
@@ -80,14 +135,131 @@ def ask_question():
             return jsonify({"error": "Missing 'question'"}), 400
         question = data['question']
         persona = data.get('persona', 'default')
+        # Send "cache": false to force a fresh answer
+        use_cache = data.get('cache', True)
         question_type = classify_question_type(question)
-        prompt_template = create_prompt_template(persona, question_type)
-        dynamic_chain = prompt_template | llm
-        response = dynamic_chain.invoke({"question": question})
-        return jsonify({"answer": response.content, "status": "success", "persona": persona, "question_type": question_type}), 200
+        prompt_template, chain = prompt_registry.get(persona, question_type)
+        # Near-duplicates are kept per prompt, so unknown personas share the default's entries
+        cache_persona = prompt_registry.resolve_persona(persona)
+
+        cache_key = prompt_cache_key(prompt_template.format_messages(question=question))
+        answer = response_cache.get(cache_key) if use_cache else None
+        similarity = None
+        if answer is None and use_cache and semantic_cache:
+            answer, similarity = semantic_cache.get(question, cache_persona, question_type)
+        cached = answer is not None
+        if not cached:
+            def generate_answer():
+                answer = chain.invoke({"question": question}).content
+                response_cache.put(cache_key, answer)
+                if semantic_cache:
+                    semantic_cache.put(question, answer, cache_persona, question_type)
+                return answer
+            answer, _ = single_flight.do(cache_key, generate_answer)
+        result = {"answer": answer, "status": "success", "persona": persona, "question_type": question_type, "cached": cached}
+        if cached and similarity is not None:
+            result["similarity"] = round(similarity, 4)
+        return jsonify(result), 200
     except Exception as e:
         return jsonify({"error": f"Unexpected error: {type(e).__name__}: {str(e)}"}), 500
 
 
+# Runs one prepared batch item through its persona/question-type chain
+answer_batch_item = RunnableLambda(lambda item: item["chain"].invoke({"question": item["question"]}).content)
+
+
+SESSION_ID_TYPES = (str, int, float)
+
+
+def batch_item_error(item):
+    """Why a batch item can't be answered, or None if it can."""
+    if not isinstance(item.get('question'), str):
+        return "Missing 'question'"
+    if not isinstance(item.get('persona', 'default'), str):
+        return "'persona' must be a string"
+    if item.get('session_id') is not None and not isinstance(item['session_id'], SESSION_ID_TYPES):
+        return "'session_id' must be a string or number"
+    return None
+
+
+@app.route('/ask-batch', methods=['POST'])
+def ask_batch():
+    """
+    Answer a list of {"question", "persona", "session_id"} items, sending at most
+    "max_concurrency" (default and upper limit ASK_BATCH_MAX_CONCURRENCY) to the LLM
+    at once. Results stream back as NDJSON, one line per item with its "index", as
+    they complete; a failed item gets its own error line. Items of the same session
+    always come back in the order they were sent.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Missing 'items'"}), 400
+    if len(items) > ASK_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items (max {ASK_BATCH_MAX_ITEMS})"}), 400
+    options = data if isinstance(data, dict) else {}
+    try:
+        max_concurrency = max(1, min(int(options.get('max_concurrency', ASK_BATCH_MAX_CONCURRENCY)), ASK_BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'max_concurrency' must be a number"}), 400
+    use_cache = options.get('cache', True)
+
+    items = [item if isinstance(item, dict) else {} for item in items]
+    errors = [batch_item_error(item) for item in items]
+    questions = [item['question'] for item, error in zip(items, errors) if error is None]
+    question_types = iter(question_classifier.classify_many(questions))
+
+    # Finished lines waiting to be sent, the LLM calls still to make, and per session
+    # the indexes not sent yet, in input order (items without a session stand alone)
+    results = {}
+    pending = []
+    queues = {}
+    for index, item in enumerate(items):
+        session_id = item.get('session_id')
+        in_session = isinstance(session_id, SESSION_ID_TYPES)
+        queues.setdefault(session_id if in_session else ("item", index), deque()).append(index)
+        result = {"index": index, "session_id": session_id}
+        if errors[index]:
+            results[index] = {**result, "error": errors[index], "status": "error"}
+            continue
+        question = item['question']
+        result.update(persona=item.get('persona', 'default'), question_type=next(question_types))
+        prompt_template, chain = prompt_registry.get(result["persona"], result["question_type"])
+        cache_key = prompt_cache_key(prompt_template.format_messages(question=question))
+        answer = response_cache.get(cache_key) if use_cache else None
+        if answer is not None:
+            results[index] = {**result, "answer": answer, "cached": True, "status": "success"}
+        else:
+            pending.append({"question": question, "chain": chain, "cache_key": cache_key, "result": result})
+    queue_of = {index: queue for queue in queues.values() for index in queue}
+
+    def ready_lines(index):
+        """NDJSON lines that can go out now that `index` is done, keeping each session in order."""
+        queue = queue_of[index]
+        while queue and queue[0] in results:
+            yield json.dumps(results.pop(queue.popleft())) + "\n"
+
+    def generate():
+        for index in list(results):
+            yield from ready_lines(index)
+        batch = answer_batch_item.batch_as_completed(pending, config={"max_concurrency": max_concurrency},
+                                                     return_exceptions=True)
+        for position, answer in batch:
+            item = pending[position]
+            result = item["result"]
+            if isinstance(answer, Exception):
+                results[result["index"]] = {"index": result["index"], "session_id": result["session_id"],
+                                            "error": f"Unexpected error: {type(answer).__name__}: {str(answer)}",
+                                            "status": "error"}
+            else:
+                response_cache.put(item["cache_key"], answer)
+                if semantic_cache:
+                    semantic_cache.put(item["question"], answer, prompt_registry.resolve_persona(result["persona"]),
+                                       result["question_type"])
+                results[result["index"]] = {**result, "answer": answer, "cached": False, "status": "success"}
+            yield from ready_lines(result["index"])
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 if __name__ == "__main__":
     app.run(debug=True, port=3000)
@@ -3,6 +3,7 @@ from langchain_openai import AzureChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 import os
 from dotenv import load_dotenv
+from question_classifier import QuestionClassifier, load_question_patterns
 
 app = Flask(__name__)
 
@@ -51,16 +52,16 @@ FEW_SHOT_EXAMPLES = {
     ]
 }
 
-# Question classification
+# Question classification, keywords checked in this order
+QUESTION_PATTERNS = {
+    "factual": ["what is", "who is", "when did", "where is"],
+    "opinion": ["what do you think", "best", "should i"],
+    "instruction": ["how do i", "how to", "steps"]
+}
+question_classifier = QuestionClassifier(load_question_patterns(QUESTION_PATTERNS))
+
 def classify_question_type(question):
-    question = question.lower()
-    if any(q in question for q in ["what is", "who is", "when did", "where is"]):
-        return "factual"
-    if any(q in question for q in ["what do you think", "best", "should i"]):
-        return "opinion"
-    if any(q in question for q in ["how do i", "how to", "steps"]):
-        return "instruction"
-    return None
+    return question_classifier.classify(question)
 
 # Dynamic prompt creation
 def create_prompt_template(persona="default", question_type=None):
@@ -0,0 +1,58 @@
+# Builds each persona/question-type prompt template and chain once and reuses it
+import threading
+
+
+class PromptRegistry:
+    """
+    Memoizes `build_template(persona, question_type)` and the `template | llm`
+    chain made from it, so /ask doesn't rebuild the few-shot text and a new
+    ChatPromptTemplate on every request. Call invalidate() after changing a
+    persona or its examples; the next lookup rebuilds it.
+    """
+
+    def __init__(self, build_template, llm, personas):
+        self.build_template = build_template
+        self.llm = llm
+        self.personas = personas
+        self.builds = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve_persona(self, persona):
+        """The persona whose prompt is used: unknown personas fall back to "default"."""
+        return persona if persona in self.personas else "default"
+
+    def _key(self, persona, question_type):
+        # Unknown personas share the default prompt's entry
+        return (self.resolve_persona(persona), question_type)
+
+    def get(self, persona="default", question_type=None):
+        """Return (template, chain) for a persona and question type, building them on first use."""
+        key = self._key(persona, question_type)
+        entry = self._entries.get(key)
+        if entry is None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    template = self.build_template(*key)
+                    entry = (template, template | self.llm)
+                    self._entries[key] = entry
+                    self.builds += 1
+        return entry
+
+    def warm(self, question_types):
+        """Build every persona × question type combination up front."""
+        for persona in list(self.personas):
+            for question_type in question_types:
+                self.get(persona, question_type)
+
+    def invalidate(self, persona=None):
+        """Forget the cached entries of one persona, or of every persona."""
+        with self._lock:
+            if persona is None:
+                self._entries.clear()
+            else:
+                self._entries = {key: entry for key, entry in self._entries.items() if key[0] != persona}
+
+    def stats(self):
+        return {"entries": len(self._entries), "builds": self.builds}
@@ -0,0 +1,91 @@
+# Classifies questions by keyword patterns with one compiled regex pass
+import json
+import os
+import re
+
+
+def load_question_patterns(defaults):
+    """
+    Return {category: [patterns]} in priority order. QUESTION_PATTERNS_FILE may
+    point to a JSON file of the same shape that replaces `defaults`.
+    """
+    patterns_file = os.getenv("QUESTION_PATTERNS_FILE")
+    if patterns_file:
+        try:
+            with open(patterns_file, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading question patterns from {patterns_file}, using defaults: {str(e)}")
+    return defaults
+
+
+def _trie_regex(patterns):
+    """
+    One regex matching the longest of `patterns` at a position. Shared prefixes are
+    merged ("what (?:is|do you think)"), so adding patterns makes the regex deeper
+    rather than adding alternatives that are each tried in turn.
+    """
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build(node):
+        terminal = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Prefer the longer match; a pattern ending here makes the rest optional
+        return f"(?:{body})?" if terminal else body
+
+    return build(trie)
+
+
+class QuestionClassifier:
+    """
+    Same answers as checking each category's patterns with `in`, category by
+    category, but in a single scan of the question. `patterns` maps categories,
+    highest priority first, to lowercase substrings.
+    """
+
+    def __init__(self, patterns):
+        self.categories = list(patterns)
+        # Every pattern found at a position is a prefix of the longest one found there,
+        # so each literal is mapped to the best category among itself and its prefixes
+        ranks = {}
+        for rank, category in enumerate(self.categories):
+            for pattern in patterns[category]:
+                if pattern:
+                    ranks.setdefault(pattern.lower(), rank)
+        self._ranks = {
+            literal: min(ranks.get(literal[:length], rank) for length in range(1, len(literal) + 1))
+            for literal, rank in ranks.items()
+        }
+        # Lookahead so overlapping hits ("show" / "how") are all seen
+        self._regex = re.compile(f"(?=({_trie_regex(ranks)}))") if ranks else None
+
+    def classify(self, question):
+        """Return the highest-priority category with a pattern in `question`, or None."""
+        if self._regex is None:
+            return None
+        best = len(self.categories)
+        for match in self._regex.finditer(question.lower()):
+            rank = self._ranks[match.group(1)]
+            if rank < best:
+                best = rank
+                if best == 0:
+                    break
+        return self.categories[best] if best < len(self.categories) else None
+
+    def classify_many(self, questions):
+        """classify() for a batch of questions; repeated questions are only scanned once."""
+        seen = {}
+        results = []
+        for question in questions:
+            if question not in seen:
+                seen[question] = self.classify(question)
+            results.append(seen[question])
+        return results
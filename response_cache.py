@@ -0,0 +1,98 @@
+# Exact-match cache of LLM answers, keyed on the rendered prompt
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_prompt_text(text):
+    """Collapse whitespace and case so trivially different spellings of a prompt share a key."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def prompt_cache_key(messages):
+    """
+    Hash a rendered prompt into a cache key. `messages` may be LangChain messages
+    (anything with .type and .content) or (role, content) pairs.
+    """
+    digest = hashlib.sha256()
+    for message in messages:
+        if isinstance(message, tuple):
+            role, content = message
+        else:
+            role, content = message.type, message.content
+        digest.update(f"{role}\x00{normalize_prompt_text(content)}\x01".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU cache of answers with a per-entry TTL, bounded by entry count and by the
+    approximate size of the cached answers.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=10 * 1024 * 1024, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached answer for `key`, or None if it's missing or expired."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            answer, expires_at, size = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.total_bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def put(self, key, answer):
+        size = len(key) + len(answer.encode("utf-8"))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            self._entries[key] = (answer, time.monotonic() + self.ttl_seconds, size)
+            self.total_bytes += size
+            while self._entries and (
+                    (self.max_entries and len(self._entries) > self.max_entries)
+                    or (self.max_bytes and self.total_bytes > self.max_bytes)):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,237 @@
+# Near-duplicate answer cache using local hashed n-gram vectors and cosine similarity
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from history_store import write_json_atomic
+
+# Words that change how a question is phrased but not what it asks about; every other word
+# has to match exactly for a hit ("Austria" vs "Australia" are close vectors, not the same question)
+FUNCTION_WORDS = frozenset("""
+a about am an and any anyone are as at be been being by can could did do does for from get got had has
+have hello hey hi how i if im in is it its ive just kindly know let me might my of on or please possible
+so some someone tell that thats the there theres this to us was we were what whats when whens where
+wheres which who whos why whys will with would you your
+""".split())
+
+
+class HashedNgramEmbedder:
+    """
+    Embeds text offline as a signed, hashed bag of word unigrams and character
+    n-grams, L2-normalized so a dot product is the cosine similarity.
+    """
+
+    def __init__(self, dim=256, ngram_sizes=(3, 4)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def words(self, text):
+        return re.sub(r"[^\w\s]", "", text.casefold()).split()
+
+    def content_words(self, text):
+        """The words of `text` that say what it asks about, see FUNCTION_WORDS."""
+        return frozenset(word for word in self.words(text) if word not in FUNCTION_WORDS)
+
+    def features(self, text):
+        words = self.words(text)
+        features = list(words)
+        padded = f" {' '.join(words)} "
+        for n in self.ngram_sizes:
+            features.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+        return features
+
+    def embed(self, text):
+        # crc32 rather than hash() so vectors stay the same across processes and restarts
+        hashes = np.fromiter((zlib.crc32(feature.encode("utf-8")) for feature in self.features(text)), dtype=np.int64)
+        signs = np.where(hashes >> 31, 1.0, -1.0)
+        vector = np.bincount(hashes % self.dim, weights=signs, minlength=self.dim).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class _Namespace:
+    """Vectors and answers for one persona/question-type, indexed by their content words."""
+
+    def __init__(self, dim, capacity=16):
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        # {content words: slots}: a hit needs the same content words, so only these are compared
+        self.buckets = {}
+        self.questions = []
+        self.content_words = []
+        self.answers = []
+        self.size = 0
+
+    def _grow(self):
+        capacity = self.matrix.shape[0] * 2
+        self.matrix = np.resize(self.matrix, (capacity, self.matrix.shape[1]))
+        self.last_used = np.resize(self.last_used, capacity)
+
+    def _unindex_slot(self, slot):
+        bucket = self.buckets[self.content_words[slot]]
+        bucket.discard(slot)
+        if not bucket:
+            del self.buckets[self.content_words[slot]]
+
+    def search(self, vector, content_words, max_candidates):
+        """Return (slots, similarities) of the cached questions with `content_words`, closest first."""
+        bucket = self.buckets.get(content_words, ())
+        slots = np.fromiter(bucket, dtype=np.int64, count=len(bucket))
+        if len(slots) > max_candidates:
+            # Many phrasings of one question: only compare the most recently used ones
+            slots = slots[np.argpartition(-self.last_used[slots], max_candidates - 1)[:max_candidates]]
+        similarities = self.matrix[slots] @ vector
+        order = np.argsort(-similarities)
+        return slots[order], similarities[order]
+
+    def insert(self, vector, question, content_words, answer, max_entries):
+        if self.size < max_entries:
+            if self.size == self.matrix.shape[0]:
+                self._grow()
+            slot = self.size
+            self.size += 1
+            self.questions.append(question)
+            self.content_words.append(content_words)
+            self.answers.append(answer)
+        else:
+            # Full: reuse the least recently used slot
+            slot = int(np.argmin(self.last_used[:self.size]))
+            self._unindex_slot(slot)
+            self.questions[slot] = question
+            self.content_words[slot] = content_words
+            self.answers[slot] = answer
+        self.matrix[slot] = vector
+        self.last_used[slot] = time.time()
+        self.buckets.setdefault(content_words, set()).add(slot)
+        return slot
+
+    def rebuild_index(self):
+        self.buckets = {}
+        for slot, content_words in enumerate(self.content_words):
+            self.buckets.setdefault(content_words, set()).add(slot)
+
+
+class SemanticCache:
+    """
+    Answers questions that are worded differently from one already answered,
+    as long as their cosine similarity reaches the threshold for the persona.
+    Entries are kept per namespace (persona + question type) so a hit always
+    comes from the same system prompt. Each namespace holds at most
+    `max_entries`, replacing the least recently used one when full.
+    A hit also needs exactly the same content words (see FUNCTION_WORDS), so
+    entries are bucketed by them and a lookup only compares its own bucket,
+    at most `max_candidates` of it (the most recently used), however many
+    entries there are. Lookups only read namespaces; put() creates them, so
+    callers should key it by a known persona rather than anything a client sends.
+    """
+
+    def __init__(self, default_threshold=0.9, thresholds=None, max_entries=100000, dim=256, max_candidates=2000):
+        self.default_threshold = default_threshold
+        self.thresholds = thresholds or {}
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.embedder = HashedNgramEmbedder(dim)
+        self.namespaces = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def threshold_for(self, persona):
+        return float(self.thresholds.get(persona, self.default_threshold))
+
+    def _namespace(self, persona, question_type):
+        key = f"{persona}:{question_type}"
+        if key not in self.namespaces:
+            self.namespaces[key] = _Namespace(self.embedder.dim)
+        return self.namespaces[key]
+
+    def get(self, question, persona="default", question_type=None):
+        """
+        Return (answer, similarity) for the closest cached question with the same content
+        words, or (None, similarity) if there is none or it is below the threshold.
+        """
+        vector = self.embedder.embed(question)
+        content_words = self.embedder.content_words(question)
+        with self._lock:
+            namespace = self.namespaces.get(f"{persona}:{question_type}")
+            if namespace is None:
+                self.misses += 1
+                return None, 0.0
+            slots, similarities = namespace.search(vector, content_words, self.max_candidates)
+            if not len(slots) or similarities[0] < self.threshold_for(persona):
+                self.misses += 1
+                return None, float(similarities[0]) if len(slots) else 0.0
+            slot = int(slots[0])
+            namespace.last_used[slot] = time.time()
+            self.hits += 1
+            return namespace.answers[slot], float(similarities[0])
+
+    def put(self, question, answer, persona="default", question_type=None):
+        vector = self.embedder.embed(question)
+        content_words = self.embedder.content_words(question)
+        with self._lock:
+            self._namespace(persona, question_type).insert(vector, question, content_words, answer, self.max_entries)
+
+    def save(self, directory):
+        """Persist vectors, questions and answers so the index survives restarts."""
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            arrays = {}
+            entries = {}
+            for i, (key, namespace) in enumerate(self.namespaces.items()):
+                arrays[f"matrix_{i}"] = namespace.matrix[:namespace.size]
+                arrays[f"last_used_{i}"] = namespace.last_used[:namespace.size]
+                entries[key] = {"index": i, "questions": namespace.questions, "answers": namespace.answers}
+            # Both via temp files, so a crash mid-save leaves the previous index readable
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, **arrays)
+                os.replace(tmp_path, os.path.join(directory, "vectors.npz"))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            write_json_atomic(os.path.join(directory, "entries.json"), entries)
+
+    def load(self, directory):
+        vectors_file = os.path.join(directory, "vectors.npz")
+        entries_file = os.path.join(directory, "entries.json")
+        if not (os.path.exists(vectors_file) and os.path.exists(entries_file)):
+            return False
+        with open(entries_file, 'r') as f:
+            entries = json.load(f)
+        arrays = np.load(vectors_file)
+        with self._lock:
+            for key, entry in entries.items():
+                matrix = arrays[f"matrix_{entry['index']}"]
+                # Skip what a different embedder (or a save interrupted between the two files) left behind
+                if matrix.shape[1] != self.embedder.dim or len(matrix) != len(entry["questions"]):
+                    continue
+                namespace = _Namespace(self.embedder.dim, capacity=max(16, len(matrix)))
+                namespace.size = len(matrix)
+                namespace.matrix[:namespace.size] = matrix
+                namespace.last_used[:namespace.size] = arrays[f"last_used_{entry['index']}"]
+                namespace.questions = entry["questions"]
+                namespace.content_words = [self.embedder.content_words(question) for question in entry["questions"]]
+                namespace.answers = entry["answers"]
+                namespace.rebuild_index()
+                self.namespaces[key] = namespace
+        return True
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": sum(namespace.size for namespace in self.namespaces.values()),
+            "namespaces": len(self.namespaces),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "default_threshold": self.default_threshold,
+            "thresholds": self.thresholds
+        }
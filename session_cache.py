@@ -0,0 +1,144 @@
+# Bounded LRU cache for per-session chat histories
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+
+def estimate_history_size(history):
+    """Rough size in bytes of a list of turns, good enough for keeping memory in check."""
+    size = 64
+    for entry in history:
+        size += 64
+        for key, value in entry.items():
+            size += len(key) + len(str(value))
+    return size
+
+
+class SessionCache(MutableMapping):
+    """
+    A {session_id: history} dict that keeps at most `max_sessions` sessions
+    (and roughly `max_bytes` of turns) in memory, least recently used first out.
+    Evicted sessions are passed to `on_evict` (e.g. written to disk) and a
+    miss is answered by `loader`, so callers can treat it as a plain dict.
+    """
+
+    def __init__(self, max_sessions=10000, max_bytes=None, loader=None, on_evict=None):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        # {session_id: [loads in flight, generation]}: the generation moves whenever the
+        # session is stored or evicted during a load, so a stale read is retried
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, session_id):
+        with self._lock:
+            if session_id in self._data:
+                self.hits += 1
+                self._data.move_to_end(session_id)
+                return self._data[session_id]
+            self.misses += 1
+            loading = self._loading.setdefault(session_id, [0, 0])
+            loading[0] += 1
+        try:
+            while True:
+                generation = loading[1]
+                history = self.loader(session_id) if self.loader else None
+                with self._lock:
+                    # Another thread may have loaded or written it while we were reading
+                    if session_id in self._data:
+                        return self._data[session_id]
+                    # It was stored and evicted meanwhile, so what we read may predate that write
+                    if loading[1] != generation:
+                        continue
+                    if history is None:
+                        raise KeyError(session_id)
+                    self._store(session_id, history)
+                    return history
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[session_id]
+
+    def __setitem__(self, session_id, history):
+        with self._lock:
+            self._store(session_id, history)
+
+    def __delitem__(self, session_id):
+        with self._lock:
+            del self._data[session_id]
+            self.total_bytes -= self._sizes.pop(session_id)
+            self._touched(session_id)
+
+    def __contains__(self, session_id):
+        try:
+            self[session_id]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        # Only what is currently in memory; spilled sessions live in the loader's store
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def peek(self, session_id):
+        """Return the in-memory copy of a session without touching LRU order, stats or the loader."""
+        return self._data.get(session_id)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            for loading in self._loading.values():
+                loading[1] += 1
+            self.total_bytes = 0
+
+    def _touched(self, session_id):
+        loading = self._loading.get(session_id)
+        if loading:
+            loading[1] += 1
+
+    def _store(self, session_id, history):
+        self._touched(session_id)
+        size = estimate_history_size(history)
+        self.total_bytes += size - self._sizes.get(session_id, 0)
+        self._sizes[session_id] = size
+        self._data[session_id] = history
+        self._data.move_to_end(session_id)
+        self._evict()
+
+    def _evict(self):
+        while len(self._data) > 1 and (
+                (self.max_sessions and len(self._data) > self.max_sessions)
+                or (self.max_bytes and self.total_bytes > self.max_bytes)):
+            session_id, history = self._data.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(session_id)
+            self.evictions += 1
+            self._touched(session_id)
+            if self.on_evict:
+                self.on_evict(session_id, history)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._data),
+            "bytes": self.total_bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
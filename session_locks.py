@@ -0,0 +1,38 @@
+# Per-session locks for serializing history updates without a global lock
+import threading
+from contextlib import contextmanager
+
+
+class SessionLocks:
+    """
+    hold(session_id) serializes the read-modify-write of one session's history.
+    Requests for different sessions never wait on each other; a session's lock
+    only exists while someone holds or is waiting for it, so idle sessions
+    cost nothing.
+    """
+
+    def __init__(self):
+        self.waits = 0
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, session_id):
+        with self._guard:
+            entry = self._locks.get(session_id)
+            if entry is None:
+                entry = self._locks[session_id] = [threading.Lock(), 0]
+            elif entry[1]:
+                self.waits += 1
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[session_id]
+
+    def stats(self):
+        return {"held": len(self._locks), "waits": self.waits}
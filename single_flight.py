@@ -0,0 +1,84 @@
+# Coalesces identical LLM calls that are in flight at the same time into one
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    do(key, fn) runs fn() unless a call with the same key is already running, in
+    which case it waits for that call and returns its result (or raises its error).
+    Nothing is kept once the call finishes; this caps duplicate work during a
+    spike rather than caching answers.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (result, shared), where `shared` is True if another caller did the work."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "calls": self.calls, "shared": self.shared}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines: do(key, make_coroutine) awaits one shared task per key."""
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._tasks = {}
+
+    async def do(self, key, make_coroutine):
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.shared += 1
+        else:
+            self.calls += 1
+            task = self._tasks[key] = asyncio.ensure_future(make_coroutine())
+            task.add_done_callback(lambda finished: self._finished(key, finished))
+        # Shielded so a caller that disconnects doesn't cancel the call for everyone else
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key, task):
+        self._tasks.pop(key, None)
+        # Mark the error as seen even if every caller went away before it was raised
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {"in_flight": len(self._tasks), "calls": self.calls, "shared": self.shared}
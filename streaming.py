@@ -0,0 +1,41 @@
+# Server-Sent Events helpers for streaming answers token by token
+import json
+import time
+
+from flask import Response, stream_with_context
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_answer(chunks, on_complete):
+    """
+    Yield a "token" event per chunk of text, then call on_complete(answer) with
+    the full answer and send what it returns as the "done" event. Nothing is
+    completed if the model fails (an "error" event is sent instead) or the
+    client goes away before the last token.
+    """
+    start = time.perf_counter()
+    first_token_ms = None
+    parts = []
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if first_token_ms is None:
+                first_token_ms = round((time.perf_counter() - start) * 1000, 1)
+                print(f"Time to first token: {first_token_ms} ms")
+            parts.append(chunk)
+            yield sse_event("token", {"token": chunk})
+        result = on_complete("".join(parts))
+    except Exception as e:
+        yield sse_event("error", {"error": f"Unexpected error: {type(e).__name__}: {str(e)}"})
+        return
+    result["time_to_first_token_ms"] = first_token_ms
+    yield sse_event("done", result)
+
+
+def sse_response(events):
+    return Response(stream_with_context(events), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,168 @@
+# Stress test: many threads asking questions in a few shared sessions at once, then check no turn was lost
+# Run: python stress_session_history.py [app_multiuser|conversation_persistence] [threads] [sessions] [turns per session] [workers]
+# The LLM is the local fake_llm_server, started in-process; histories are written to a temporary directory.
+# With workers > 0 the app is served by that many processes and consecutive questions of a session go to
+# different ones, as behind a load balancer; use HISTORY_STORAGE_MODE=sqlite so they share the histories.
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+APP = sys.argv[1] if len(sys.argv) > 1 else "conversation_persistence"
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+SESSIONS = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+TURNS = int(sys.argv[4]) if len(sys.argv) > 4 else 50
+WORKERS = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+FAKE_LLM_PORT = 8082
+WORKER_PORT = 8090
+
+# Keep every turn so a lost one shows up as a short history
+os.environ["MAX_HISTORY_LENGTH"] = str(TURNS)
+os.environ["FAKE_LLM_DELAY_MS"] = "5"
+os.environ["AZURE_OPENAI_API_KEY"] = "stress"
+os.environ["AZURE_OPENAI_ENDPOINT"] = os.environ["AZURE_OPENAI_API_ENDPOINT"] = f"http://localhost:{FAKE_LLM_PORT}"
+os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-05-01-preview")
+os.environ.setdefault("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME", "stress")
+
+
+def start_fake_llm():
+    import fake_llm_server
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(fake_llm_server.app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "localhost", FAKE_LLM_PORT).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+def check(histories):
+    """Return a list of problems: missing or duplicated turns, or turns out of timestamp order."""
+    problems = []
+    for s in range(SESSIONS):
+        history = histories.get(f"stress-{s}") or []
+        questions = [entry["question"] for entry in history]
+        expected = {f"Session {s} turn {t}" for t in range(TURNS)}
+        if len(questions) != len(set(questions)):
+            problems.append(f"stress-{s}: duplicated turns")
+        if set(questions) != expected:
+            problems.append(f"stress-{s}: {len(expected - set(questions))} of {TURNS} turns lost")
+        timestamps = [entry["timestamp"] for entry in history]
+        if timestamps != sorted(timestamps):
+            problems.append(f"stress-{s}: turns out of timestamp order")
+    return problems
+
+
+class WorkerClient:
+    """Sends each request to the next of the worker processes on WORKER_PORT, WORKER_PORT + 1, ..."""
+
+    def __init__(self, workers):
+        self.ports = [WORKER_PORT + i for i in range(workers)]
+        self.next_port = iter(range(sys.maxsize))
+
+    def request(self, path, body=None, port=None):
+        port = port or self.ports[next(self.next_port) % len(self.ports)]
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(f"http://localhost:{port}{path}", data=data,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    def histories(self, port):
+        return {f"stress-{s}": self.request(f"/history?session_id=stress-{s}", port=port)[1]["history"]
+                for s in range(SESSIONS)}
+
+
+def start_workers():
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", str(WORKER_PORT + i)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for i in range(WORKERS)]
+    for i in range(WORKERS):
+        for _ in range(300):
+            try:
+                urllib.request.urlopen(f"http://localhost:{WORKER_PORT + i}/history")
+                break
+            except OSError:
+                time.sleep(0.1)
+    return workers
+
+
+def serve(port):
+    from werkzeug.serving import make_server
+
+    sys.setswitchinterval(1e-6)
+    app_module = __import__(APP)
+    make_server("localhost", port, app_module.app, threaded=True).serve_forever()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        # A worker process, started by start_workers() from the test's directory
+        APP = os.environ["STRESS_APP"]
+        serve(int(sys.argv[2]))
+    # Switch threads as often as possible so unsynchronized read-modify-writes interleave
+    sys.setswitchinterval(1e-6)
+    start_fake_llm()
+    # The apps keep their histories under ./chat_histories
+    os.chdir(tempfile.mkdtemp(prefix="stress_session_history_"))
+    os.environ["STRESS_APP"] = APP
+    if WORKERS:
+        worker_processes = start_workers()
+        client = WorkerClient(WORKERS)
+        ask_request = client.request
+    else:
+        app_module = __import__(APP)
+        test_client = app_module.app.test_client()
+
+        def ask_request(path, body):
+            response = test_client.post(path, json=body)
+            return response.status_code, response.get_json()
+
+    def ask(job):
+        s, t = job
+        status, _ = ask_request("/ask", {"question": f"Session {s} turn {t}", "session_id": f"stress-{s}",
+                                         "cache": False})
+        return status == 200
+
+    jobs = [(s, t) for t in range(TURNS) for s in range(SESSIONS)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as pool:
+        ok = sum(pool.map(ask, jobs))
+    elapsed = time.perf_counter() - start
+    print(f"{ok}/{len(jobs)} requests succeeded in {elapsed:.2f}s ({len(jobs) / elapsed:.0f}/s) with {THREADS} threads "
+          f"over {SESSIONS} sessions" + (f" and {WORKERS} worker processes" if WORKERS else ""))
+
+    if WORKERS:
+        # Every worker has to return the same, complete histories
+        sessions = client.histories(client.ports[0])
+        problems = check(sessions)
+        for port in client.ports[1:]:
+            if client.histories(port) != sessions:
+                problems.append(f"worker on port {port} sees different histories")
+        for worker in worker_processes:
+            worker.terminate()
+            worker.wait()
+    else:
+        sessions = {f"stress-{s}": test_client.get("/history", query_string={"session_id": f"stress-{s}"}).get_json()["history"]
+                    for s in range(SESSIONS)}
+        problems = check(sessions)
+    if not WORKERS and APP == "conversation_persistence" and os.getenv("HISTORY_STORAGE_MODE", "json") == "json":
+        # What was written to disk has to match what is in memory
+        app_module.save_chat_histories()
+        with open(app_module.HISTORY_FILE, 'r') as f:
+            problems += [f"on disk: {problem}" for problem in check(json.load(f))]
+
+    for problem in problems:
+        print(problem)
+    print("FAIL" if problems else "OK: no lost, duplicated or reordered turns")
+    sys.exit(1 if problems else 0)
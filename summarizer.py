@@ -0,0 +1,185 @@
+# Folds older conversation turns into a running per-session summary, off the request path
+import json
+import os
+import threading
+
+from context_builder import render_turn
+from history_store import WriteBehindFlusher, write_json_atomic
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a human and an AI assistant.\n"
+    "Update the summary with the new turns below. Keep names, facts, decisions and open "
+    "questions; drop small talk. Reply with the updated summary only.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New turns:\n{transcript}"
+)
+
+
+def make_llm_summarizer(llm):
+    """Build a summarize(previous_summary, turns) function on top of any LLM with `.invoke()`."""
+    def summarize(summary, turns):
+        transcript = "".join(render_turn(entry) for entry in turns)
+        response = llm.invoke(SUMMARY_PROMPT.format(summary=summary or "(empty)", transcript=transcript))
+        return response.content.strip()
+    return summarize
+
+
+class RollingSummarizer:
+    """
+    Keeps a summary per session of every turn except the newest `keep_turns`.
+    /ask calls schedule() after storing a turn; a background thread folds the
+    turns that have left the recent window into the summary, so the prompt
+    stays small without forgetting what was said earlier. Summaries are saved
+    to `summaries_file` if one is given.
+    """
+
+    def __init__(self, summarize_fn, keep_turns=4, summaries_file=None, background=True):
+        self.summarize_fn = summarize_fn
+        self.keep_turns = keep_turns
+        self.summaries_file = summaries_file
+        self.summaries = {}
+        self.folds = 0
+        self._pending = {}
+        self._epochs = {}
+        self._cond = threading.Condition()
+        self._flusher = None
+        if summaries_file:
+            if os.path.exists(summaries_file):
+                with open(summaries_file, 'r') as f:
+                    self.summaries = json.load(f)
+            self._flusher = WriteBehindFlusher(self._save)
+        if background:
+            threading.Thread(target=self._run, name="history-summarizer", daemon=True).start()
+
+    def _save(self, dirty_sessions):
+        write_json_atomic(self.summaries_file, dict(self.summaries))
+
+    def get(self, session_id):
+        """Return (summary, timestamp of the last folded turn), or ("", None)."""
+        state = self.summaries.get(session_id)
+        if not state:
+            return "", None
+        return state["summary"], state["through"]
+
+    def unfolded_turns(self, session_id, history):
+        """How many of the newest turns in `history` are not covered by the summary yet."""
+        _, through = self.get(session_id)
+        if through is None:
+            return len(history)
+        count = 0
+        for entry in reversed(history):
+            if (entry.get("timestamp") or "") <= through:
+                break
+            count += 1
+        return count
+
+    def schedule(self, session_id, history):
+        """
+        Queue a session for folding. If it's already queued, its latest history replaces
+        the queued one, except for queued turns that MAX_HISTORY_LENGTH has trimmed off
+        since: those are kept in front so they are still folded into the summary.
+        """
+        if len(history) <= self.keep_turns:
+            return
+        with self._cond:
+            queued = self._pending.get(session_id)
+            history = list(history)
+            if queued:
+                first = history[0].get("timestamp") or ""
+                history = [entry for entry in queued if (entry.get("timestamp") or "") < first] + history
+            self._pending[session_id] = history
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            self.run_pending()
+
+    def run_pending(self):
+        """Fold every queued session now. The background thread calls this; tests can too."""
+        while True:
+            with self._cond:
+                if not self._pending:
+                    return
+                session_id, history = self._pending.popitem()
+                epoch = self._epochs.get(session_id, 0)
+            try:
+                self._fold(session_id, history, epoch)
+            except Exception as e:
+                print(f"Error summarizing session {session_id}: {str(e)}")
+
+    def _fold(self, session_id, history, epoch):
+        summary, through = self.get(session_id)
+        older = history[:-self.keep_turns]
+        new_turns = [entry for entry in older
+                     if through is None or (entry.get("timestamp") or "") > through]
+        if not new_turns:
+            return
+        summary = self.summarize_fn(summary, new_turns)
+        with self._cond:
+            # The session was cleared while we were talking to the LLM
+            if self._epochs.get(session_id, 0) != epoch:
+                return
+            self.summaries[session_id] = {"summary": summary, "through": new_turns[-1].get("timestamp")}
+            self.folds += 1
+        if self._flusher:
+            self._flusher.mark_dirty(session_id)
+
+    def discard(self, session_id):
+        with self._cond:
+            self._pending.pop(session_id, None)
+            self._epochs[session_id] = self._epochs.get(session_id, 0) + 1
+            found = self.summaries.pop(session_id, None) is not None
+        if found and self._flusher:
+            self._flusher.mark_dirty(session_id)
+
+    def clear(self):
+        with self._cond:
+            session_ids = set(self.summaries) | set(self._pending)
+            self._pending.clear()
+            self.summaries = {}
+            for session_id in session_ids:
+                self._epochs[session_id] = self._epochs.get(session_id, 0) + 1
+        if self._flusher:
+            self._flusher.mark_dirty(None)
+
+
+# Quick self-check with a fake LLM, no Azure credentials needed
+if __name__ == "__main__":
+    class FakeResponse:
+        def __init__(self, content):
+            self.content = content
+
+    class FakeLLM:
+        def __init__(self):
+            self.prompts = []
+
+        def invoke(self, prompt):
+            self.prompts.append(prompt)
+            return FakeResponse(f"summary #{len(self.prompts)}")
+
+    fake_llm = FakeLLM()
+    summarizer = RollingSummarizer(make_llm_summarizer(fake_llm), keep_turns=2, background=False)
+    history = []
+    for i in range(5):
+        history.append({"question": f"Q{i}", "answer": f"A{i}", "timestamp": f"2025-01-01 00:00:0{i}"})
+        summarizer.schedule("demo", history)
+        summarizer.run_pending()
+
+    summary, through = summarizer.get("demo")
+    print(f"Summary: {summary} (through {through})")
+    print(f"Unfolded turns: {summarizer.unfolded_turns('demo', history)}")
+    print(f"LLM calls: {len(fake_llm.prompts)}")
+    assert summary == "summary #3" and through == "2025-01-01 00:00:02"
+    assert summarizer.unfolded_turns("demo", history) == 2
+
+    # Turns trimmed off the stored history before the summarizer got to them are still folded
+    for i in range(5, 10):
+        history = (history + [{"question": f"Q{i}", "answer": f"A{i}", "timestamp": f"2025-01-01 00:00:0{i}"}])[-3:]
+        summarizer.schedule("demo", history)
+    summarizer.run_pending()
+    print(f"Folded after trimming to {len(history)} turns: {fake_llm.prompts[-1].split('New turns:')[1].count('Human:')} turns")
+    assert all(f"Q{i}" in fake_llm.prompts[-1] for i in (3, 4, 5, 6, 7))
+    assert summarizer.get("demo")[1] == "2025-01-01 00:00:07"
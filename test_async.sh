@@ -0,0 +1,42 @@
+#!/bin/bash
+# Async multi-user API, tested against the fake LLM so no Azure credentials are needed
+
+echo "Start these separately first:"
+echo "  FAKE_LLM_DELAY_MS=2000 python fake_llm_server.py"
+echo "  AZURE_OPENAI_ENDPOINT=http://localhost:8081 python app_async.py"
+echo "Testing the async chat API..."
+
+# Log in (the session cookie is kept in a cookie jar)
+JAR=$(mktemp)
+echo "Registering and logging in testuser..."
+curl -s -c $JAR -X POST http://localhost:3000/register -H "Content-Type: application/json" -d '{"username": "testuser", "password": "password123"}'
+echo
+SESSION_ID=$(curl -s -c $JAR -b $JAR -X POST http://localhost:3000/login -H "Content-Type: application/json" -d '{"username": "testuser", "password": "password123"}' | jq -r '.session_id')
+echo "Session ID: $SESSION_ID"
+
+# Ask a question and a follow-up, the second one streamed
+echo "Asking a question..."
+curl -s -b $JAR -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d "{\"question\": \"What is machine learning?\", \"session_id\": \"$SESSION_ID\"}"
+echo
+echo "Streaming a follow-up..."
+curl -s -N -b $JAR -X POST http://localhost:3000/ask/stream -H "Content-Type: application/json" -d "{\"question\": \"Give me an example.\", \"session_id\": \"$SESSION_ID\"}"
+
+# History and sessions
+echo "Getting the history..."
+curl -s "http://localhost:3000/history?session_id=$SESSION_ID"
+echo
+echo "Listing sessions..."
+curl -s http://localhost:3000/sessions
+echo
+
+# Many questions at once: with a 2 s fake LLM these should finish in a few seconds, not 2 s each
+echo "Sending 500 questions at once..."
+python bench_async_concurrency.py 500
+
+# Clean up
+echo "Clearing the history and logging out..."
+curl -s -X POST http://localhost:3000/clear-history -H "Content-Type: application/json" -d "{\"session_id\": \"$SESSION_ID\"}"
+echo
+curl -s -b $JAR -X POST http://localhost:3000/logout
+echo
+rm -f $JAR
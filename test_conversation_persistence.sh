@@ -19,3 +19,13 @@ curl -X GET "http://localhost:3000/history?session_id=YOUR_SESSION_ID"
 # Ask a follow-up question
 echo "Asking follow-up question..."
 curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d '{"question": "What are its main applications?", "session_id": "YOUR_SESSION_ID"}'
+
+# Stream the answer as Server-Sent Events; the turn is saved once the "done" event arrives
+echo "Streaming a follow-up answer..."
+curl -N -X POST http://localhost:3000/ask/stream -H "Content-Type: application/json" -d '{"question": "Summarize that in one sentence.", "session_id": "YOUR_SESSION_ID"}'
+
+# Concurrent questions into a few shared sessions (fake LLM started in-process); fails if a turn is lost.
+# A two-session cache makes every request evict and reload sessions from their files.
+echo "Stress-testing concurrent turns..."
+python stress_session_history.py conversation_persistence 32 8 30
+HISTORY_STORAGE_MODE=sharded HISTORY_CACHE_MAX_SESSIONS=2 python stress_session_history.py conversation_persistence 32 8 30
@@ -46,9 +46,26 @@ echo "Viewing User 2's chat history..."
 curl -X GET "http://localhost:3000/history?session_id=$USER2_SESSION"
 echo -e "\n"
 
-# Test 5: List all active sessions
+# Test 4b: Fetch only the newest turn, then poll with the ETag (304 until the session changes)
+echo "Viewing User 1's latest turn..."
+curl -X GET "http://localhost:3000/history?session_id=$USER1_SESSION&limit=1"
+echo -e "\n"
+
+echo "Polling User 1's chat history with its ETag..."
+ETAG=$(curl -s -D - -o /dev/null "http://localhost:3000/history?session_id=$USER1_SESSION" | grep -i '^etag:' | cut -d' ' -f2 | tr -d '\r')
+curl -s -o /dev/null -w "%{http_code}\n" -H "If-None-Match: $ETAG" "http://localhost:3000/history?session_id=$USER1_SESSION"
+echo -e "\n"
+
+# Test 4c: Ask for only the new turn instead of the whole history
+echo "User 1 asks with a delta-only response..."
+curl -X POST http://localhost:3000/ask \
+  -H "Content-Type: application/json" \
+  -d "{\"question\":\"And its population?\", \"session_id\":\"$USER1_SESSION\", \"history_mode\":\"delta\"}"
+echo -e "\n"
+
+# Test 5: List all active sessions, a page at a time
 echo "Listing all active sessions..."
-curl -X GET http://localhost:3000/sessions
+curl -X GET "http://localhost:3000/sessions?limit=10"
 echo -e "\n"
 
 # Test 6: Clear chat history for a specific session (User 1)
@@ -58,6 +75,13 @@ curl -X POST http://localhost:3000/clear-history \
   -d "{\"session_id\":\"$USER1_SESSION\"}"
 echo -e "\n"
 
+# Test 6b: Stream an answer as Server-Sent Events (-N turns off curl's buffering)
+echo "Streaming an answer for User 2..."
+curl -N -X POST http://localhost:3000/ask/stream \
+  -H "Content-Type: application/json" \
+  -d "{\"question\":\"Tell me a short story about a robot.\",\"session_id\":\"$USER2_SESSION\"}"
+echo -e "\n"
+
 # Test 7: Clear all chat histories
 echo "Clearing all chat histories..."
 curl -X POST http://localhost:3000/clear-all-history
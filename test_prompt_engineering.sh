@@ -19,3 +19,23 @@ curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d '{
 # Ask an instruction question with concise persona
 echo "Asking an instruction question with concise persona..."
 curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d '{"question": "How do I learn programming?", "persona": "concise"}'
+
+# Ask the same question again - should come back with "cached": true
+echo "Repeating the factual question (expect a cached answer)..."
+curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d '{"question": "What is quantum computing?", "persona": "expert"}'
+
+# Bypass the cache for a fresh answer
+echo "Repeating it with the cache bypassed..."
+curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d '{"question": "What is quantum computing?", "persona": "expert", "cache": false}'
+
+# Check the response cache hit rate
+echo "Checking response cache stats..."
+curl -X GET http://localhost:3000/cache-stats
+
+# Reworded question - with SEMANTIC_CACHE_ENABLED=true this comes back cached with a "similarity"
+echo "Asking a reworded version of the factual question..."
+curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d '{"question": "what is quantum computing", "persona": "expert"}'
+
+# Several questions in one call - answers stream back as NDJSON lines as they finish
+echo "Asking a batch of questions..."
+curl -N -X POST http://localhost:3000/ask-batch -H "Content-Type: application/json" -d '{"max_concurrency": 4, "items": [{"question": "What is a black hole?", "persona": "expert", "session_id": "nightly-1"}, {"question": "How do I bake bread?", "persona": "friendly", "session_id": "nightly-1"}, {"question": "Should I learn Rust?", "persona": "concise", "session_id": "nightly-2"}]}'
@@ -16,6 +16,10 @@ curl -X POST http://localhost:3000/login -H "Content-Type: application/json" -d
 echo "Asking a question with session ID..."
 curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -d '{"question": "What is machine learning?", "session_id": "YOUR_SESSION_ID"}'
 
+# Ask with the bearer token from the login response instead (replace YOUR_TOKEN)
+echo "Asking a question with a bearer token..."
+curl -X POST http://localhost:3000/ask -H "Content-Type: application/json" -H "Authorization: Bearer YOUR_TOKEN" -d '{"question": "What is deep learning?"}'
+
 # Log out
 echo "Logging out..."
 curl -X POST http://localhost:3000/logout -H "Content-Type: application/json" -d '{"session_id": "YOUR_SESSION_ID"}'
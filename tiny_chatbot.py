@@ -2,6 +2,7 @@ from langchain_openai import AzureChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 import os
 from dotenv import load_dotenv
+from question_classifier import QuestionClassifier, load_question_patterns
 
 load_dotenv()
 
@@ -30,13 +31,17 @@ llm = AzureChatOpenAI(
 )
 
 
-# Guess the question type
+# Guess the question type (first matching type wins)
+QUESTION_PATTERNS = {
+    "factual": ["what is", "who"],
+    "opinion": ["think", "best"],
+    "instruction": ["how"]
+}
+question_classifier = QuestionClassifier(load_question_patterns(QUESTION_PATTERNS))
+
+
 def classify_question(question):
-    q = question.lower()
-    if "what is" in q or "who" in q: return "factual"
-    if "think" in q or "best" in q: return "opinion"
-    if "how" in q: return "instruction"
-    return None
+    return question_classifier.classify(question)
 
 
 # Build a dynamic prompt
@@ -1,31 +1,44 @@
 # Adds user login/logout magic
 from flask import Flask, jsonify, request, session, redirect, url_for
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
-import json
 import os
+from auth_tokens import TokenAuth, secret_keys_from_env, use_secret_keys
+from password_hashing import PasswordHasher, PasswordHasherBusy
+from user_store import JsonUserStore, SessionReaper, open_user_store
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
+
+# Set SECRET_KEY to the same value on every worker so all of them accept the same cookies and tokens
+SECRET_KEYS = secret_keys_from_env()
+use_secret_keys(app, SECRET_KEYS)
+# /login also returns a bearer token, checked with one HMAC on any worker without reading the user store
+token_auth = TokenAuth(SECRET_KEYS, int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "86400")))
 
 HISTORY_DIR = "chat_histories"
 USERS_FILE = os.path.join(HISTORY_DIR, "users.json")
+USERS_DB_FILE = os.path.join(HISTORY_DIR, "users.db")
+# "json" rewrites users.json on every login; "sqlite" updates one indexed row in users.db
+USER_STORAGE_MODE = os.getenv("USER_STORAGE_MODE", "json")
+# Login sessions expire SESSION_IDLE_TTL_SECONDS after their last use or SESSION_MAX_AGE_SECONDS after
+# login (0 means never); a background thread removes expired ones in batches
+SESSION_IDLE_TTL_SECONDS = int(os.getenv("SESSION_IDLE_TTL_SECONDS", "86400"))
+SESSION_MAX_AGE_SECONDS = int(os.getenv("SESSION_MAX_AGE_SECONDS", "604800"))
+SESSION_REAP_INTERVAL_SECONDS = float(os.getenv("SESSION_REAP_INTERVAL_SECONDS", "60"))
+SESSION_REAP_BATCH_SIZE = int(os.getenv("SESSION_REAP_BATCH_SIZE", "1000"))
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
-users = {}
+# Password hashing runs in worker processes so a burst of logins doesn't stall other requests.
+# PASSWORD_HASH_METHOD is a werkzeug method string, e.g. "scrypt" or "pbkdf2:sha256:600000".
+password_hasher = PasswordHasher(os.getenv("PASSWORD_HASH_METHOD", "scrypt"),
+                                 int(os.getenv("PASSWORD_HASH_WORKERS", "2")),
+                                 int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64")))
 
 
 def save_users():
     try:
-        with open(USERS_FILE, 'w') as f:
-            serializable_users = {}
-            for username, user_data in users.items():
-                serializable_users[username] = {
-                    'password_hash': user_data['password_hash'],
-                    'sessions': user_data['sessions']
-                }
-            json.dump(serializable_users, f, indent=2)
-        print(f"Users saved to {USERS_FILE}")
+        users.flush()
+        if USER_STORAGE_MODE != "sqlite":
+            print(f"Users saved to {USERS_FILE}")
         return True
     except Exception as e:
         print(f"Error saving users: {str(e)}")
@@ -35,33 +48,49 @@ def save_users():
 def load_users():
     global users
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r') as f:
-                users = json.load(f)
-            print(f"Users loaded from {USERS_FILE}")
-            return users
-        else:
-            print(f"No users file found at {USERS_FILE}, creating default users")
-            default_users = {
-                'admin': {
-                    'password_hash': generate_password_hash('admin'),
-                    'sessions': []
-                }
-            }
+        users = open_user_store(USER_STORAGE_MODE, USERS_FILE, USERS_DB_FILE,
+                                SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
+        if users.is_empty():
+            print("No users found, creating default users")
+            users.add_user('admin', password_hasher.hash('admin'))
             save_users()
-            return default_users
+        else:
+            print(f"Users loaded ({USER_STORAGE_MODE} storage)")
+        return users
     except Exception as e:
         print(f"Error loading users: {str(e)}")
-        return {'admin': {'password_hash': generate_password_hash('admin'), 'sessions': []}}
+        users = JsonUserStore(None, SESSION_IDLE_TTL_SECONDS, SESSION_MAX_AGE_SECONDS)
+        users.add_user('admin', password_hasher.hash('admin'))
+        return users
 
 
+# Users and which user owns each login session, so /ask can tell who owns a
+# session without scanning every user
 users = load_users()
+session_reaper = SessionReaper(users, SESSION_REAP_INTERVAL_SECONDS, SESSION_REAP_BATCH_SIZE, on_reaped=save_users)
+
+
+def current_login():
+    """The {"username", "session_id"} of a valid bearer token, else of the session cookie; {} if neither."""
+    login_state = token_auth.verify_header(request.headers.get('Authorization'))
+    if login_state:
+        # Like the cookie, the token is only good while its login session hasn't expired or been logged out
+        if users.touch(login_state.get('session_id')) == login_state.get('username'):
+            return login_state
+        return {}
+    if 'username' in session:
+        # The cookie is only good while its login session hasn't expired or been logged out
+        if users.touch(session.get('session_id')) == session['username']:
+            return {"username": session['username'], "session_id": session.get('session_id')}
+        session.pop('username', None)
+        session.pop('session_id', None)
+    return {}
 
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'username' not in session:
+        if not current_login():
             return jsonify({"error": "Authentication required"}), 401
         return f(*args, **kwargs)
     return decorated_function
@@ -69,37 +98,41 @@ def login_required(f):
 
 @app.route('/register', methods=['POST'])
 def register():
-    global users
     try:
         data = request.get_json()
         if not data or 'username' not in data or 'password' not in data:
             return jsonify({"error": "Missing username or password"}), 400
         username, password = data['username'], data['password']
-        if username in users:
+        if username in users or not users.add_user(username, password_hasher.hash(password)):
             return jsonify({"error": "Username already exists"}), 400
-        users[username] = {'password_hash': generate_password_hash(password), 'sessions': []}
         save_users()
         return jsonify({"message": f"User {username} registered successfully", "status": "success"}), 201
+    except PasswordHasherBusy:
+        return jsonify({"error": "Too many logins in progress, try again shortly"}), 503
     except Exception as e:
         return jsonify({"error": f"Unexpected error: {type(e).__name__}: {str(e)}"}), 500
 
 
 @app.route('/login', methods=['POST'])
 def login():
-    global users
     try:
         data = request.get_json()
         if not data or 'username' not in data or 'password' not in data:
             return jsonify({"error": "Missing username or password"}), 400
         username, password = data['username'], data['password']
-        if username not in users or not check_password_hash(users[username]['password_hash'], password):
+        user = users.get(username)
+        if user is None or not password_hasher.verify(user['password_hash'], password):
             return jsonify({"error": "Invalid username or password"}), 401
         new_session_id = str(os.urandom(16).hex())
-        users[username]['sessions'].append(new_session_id)
+        users.add_session(username, new_session_id)
         session['username'] = username
         session['session_id'] = new_session_id
         save_users()
-        return jsonify({"message": f"User {username} logged in", "status": "success", "session_id": new_session_id}), 200
+        return jsonify({"message": f"User {username} logged in", "status": "success", "session_id": new_session_id,
+                        "token": token_auth.issue(username, new_session_id),
+                        "expires_in": token_auth.ttl_seconds}), 200
+    except PasswordHasherBusy:
+        return jsonify({"error": "Too many logins in progress, try again shortly"}), 503
     except Exception as e:
         return jsonify({"error": f"Unexpected error: {type(e).__name__}: {str(e)}"}), 500
 
@@ -107,13 +140,12 @@ def login():
 @app.route('/logout', methods=['POST'])
 @login_required
 def logout():
-    global users
     try:
         data = request.get_json() or {}
-        session_id = data.get('session_id', session.get('session_id'))
-        username = session.get('username')
-        if username in users and session_id in users[username]['sessions']:
-            users[username]['sessions'].remove(session_id)
+        login_state = current_login()
+        session_id = data.get('session_id', login_state.get('session_id'))
+        username = login_state.get('username')
+        if users.remove_session(username, session_id):
             save_users()
         session.pop('username', None)
         session.pop('session_id', None)
@@ -122,31 +154,31 @@ def logout():
         return jsonify({"error": f"Unexpected error: {type(e).__name__}: {str(e)}"}), 500
 
 
+@app.route('/session-stats', methods=['GET'])
+def session_stats():
+    return jsonify({"sessions": users.stats(), "password_hashing": password_hasher.stats(), "status": "success"}), 200
+
+
 @app.route('/ask', methods=['POST'])
 def ask_question():
     """REST API endpoint to ask a question to Azure OpenAI.
     Expects a JSON payload with 'question' field and optional 'session_id'.
     Returns the model's response as JSON along with the chat history for that session."""
-    global chat_histories, users
+    global chat_histories
     try:
         data = request.get_json()
         if not data or 'question' not in data:
             return jsonify({"error": "Missing 'question' in request body"}), 400
 
         question = data['question']
-        session_id = data.get('session_id', session.get('session_id', 'default_session'))
+        login_state = current_login()
+        session_id = data.get('session_id', login_state.get('session_id', 'default_session'))
 
-        is_authenticated = False
-        session_username = None
-        if 'username' in session and session.get('session_id') == session_id:
-            is_authenticated = True
-            session_username = session.get('username')
+        if login_state.get('session_id') == session_id:
+            session_username = login_state.get('username')
         else:
-            for username, user_data in users.items():
-                if session_id in user_data['sessions']:
-                    is_authenticated = True
-                    session_username = username
-                    break
+            session_username = users.touch(session_id)
+        is_authenticated = session_username is not None
 
         print(f"Question received from {'authenticated ' + session_username if is_authenticated else 'unauthenticated'} session {session_id}: {question}")
 
@@ -0,0 +1,102 @@
+# Reverse index from login session IDs to the users that own them
+import time
+from collections import OrderedDict
+
+
+class UserSessionIndex:
+    """
+    Answers "which user owns this session?" with one dict lookup instead of
+    scanning every user's sessions. load() builds it from the users dict read
+    from disk and turns each user's 'sessions' into a dict of
+    {session_id: {"issued_at", "last_seen"}} (Unix times; a legacy list of IDs
+    counts as issued at load time); add(), touch() and remove() keep both in
+    step. Sessions are also kept in issue and in last-use order, so expired()
+    finds the ones past their TTL without looking at the others. Use
+    serializable_users() to write the users back as JSON.
+    """
+
+    def __init__(self, users=None):
+        self.users = {}
+        self.owners = {}
+        self.activity = OrderedDict()
+        if users is not None:
+            self.load(users)
+
+    def load(self, users):
+        now = time.time()
+        sessions = []
+        for username in users:
+            for session_id, record in self._sessions(users, username, now).items():
+                sessions.append((record["issued_at"], record["last_seen"], session_id, username))
+        self.users = users
+        self.owners = {session_id: username for _, _, session_id, username in sorted(sessions)}
+        self.activity = OrderedDict((session_id, None) for _, _, session_id, _ in
+                                    sorted(sessions, key=lambda session: session[1]))
+
+    @staticmethod
+    def _sessions(users, username, now=None):
+        user_data = users[username]
+        sessions = user_data.get('sessions')
+        if not isinstance(sessions, dict):
+            now = now or time.time()
+            sessions = user_data['sessions'] = {session_id: {"issued_at": now, "last_seen": now}
+                                                for session_id in sessions or []}
+        return sessions
+
+    def record(self, session_id):
+        username = self.owners.get(session_id)
+        if username is None or username not in self.users:
+            return None
+        return self._sessions(self.users, username).get(session_id)
+
+    def owner(self, session_id):
+        """Return the username that owns `session_id`, or None."""
+        return self.owners.get(session_id)
+
+    def sessions(self, username):
+        """Return the session IDs of `username`, oldest first."""
+        if username not in self.users:
+            return []
+        return list(self._sessions(self.users, username))
+
+    def add(self, username, session_id, now=None):
+        now = now or time.time()
+        self._sessions(self.users, username)[session_id] = {"issued_at": now, "last_seen": now}
+        self.owners[session_id] = username
+        self.activity[session_id] = None
+
+    def touch(self, session_id, now=None):
+        """Record that `session_id` was used. Returns its record, or None if there is no such session."""
+        record = self.record(session_id)
+        if record is not None:
+            record["last_seen"] = now or time.time()
+            self.activity.move_to_end(session_id)
+        return record
+
+    def remove(self, username, session_id):
+        """Forget `session_id` if `username` owns it. Returns False if it doesn't."""
+        if self.owners.get(session_id) != username:
+            return False
+        del self.owners[session_id]
+        self.activity.pop(session_id, None)
+        if username in self.users:
+            self._sessions(self.users, username).pop(session_id, None)
+        return True
+
+    def expired(self, idle_before, issued_before, limit):
+        """Up to `limit` (session_id, username) pairs last used before `idle_before` or issued before `issued_before`."""
+        found = {}
+        for session_id in self.activity:
+            if len(found) >= limit or self.record(session_id)["last_seen"] >= idle_before:
+                break
+            found[session_id] = self.owners[session_id]
+        for session_id, username in self.owners.items():
+            if len(found) >= limit or self.record(session_id)["issued_at"] >= issued_before:
+                break
+            found[session_id] = username
+        return list(found.items())
+
+    def serializable_users(self):
+        """The users dict with plain JSON values, ready to dump."""
+        return {username: dict(user_data, sessions=dict(self._sessions(self.users, username)))
+                for username, user_data in self.users.items()}
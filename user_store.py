@@ -0,0 +1,353 @@
+# Storage backends for user accounts and their login sessions
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from history_store import write_json_atomic
+from user_sessions import UserSessionIndex
+
+
+def _expiry_bounds(idle_ttl, absolute_ttl, now):
+    """(idle_before, issued_before): sessions last used or issued before these times have expired."""
+    never = float("-inf")
+    return (now - idle_ttl if idle_ttl else never, now - absolute_ttl if absolute_ttl else never)
+
+
+class JsonUserStore:
+    """
+    All users in one JSON file, held in memory. Changes only reach the file on
+    flush(), which rewrites it atomically; a lock keeps concurrent logins from
+    clobbering each other. flush() only holds that lock to copy the users, so
+    logins and session checks don't wait for the file write; a second lock
+    keeps the writes in order. Pass path=None for a store that is never written.
+
+    Login sessions expire `idle_ttl` seconds after they were last used or
+    `absolute_ttl` seconds after login (None or 0 for no limit); reap() removes
+    expired ones in batches.
+    """
+
+    def __init__(self, path, idle_ttl=None, absolute_ttl=None):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.absolute_ttl = absolute_ttl
+        self.reaped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        users = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                users = json.load(f)
+            if not isinstance(users, dict):
+                raise ValueError(f"{path} does not contain a dictionary of users")
+        self.index = UserSessionIndex(users)
+
+    def __contains__(self, username):
+        return username in self.index.users
+
+    def __len__(self):
+        return len(self.index.users)
+
+    def get(self, username):
+        """Return {"password_hash", "sessions"} for `username`, or None."""
+        with self._lock:
+            user_data = self.index.users.get(username)
+            if user_data is None:
+                return None
+            return {'password_hash': user_data['password_hash'], 'sessions': self.index.sessions(username)}
+
+    def add_user(self, username, password_hash):
+        """Create `username`. Returns False if the username is taken."""
+        with self._lock:
+            if username in self.index.users:
+                return False
+            self.index.users[username] = {'password_hash': password_hash, 'sessions': {}}
+            return True
+
+    def add_session(self, username, session_id):
+        with self._lock:
+            self.index.add(username, session_id)
+
+    def remove_session(self, username, session_id):
+        """Forget `session_id` if `username` owns it. Returns False if it doesn't."""
+        with self._lock:
+            return self.index.remove(username, session_id)
+
+    def owner(self, session_id):
+        """Return the username that owns `session_id`, or None."""
+        return self.index.owner(session_id)
+
+    def touch(self, session_id):
+        """Mark `session_id` as used now. Returns its username, or None if it doesn't exist or has expired."""
+        now = time.time()
+        idle_before, issued_before = _expiry_bounds(self.idle_ttl, self.absolute_ttl, now)
+        with self._lock:
+            record = self.index.record(session_id)
+            if record is None or record["last_seen"] < idle_before or record["issued_at"] < issued_before:
+                return None
+            self.index.touch(session_id, now)
+            return self.index.owner(session_id)
+
+    def sessions(self, username):
+        with self._lock:
+            return self.index.sessions(username)
+
+    def reap(self, limit=1000):
+        """Remove up to `limit` expired sessions. Returns how many were removed."""
+        idle_before, issued_before = _expiry_bounds(self.idle_ttl, self.absolute_ttl, time.time())
+        with self._lock:
+            expired = self.index.expired(idle_before, issued_before, limit)
+            for session_id, username in expired:
+                self.index.remove(username, session_id)
+            self.reaped += len(expired)
+        return len(expired)
+
+    def stats(self):
+        return {"users": len(self.index.users), "active_sessions": len(self.index.owners),
+                "reaped_sessions": self.reaped, "idle_ttl": self.idle_ttl, "absolute_ttl": self.absolute_ttl}
+
+    def is_empty(self):
+        return not self.index.users
+
+    def flush(self):
+        if not self.path:
+            return
+        # Snapshot and write under the flush lock, so a later snapshot is never overwritten by an earlier one
+        with self._flush_lock:
+            with self._lock:
+                users = self.index.serializable_users()
+            write_json_atomic(self.path, users)
+
+
+class SqliteUserStore:
+    """
+    Users and login sessions as indexed rows in an embedded SQLite database.
+    Every change updates just the rows it touches and is committed right away,
+    so login and logout cost the same with ten users or a million.
+
+    Sessions expire like in JsonUserStore. A session's last use is written at
+    most every `touch_interval` seconds, so requests don't each cost a write.
+    """
+
+    def __init__(self, db_file, idle_ttl=None, absolute_ttl=None, touch_interval=60):
+        self.db_file = db_file
+        self.idle_ttl = idle_ttl
+        self.absolute_ttl = absolute_ttl
+        self.touch_interval = touch_interval
+        self.reaped = 0
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "username TEXT PRIMARY KEY, password_hash TEXT NOT NULL, created_at TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_sessions ("
+                "session_id TEXT PRIMARY KEY, username TEXT NOT NULL, created_at TEXT NOT NULL, "
+                "issued_at REAL, last_seen REAL)"
+            )
+            # Databases created before sessions expired have no issue/last-use times; count them from now
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(user_sessions)")]
+            if "issued_at" not in columns:
+                now = time.time()
+                conn.execute("ALTER TABLE user_sessions ADD COLUMN issued_at REAL")
+                conn.execute("ALTER TABLE user_sessions ADD COLUMN last_seen REAL")
+                conn.execute("UPDATE user_sessions SET issued_at = ?, last_seen = ?", (now, now))
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_user_sessions_username ON user_sessions (username)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_user_sessions_last_seen ON user_sessions (last_seen)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_user_sessions_issued_at ON user_sessions (issued_at)"
+            )
+
+    def _connect(self):
+        # sqlite3 connections can't be shared across threads, so each worker thread gets its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def __contains__(self, username):
+        conn = self._connect()
+        return conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+
+    def __len__(self):
+        conn = self._connect()
+        return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def get(self, username):
+        """Return {"password_hash", "sessions"} for `username`, or None."""
+        conn = self._connect()
+        row = conn.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        return {'password_hash': row[0], 'sessions': self.sessions(username)}
+
+    def add_user(self, username, password_hash):
+        """Create `username`. Returns False if the username is taken."""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                (username, password_hash, str(datetime.now()))
+            )
+        return cursor.rowcount == 1
+
+    def add_session(self, username, session_id):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO user_sessions (session_id, username, created_at, issued_at, last_seen) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, username, str(datetime.now()), now, now)
+            )
+
+    def remove_session(self, username, session_id):
+        """Forget `session_id` if `username` owns it. Returns False if it doesn't."""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM user_sessions WHERE session_id = ? AND username = ?", (session_id, username)
+            )
+        return cursor.rowcount == 1
+
+    def owner(self, session_id):
+        """Return the username that owns `session_id`, or None."""
+        conn = self._connect()
+        row = conn.execute("SELECT username FROM user_sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def touch(self, session_id):
+        """Mark `session_id` as used now. Returns its username, or None if it doesn't exist or has expired."""
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT username, issued_at, last_seen FROM user_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        username, issued_at, last_seen = row
+        idle_before, issued_before = _expiry_bounds(self.idle_ttl, self.absolute_ttl, now)
+        if last_seen < idle_before or issued_at < issued_before:
+            return None
+        if now - last_seen >= self.touch_interval:
+            with conn:
+                conn.execute("UPDATE user_sessions SET last_seen = ? WHERE session_id = ?", (now, session_id))
+        return username
+
+    def sessions(self, username):
+        conn = self._connect()
+        return [row[0] for row in conn.execute(
+            "SELECT session_id FROM user_sessions WHERE username = ? ORDER BY rowid", (username,)
+        )]
+
+    def reap(self, limit=1000):
+        """Remove up to `limit` expired sessions. Returns how many were removed."""
+        idle_before, issued_before = _expiry_bounds(self.idle_ttl, self.absolute_ttl, time.time())
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM user_sessions WHERE session_id IN ("
+                "SELECT session_id FROM user_sessions WHERE last_seen < ? OR issued_at < ? LIMIT ?)",
+                (idle_before, issued_before, limit)
+            )
+        self.reaped += cursor.rowcount
+        return cursor.rowcount
+
+    def stats(self):
+        conn = self._connect()
+        return {"users": len(self), "active_sessions": conn.execute("SELECT COUNT(*) FROM user_sessions").fetchone()[0],
+                "reaped_sessions": self.reaped, "idle_ttl": self.idle_ttl, "absolute_ttl": self.absolute_ttl}
+
+    def is_empty(self):
+        conn = self._connect()
+        return conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def flush(self):
+        # Every change is committed as it happens
+        pass
+
+    def import_users(self, users):
+        """Bulk-load a {username: {"password_hash", "sessions"}} dict, e.g. an existing users.json."""
+        UserSessionIndex(users)  # turns legacy lists of session IDs into {session_id: record}
+        conn = self._connect()
+        now = str(datetime.now())
+        with conn:
+            for username, user_data in users.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                    (username, user_data['password_hash'], now)
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO user_sessions (session_id, username, created_at, issued_at, last_seen) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(session_id, username, now, record["issued_at"], record["last_seen"])
+                     for session_id, record in user_data['sessions'].items()]
+                )
+
+
+class SessionReaper:
+    """
+    Every `interval` seconds, removes expired login sessions from `store` in
+    batches of `batch_size` (each batch holds the store's lock only briefly),
+    then calls `on_reaped` once if anything was removed, e.g. to save the users.
+    """
+
+    def __init__(self, store, interval=60, batch_size=1000, on_reaped=None):
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.on_reaped = on_reaped
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.reap()
+
+    def reap(self):
+        """Remove every expired session now. Returns how many were removed."""
+        removed = 0
+        try:
+            while True:
+                count = self.store.reap(self.batch_size)
+                removed += count
+                if count < self.batch_size or self._stopped.is_set():
+                    break
+            if removed and self.on_reaped:
+                self.on_reaped()
+        except Exception as e:
+            print(f"Error reaping login sessions: {str(e)}")
+        return removed
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join(timeout=10)
+
+
+def open_user_store(mode, users_file, db_file, idle_ttl=None, absolute_ttl=None):
+    """
+    Open the user store for `mode` ("json" or "sqlite"). The first time the
+    SQLite store is opened, the users in an existing `users_file` are imported.
+    """
+    if mode != "sqlite":
+        return JsonUserStore(users_file, idle_ttl, absolute_ttl)
+    store = SqliteUserStore(db_file, idle_ttl, absolute_ttl)
+    if store.is_empty() and os.path.exists(users_file):
+        with open(users_file, 'r') as f:
+            store.import_users(json.load(f))
+        print(f"Users imported from {users_file} into {db_file}")
+    return store